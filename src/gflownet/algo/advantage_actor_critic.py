@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch_geometric.data as gd
 from torch import Tensor
 
+from gflownet.data.trajectory_batch import TrajectoryBatch
 from gflownet.envs.graph_building_env import GraphBuildingEnv, GraphBuildingEnvContext, generate_forward_trajectory
 
 from .graph_sampling import GraphSampler
@@ -79,17 +80,13 @@ class A2C:
             Probability of taking a random action
         Returns
         -------
-        data: List[Dict]
-           A list of trajectories. Each trajectory is a dict with keys
-           - trajs: List[Tuple[Graph, GraphAction]]
-           - fwd_logprob: log Z + sum logprobs P_F
-           - bck_logprob: sum logprobs P_B
-           - is_valid: is the generated graph valid according to the env & ctx
+        trajs: TrajectoryBatch
+           The sampled trajectories (see GraphSampler.sample_from_model)
         """
         dev = self.ctx.device
         cond_info = cond_info.to(dev)
-        data = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
-        return data
+        trajs = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
+        return trajs
 
     def create_training_data_from_graphs(self, graphs):
         """Generate trajectories from known endpoints
@@ -101,18 +98,18 @@ class A2C:
 
         Returns
         -------
-        trajs: List[Dict{'traj': List[tuple[Graph, GraphAction]]}]
-           A list of trajectories.
+        trajs: TrajectoryBatch
+           The trajectories.
         """
-        return [{"traj": generate_forward_trajectory(i)} for i in graphs]
+        return TrajectoryBatch.from_graph_trajectories([generate_forward_trajectory(i) for i in graphs], self.ctx)
 
     def construct_batch(self, trajs, cond_info, log_rewards):
         """Construct a batch from a list of trajectories and their information
 
         Parameters
         ----------
-        trajs: List[List[tuple[Graph, GraphAction]]]
-            A list of N trajectories.
+        trajs: TrajectoryBatch
+            A batch of N trajectories.
         cond_info: Tensor
             The conditional info that is considered for each trajectory. Shape (N, n_info)
         log_rewards: Tensor
@@ -122,16 +119,13 @@ class A2C:
         batch: gd.Batch
              A (CPU) Batch object with relevant attributes added
         """
-        torch_graphs = [self.ctx.graph_to_Data(i[0]) for tj in trajs for i in tj["traj"]]
-        actions = [
-            self.ctx.GraphAction_to_aidx(g, a) for g, a in zip(torch_graphs, [i[1] for tj in trajs for i in tj["traj"]])
-        ]
+        _, torch_graphs, _, _ = trajs.replay(self.env, self.ctx)
         batch = self.ctx.collate(torch_graphs)
-        batch.traj_lens = torch.tensor([len(i["traj"]) for i in trajs])
-        batch.actions = torch.tensor(actions)
+        batch.traj_lens = trajs.traj_lens
+        batch.actions = trajs.actions
         batch.log_rewards = log_rewards
         batch.cond_info = cond_info
-        batch.is_valid = torch.tensor([i.get("is_valid", True) for i in trajs]).float()
+        batch.is_valid = trajs.is_valid.float()
         return batch
 
     def compute_batch_losses(self, model: nn.Module, batch: gd.Batch, num_bootstrap: int = 0):
@@ -176,7 +170,7 @@ class A2C:
             "V_loss": V_loss,
             "A": A.mean(),
             "invalid_trajectories": invalid_mask.sum() / batch.num_online if batch.num_online > 0 else 0,
-            "loss": loss.item(),
+            "loss": loss.detach(),
         }
 
         if not torch.isfinite(loss).all():
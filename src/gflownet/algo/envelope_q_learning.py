@@ -8,6 +8,7 @@ import torch_geometric.data as gd
 from torch import Tensor
 from torch_scatter import scatter
 
+from gflownet.data.trajectory_batch import TrajectoryBatch
 from gflownet.envs.graph_building_env import (
     GraphActionCategorical,
     GraphBuildingEnv,
@@ -230,17 +231,13 @@ class EnvelopeQLearning:
             Probability of taking a random action
         Returns
         -------
-        data: List[Dict]
-           A list of trajectories. Each trajectory is a dict with keys
-           - trajs: List[Tuple[Graph, GraphAction]]
-           - fwd_logprob: log Z + sum logprobs P_F
-           - bck_logprob: sum logprobs P_B
-           - is_valid: is the generated graph valid according to the env & ctx
+        trajs: TrajectoryBatch
+           The sampled trajectories (see GraphSampler.sample_from_model)
         """
         dev = self.ctx.device
         cond_info = cond_info.to(dev)
-        data = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
-        return data
+        trajs = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
+        return trajs
 
     def create_training_data_from_graphs(self, graphs):
         """Generate trajectories from known endpoints
@@ -252,18 +249,18 @@ class EnvelopeQLearning:
 
         Returns
         -------
-        trajs: List[Dict{'traj': List[tuple[Graph, GraphAction]]}]
-           A list of trajectories.
+        trajs: TrajectoryBatch
+           The trajectories.
         """
-        return [{"traj": generate_forward_trajectory(i)} for i in graphs]
+        return TrajectoryBatch.from_graph_trajectories([generate_forward_trajectory(i) for i in graphs], self.ctx)
 
     def construct_batch(self, trajs, cond_info, log_rewards):
         """Construct a batch from a list of trajectories and their information
 
         Parameters
         ----------
-        trajs: List[List[tuple[Graph, GraphAction]]]
-            A list of N trajectories.
+        trajs: TrajectoryBatch
+            A batch of N trajectories.
         cond_info: Tensor
             The conditional info that is considered for each trajectory. Shape (N, n_info)
         log_rewards: Tensor
@@ -273,24 +270,20 @@ class EnvelopeQLearning:
         batch: gd.Batch
              A (CPU) Batch object with relevant attributes added
         """
-        torch_graphs = [self.ctx.graph_to_Data(i[0]) for tj in trajs for i in tj["traj"]]
-        actions = [
-            self.ctx.GraphAction_to_aidx(g, a) for g, a in zip(torch_graphs, [i[1] for tj in trajs for i in tj["traj"]])
-        ]
+        _, torch_graphs, _, _ = trajs.replay(self.env, self.ctx)
         batch = self.ctx.collate(torch_graphs)
-        batch.traj_lens = torch.tensor([len(i["traj"]) for i in trajs])
-        batch.actions = torch.tensor(actions)
+        batch.traj_lens = trajs.traj_lens
+        batch.actions = trajs.actions
         batch.log_rewards = log_rewards
         batch.cond_info = cond_info
-        batch.is_valid = torch.tensor([i.get("is_valid", True) for i in trajs]).float()
+        batch.is_valid = trajs.is_valid.float()
 
         # Now we create a duplicate/repeated batch for Q(s,a,w')
         omega_prime = self.task.sample_conditional_information(self.num_omega_samples * batch.num_graphs)
         torch_graphs = [i for i in torch_graphs for j in range(self.num_omega_samples)]
-        actions = [i for i in actions for j in range(self.num_omega_samples)]
         batch_prime = self.ctx.collate(torch_graphs)
         batch_prime.traj_lens = batch.traj_lens.repeat_interleave(self.num_omega_samples)
-        batch_prime.actions = torch.tensor(actions)
+        batch_prime.actions = trajs.actions.repeat_interleave(self.num_omega_samples, 0)
         batch_prime.cond_info = omega_prime["encoding"]
         batch_prime.preferences = omega_prime["preferences"]
         batch.batch_prime = batch_prime
@@ -404,7 +397,7 @@ class EnvelopeQLearning:
         loss = losses.mean()
         invalid_mask = 1 - batch.is_valid
         info = {
-            "loss": loss.item(),
+            "loss": loss.detach(),
             "loss_A": loss_A.mean(),
             "loss_B": loss_B.mean(),
             "offline_loss": traj_losses[: batch.num_offline].mean() if batch.num_offline > 0 else 0,
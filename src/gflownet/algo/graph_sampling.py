@@ -1,11 +1,14 @@
 import copy
-from typing import List
+import math
+from typing import List, Tuple
 
 import torch
 import torch.nn as nn
 from torch import Tensor
 
+from gflownet.data.trajectory_batch import TrajectoryBatch
 from gflownet.envs.graph_building_env import GraphAction, GraphActionType
+from gflownet.utils.timing import timers
 
 
 class GraphSampler:
@@ -63,18 +66,22 @@ class GraphSampler:
 
         Returns
         -------
-        data: List[Dict]
-           A list of trajectories. Each trajectory is a dict with keys
-           - trajs: List[Tuple[Graph, GraphAction]], the list of states and actions
-           - fwd_logprob: sum logprobs P_F
-           - bck_logprob: sum logprobs P_B
-           - is_valid: is the generated graph valid according to the env & ctx
+        trajs: TrajectoryBatch
+           The sampled trajectories, with their forward (sampling) and backward (uniform) step
+           log-probabilities, whether they are valid according to the env & ctx, and, if
+           `pad_with_terminal_state` is set, the backward actions and sink flags of each step.
         """
-        # This will be returned
-        data = [{"traj": [], "reward_pred": None, "is_valid": True, "is_sink": []} for i in range(n)]
-        # Let's also keep track of trajectory statistics according to the model
-        fwd_logprob: List[List[Tensor]] = [[] for i in range(n)]
-        bck_logprob: List[List[Tensor]] = [[] for i in range(n)]
+        # Per-trajectory lists of per-step values, these are flattened into a TrajectoryBatch at the end.
+        # States are not kept (the Data of every step would take far more memory than the rest of the
+        # trajectory), they can be recovered from the actions.
+        fwd_a: List[List[Tuple[int, int, int]]] = [[] for i in range(n)]
+        bck_logprob: List[List[float]] = [[] for i in range(n)]
+        is_sink: List[List[int]] = [[] for i in range(n)]
+        is_valid = [True] * n
+        # Forward log-probs are kept as one tensor per timestep (on `dev`) and only gathered at the
+        # end, along with the trajectory index of each of their entries
+        fwd_logprobs: List[Tensor] = []
+        fwd_traj_idx: List[int] = []
 
         graphs = [self.env.new() for i in range(n)]
         done = [False] * n
@@ -83,77 +90,85 @@ class GraphSampler:
         # always be at least a valid index, and will be masked out anyways -- but this isn't ideal.
         # Here we have to pad the backward actions with something, since the backward actions are
         # evaluated at s_{t+1} not s_t.
-        bck_a = [[GraphAction(GraphActionType.Stop)] for i in range(n)]
-
-        def not_done(lst):
-            return [e for i, e in enumerate(lst) if not done[i]]
+        bck_a = [GraphAction(GraphActionType.Stop) for i in range(n)]  # P_B action leading to graphs[i]
+        bck_aidx: List[List[Tuple[int, int, int]]] = [[] for i in range(n)]
 
         for t in range(self.max_len):
             # Construct graphs for the trajectories that aren't yet done
-            torch_graphs = [self.ctx.graph_to_Data(i) for i in not_done(graphs)]
-            not_done_mask = torch.tensor(done, device=dev).logical_not()
+            with timers("graph_to_Data"):
+                not_done_idx = [i for i in range(n) if not done[i]]
+                torch_graphs = [self.ctx.graph_to_Data(graphs[i]) for i in not_done_idx]
+                not_done_mask = torch.tensor(done, device=dev).logical_not()
+                batch = self.ctx.collate(torch_graphs).to(dev)
             # Forward pass to get GraphActionCategorical
             # Note about `*_`, the model may be outputting its own bck_cat, but we ignore it if it does.
             # TODO: compute bck_cat.log_prob(bck_a) when relevant
-            fwd_cat, *_, log_reward_preds = model(self.ctx.collate(torch_graphs).to(dev), cond_info[not_done_mask])
-            if random_action_prob > 0:
-                masks = [1] * len(fwd_cat.logits) if fwd_cat.masks is None else fwd_cat.masks
-                # Device which graphs in the minibatch will get their action randomized
-                is_random_action = torch.tensor(
-                    self.rng.uniform(size=len(torch_graphs)) < random_action_prob, device=dev
-                ).float()
-                # Set the logits to some large value if they're not masked, this way the masked
-                # actions have no probability of getting sampled, and there is a uniform
-                # distribution over the rest
-                fwd_cat.logits = [
-                    # We don't multiply m by i on the right because we're assume the model forward()
-                    # method already does that
-                    is_random_action[b][:, None] * torch.ones_like(i) * m * 100 + i * (1 - is_random_action[b][:, None])
-                    for i, m, b in zip(fwd_cat.logits, masks, fwd_cat.batch)
-                ]
-            if self.sample_temp != 1:
-                sample_cat = copy.copy(fwd_cat)
-                sample_cat.logits = [i / self.sample_temp for i in fwd_cat.logits]
-                actions = sample_cat.sample()
-            else:
-                actions = fwd_cat.sample()
-            graph_actions = [self.ctx.aidx_to_GraphAction(g, a) for g, a in zip(torch_graphs, actions)]
-            log_probs = fwd_cat.log_prob(actions)
+            with timers("forward"):
+                fwd_cat, *_, log_reward_preds = model(batch, cond_info[not_done_mask])
+            with timers("sample_actions"):
+                if random_action_prob > 0:
+                    masks = [1] * len(fwd_cat.logits) if fwd_cat.masks is None else fwd_cat.masks
+                    # Device which graphs in the minibatch will get their action randomized
+                    is_random_action = torch.tensor(
+                        self.rng.uniform(size=len(torch_graphs)) < random_action_prob, device=dev
+                    ).float()
+                    # Set the logits to some large value if they're not masked, this way the masked
+                    # actions have no probability of getting sampled, and there is a uniform
+                    # distribution over the rest
+                    fwd_cat.logits = [
+                        # We don't multiply m by i on the right because we're assume the model forward()
+                        # method already does that
+                        is_random_action[b][:, None] * torch.ones_like(i) * m * 100
+                        + i * (1 - is_random_action[b][:, None])
+                        for i, m, b in zip(fwd_cat.logits, masks, fwd_cat.batch)
+                    ]
+                if self.sample_temp != 1:
+                    sample_cat = copy.copy(fwd_cat)
+                    sample_cat.logits = [i / self.sample_temp for i in fwd_cat.logits]
+                    actions = sample_cat.sample()
+                else:
+                    actions = fwd_cat.sample()
+                graph_actions = [self.ctx.aidx_to_GraphAction(g, a) for g, a in zip(torch_graphs, actions)]
+                fwd_logprobs.append(fwd_cat.log_prob(actions))
+                fwd_traj_idx += not_done_idx
             # Step each trajectory, and accumulate statistics
-            for i, j in zip(not_done(range(n)), range(n)):
-                fwd_logprob[i].append(log_probs[j].unsqueeze(0))
-                data[i]["traj"].append((graphs[i], graph_actions[j]))
-                bck_a[i].append(self.env.reverse(graphs[i], graph_actions[j]))
-                # Check if we're done
-                if graph_actions[j].action is GraphActionType.Stop:
-                    done[i] = True
-                    bck_logprob[i].append(torch.tensor([1.0], device=dev).log())
-                    data[i]["is_sink"].append(1)
-                else:  # If not done, try to step the self.environment
-                    gp = graphs[i]
-                    try:
-                        # self.env.step can raise AssertionError if the action is illegal
-                        gp = self.env.step(graphs[i], graph_actions[j])
-                        assert len(gp.nodes) <= self.max_nodes
-                    except AssertionError:
-                        done[i] = True
-                        data[i]["is_valid"] = False
-                        bck_logprob[i].append(torch.tensor([1.0], device=dev).log())
-                        data[i]["is_sink"].append(1)
-                        continue
-                    if t == self.max_len - 1:
+            with timers("env_step"):
+                for j, i in enumerate(not_done_idx):
+                    fwd_a[i].append(actions[j])
+                    if self.pad_with_terminal_state:
+                        bck_aidx[i].append(self.ctx.GraphAction_to_aidx(torch_graphs[j], bck_a[i]))
+                    bck_a[i] = self.env.reverse(graphs[i], graph_actions[j])
+                    # Check if we're done
+                    if graph_actions[j].action is GraphActionType.Stop:
                         done[i] = True
-                    # If no error, add to the trajectory
-                    # P_B = uniform backward
-                    n_back = self.env.count_backward_transitions(gp, check_idempotent=self.correct_idempotent)
-                    bck_logprob[i].append(torch.tensor([1 / n_back], device=dev).log())
-                    data[i]["is_sink"].append(0)
-                    graphs[i] = gp
-                if done[i] and self.sanitize_samples and not self.ctx.is_sane(graphs[i]):
-                    # check if the graph is sane (e.g. RDKit can
-                    # construct a molecule from it) otherwise
-                    # treat the done action as illegal
-                    data[i]["is_valid"] = False
+                        bck_logprob[i].append(0.0)
+                        is_sink[i].append(1)
+                    else:  # If not done, try to step the self.environment
+                        gp = graphs[i]
+                        try:
+                            # self.env.step can raise AssertionError if the action is illegal
+                            gp = self.env.step(graphs[i], graph_actions[j])
+                            assert len(gp.nodes) <= self.max_nodes
+                        except AssertionError:
+                            done[i] = True
+                            is_valid[i] = False
+                            bck_logprob[i].append(0.0)
+                            is_sink[i].append(1)
+                            continue
+                        if t == self.max_len - 1:
+                            done[i] = True
+                        # If no error, add to the trajectory
+                        # P_B = uniform backward
+                        n_back = self.env.count_backward_transitions(gp, check_idempotent=self.correct_idempotent)
+                        bck_logprob[i].append(math.log(1 / n_back))
+                        is_sink[i].append(0)
+                        graphs[i] = gp
+                    if done[i] and self.sanitize_samples:
+                        # check if the graph is sane (e.g. RDKit can
+                        # construct a molecule from it) otherwise
+                        # treat the done action as illegal
+                        with timers("is_sane"):
+                            is_valid[i] = is_valid[i] and self.ctx.is_sane(graphs[i])
             if all(done):
                 break
 
@@ -170,18 +185,32 @@ class GraphSampler:
         #  C - ends at max_len.              = [..., (g, a), (gp, None)],                 = [..., bck(gp), 1]
         # and then P_F(terminal) "must" be 1
 
-        for i in range(n):
-            # If we're not bootstrapping, we could query the reward
-            # model here, but this is expensive/impractical.  Instead
-            # just report forward and backward logprobs
-            data[i]["fwd_logprob"] = sum(fwd_logprob[i])
-            data[i]["bck_logprob"] = sum(bck_logprob[i])
-            data[i]["bck_logprobs"] = torch.stack(bck_logprob[i]).reshape(-1)
-            data[i]["result"] = graphs[i]
-            data[i]["bck_a"] = bck_a[i]
-            if self.pad_with_terminal_state:
-                # TODO: instead of padding with Stop, we could have a virtual action whose
-                # probability always evaluates to 1.
-                data[i]["traj"].append((graphs[i], GraphAction(GraphActionType.Stop)))
-                data[i]["is_sink"].append(1)
-        return data
+        # Gather the forward log-probs in trajectory-major order; a stable sort keeps the steps of
+        # each trajectory in temporal order.
+        fwd_order = torch.sort(torch.tensor(fwd_traj_idx), stable=True).indices
+        log_p_F = torch.cat(fwd_logprobs).detach().cpu()[fwd_order] if len(fwd_logprobs) else torch.zeros(0)
+        if self.pad_with_terminal_state:
+            # TODO: instead of padding with Stop, we could have a virtual action whose
+            # probability always evaluates to 1.
+            stop = GraphAction(GraphActionType.Stop)
+            log_p_F = torch.cat([torch.cat([i, torch.zeros(1)]) for i in log_p_F.split([len(i) for i in fwd_a])])
+            for i in range(n):
+                gd = self.ctx.graph_to_Data(graphs[i])
+                fwd_a[i].append(self.ctx.GraphAction_to_aidx(gd, stop))
+                bck_aidx[i].append(self.ctx.GraphAction_to_aidx(gd, bck_a[i]))
+                bck_logprob[i].append(0.0)
+                is_sink[i].append(1)
+        return TrajectoryBatch(
+            traj_lens=torch.tensor([len(i) for i in fwd_a], dtype=torch.long),
+            actions=torch.tensor(sum(fwd_a, []), dtype=torch.long).reshape((-1, 3)),
+            results=graphs,
+            is_valid=torch.tensor(is_valid),
+            log_p_F=log_p_F,
+            log_p_B=torch.tensor(sum(bck_logprob, [])),
+            bck_actions=(
+                torch.tensor(sum(bck_aidx, []), dtype=torch.long).reshape((-1, 3))
+                if self.pad_with_terminal_state
+                else None
+            ),
+            is_sink=torch.tensor(sum(is_sink, []), dtype=torch.long),
+        )
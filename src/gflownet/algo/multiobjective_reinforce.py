@@ -52,7 +52,7 @@ class MultiObjectiveReinforce(TrajectoryBalance):
 
         loss = traj_losses.mean()
         info = {
-            "loss": loss.item(),
+            "loss": loss.detach(),
         }
         if not torch.isfinite(traj_losses).all():
             raise ValueError("loss is not finite")
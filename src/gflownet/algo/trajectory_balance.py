@@ -9,6 +9,7 @@ from torch import Tensor
 from torch_scatter import scatter, scatter_sum
 
 from gflownet.algo.graph_sampling import GraphSampler
+from gflownet.data.trajectory_batch import TrajectoryBatch
 from gflownet.envs.graph_building_env import (
     Graph,
     GraphAction,
@@ -118,23 +119,14 @@ class TrajectoryBalance:
             Probability of taking a random action
         Returns
         -------
-        data: List[Dict]
-           A list of trajectories. Each trajectory is a dict with keys
-           - trajs: List[Tuple[Graph, GraphAction]]
-           - reward_pred: float, -100 if an illegal action is taken, predicted R(x) if bootstrapping, None otherwise
-           - fwd_logprob: log Z + sum logprobs P_F
-           - bck_logprob: sum logprobs P_B
-           - logZ: predicted log Z
-           - loss: predicted loss (if bootstrapping)
-           - is_valid: is the generated graph valid according to the env & ctx
+        trajs: TrajectoryBatch
+           The sampled trajectories (see GraphSampler.sample_from_model), with their logZ prediction
         """
         dev = self.ctx.device
         cond_info = cond_info.to(dev)
-        data = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
-        logZ_pred = model.logZ(cond_info)
-        for i in range(n):
-            data[i]["logZ"] = logZ_pred[i].item()
-        return data
+        trajs = self.graph_sampler.sample_from_model(model, n, cond_info, dev, random_action_prob)
+        trajs.logZ = model.logZ(cond_info)[:, 0].detach().cpu()
+        return trajs
 
     def create_training_data_from_graphs(self, graphs):
         """Generate trajectories from known endpoints
@@ -146,18 +138,17 @@ class TrajectoryBalance:
 
         Returns
         -------
-        trajs: List[Dict{'traj': List[tuple[Graph, GraphAction]]}]
-           A list of trajectories.
+        trajs: TrajectoryBatch
+           The trajectories, with their (uniform) P_B log-probabilities.
         """
-        trajs = [{"traj": generate_forward_trajectory(i)} for i in graphs]
+        trajs = [generate_forward_trajectory(i) for i in graphs]
+        log_p_B = []
         for traj in trajs:
             n_back = [
-                self.env.count_backward_transitions(gp, check_idempotent=self.correct_idempotent)
-                for gp, _ in traj["traj"][1:]
+                self.env.count_backward_transitions(gp, check_idempotent=self.correct_idempotent) for gp, _ in traj[1:]
             ] + [1]
-            traj["bck_logprobs"] = (1 / torch.tensor(n_back).float()).log().to(self.ctx.device)
-            traj["result"] = traj["traj"][-1][0]
-        return trajs
+            log_p_B.append((1 / torch.tensor(n_back).float()).log())
+        return TrajectoryBatch.from_graph_trajectories(trajs, self.ctx, log_p_B)
 
     def get_idempotent_actions(self, g: Graph, gd: gd.Data, gp: Graph, action: GraphAction):
         """Returns the list of idempotent actions for a given transition.
@@ -207,8 +198,8 @@ class TrajectoryBalance:
 
         Parameters
         ----------
-        trajs: List[List[tuple[Graph, GraphAction]]]
-            A list of N trajectories.
+        trajs: TrajectoryBatch
+            A batch of N trajectories.
         cond_info: Tensor
             The conditional info that is considered for each trajectory. Shape (N, n_info)
         log_rewards: Tensor
@@ -218,31 +209,26 @@ class TrajectoryBalance:
         batch: gd.Batch
              A (CPU) Batch object with relevant attributes added
         """
-        torch_graphs = [self.ctx.graph_to_Data(i[0]) for tj in trajs for i in tj["traj"]]
-        actions = [
-            self.ctx.GraphAction_to_aidx(g, a) for g, a in zip(torch_graphs, [i[1] for tj in trajs for i in tj["traj"]])
-        ]
+        if not self.correct_idempotent and trajs.states is not None and all(i is not None for i in trajs.states):
+            # The states were precomputed (see data/offline_trajectories.py), the trajectories needn't be replayed
+            torch_graphs = trajs.states
+        else:
+            agraphs, torch_graphs, gactions, bck_gactions = trajs.replay(self.env, self.ctx)
         batch = self.ctx.collate(torch_graphs)
-        batch.traj_lens = torch.tensor([len(i["traj"]) for i in trajs])
-        batch.log_p_B = torch.cat([i["bck_logprobs"] for i in trajs], 0)
-        batch.actions = torch.tensor(actions)
+        batch.traj_lens = trajs.traj_lens
+        batch.log_p_B = trajs.log_p_B
+        batch.actions = trajs.actions
         if self.p_b_is_parameterized:
-            batch.bck_actions = torch.tensor(
-                [
-                    self.ctx.GraphAction_to_aidx(g, a)
-                    for g, a in zip(torch_graphs, [i for tj in trajs for i in tj["bck_a"]])
-                ]
-            )
-            batch.is_sink = torch.tensor(sum([i["is_sink"] for i in trajs], []))
+            batch.bck_actions = trajs.bck_actions
+            batch.is_sink = trajs.is_sink
         batch.log_rewards = log_rewards
         batch.cond_info = cond_info
-        batch.is_valid = torch.tensor([i.get("is_valid", True) for i in trajs]).float()
+        batch.is_valid = trajs.is_valid.float()
         if self.correct_idempotent:
             # Every timestep is a (graph_a, action, graph_b) triple
-            agraphs = [i[0] for tj in trajs for i in tj["traj"]]
+            ptr = trajs.step_ptr.tolist()
             # Here we start at the 1th timestep and append the result
-            bgraphs = sum([[i[0] for i in tj["traj"][1:]] + [tj["result"]] for tj in trajs], [])
-            gactions = [i[1] for tj in trajs for i in tj["traj"]]
+            bgraphs = sum([agraphs[ptr[i] + 1 : ptr[i + 1]] + [trajs.results[i]] for i in range(len(trajs))], [])
             ipa = [
                 self.get_idempotent_actions(g, gd, gp, a)
                 for g, gd, gp, a in zip(agraphs, torch_graphs, bgraphs, gactions)
@@ -251,11 +237,10 @@ class TrajectoryBalance:
             batch.ip_lens = torch.tensor([len(i) for i in ipa])
             if self.p_b_is_parameterized:
                 # Here we start at the 0th timestep and prepend None (it will be unused)
-                bgraphs = sum([[None] + [i[0] for i in tj["traj"][:-1]] for tj in trajs], [])
-                gactions = [i for tj in trajs for i in tj["bck_a"]]
+                bgraphs = sum([[None] + agraphs[ptr[i] : ptr[i + 1] - 1] for i in range(len(trajs))], [])
                 bck_ipa = [
                     self.get_idempotent_actions(g, gd, gp, a)
-                    for g, gd, gp, a in zip(agraphs, torch_graphs, bgraphs, gactions)
+                    for g, gd, gp, a in zip(agraphs, torch_graphs, bgraphs, bck_gactions)
                 ]
                 batch.bck_ip_actions = torch.tensor(sum(bck_ipa, []))
                 batch.bck_ip_lens = torch.tensor([len(i) for i in bck_ipa])
@@ -418,15 +403,19 @@ class TrajectoryBalance:
             reward_loss = 0
 
         loss = traj_losses.mean() + reward_loss * self.reward_loss_multiplier
+        # Replayed trajectories (see ReplayBuffer), if any, come after the online trajectories
+        num_replayed = getattr(batch, "num_replayed", 0)
+        end_online = batch.num_offline + batch.num_online
         info = {
             "offline_loss": traj_losses[: batch.num_offline].mean() if batch.num_offline > 0 else 0,
-            "online_loss": traj_losses[batch.num_offline :].mean() if batch.num_online > 0 else 0,
+            "online_loss": traj_losses[batch.num_offline : end_online].mean() if batch.num_online > 0 else 0,
+            "replay_loss": traj_losses[end_online:].mean() if num_replayed > 0 else 0,
             "reward_loss": reward_loss,
             "invalid_trajectories": invalid_mask.sum() / batch.num_online if batch.num_online > 0 else 0,
             "invalid_logprob": (invalid_mask * traj_log_p_F).sum() / (invalid_mask.sum() + 1e-4),
             "invalid_losses": (invalid_mask * traj_losses).sum() / (invalid_mask.sum() + 1e-4),
             "logZ": log_Z.mean(),
-            "loss": loss.item(),
+            "loss": loss.detach(),
         }
 
         return loss, info
@@ -0,0 +1,5 @@
+"""Performance benchmarks of gflownet's hot paths.
+
+Run with `gflownet-bench run -o results.json` (or `python -m gflownet.benchmarks`), and compare
+two runs with `gflownet-bench compare baseline.json results.json`. See `gflownet-bench --help`.
+"""
@@ -0,0 +1,107 @@
+import argparse
+import json
+import sys
+
+from gflownet.benchmarks import core
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="gflownet-bench", description="gflownet performance benchmarks")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("run", help="Run the micro-benchmarks")
+    run.add_argument("-k", "--filter", nargs="*", help="Only run the benchmarks matching these glob patterns")
+    run.add_argument("-o", "--output", help="Write the results to this JSON file")
+    run.add_argument("--repeats", type=int, default=5)
+    run.add_argument("--min-time", type=float, default=0.2, help="Minimum duration (in seconds) of each repeat")
+    run.add_argument("--num-threads", type=int, default=1, help="Number of torch threads")
+    run.add_argument("--compare", help="Compare the results to those of this JSON file")
+    run.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown flagged as a regression")
+
+    cmp = subparsers.add_parser("compare", help="Compare two benchmark result files")
+    cmp.add_argument("baseline")
+    cmp.add_argument("results")
+    cmp.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown flagged as a regression")
+
+    subparsers.add_parser("list", help="List the micro-benchmarks")
+
+    tp = subparsers.add_parser("throughput", help="Measure the end-to-end training throughput of a task")
+    tp.add_argument("--task", nargs="+", default=["seh_frag"], choices=["seh_frag", "seh_frag_moo"])
+    tp.add_argument("--workers", nargs="+", type=int, default=[0, 4], help="Values of num_data_loader_workers")
+    tp.add_argument("--batch-sizes", nargs="+", type=int, default=[64], help="Values of global_batch_size")
+    tp.add_argument("--pickle-messages", nargs="+", type=int, default=[0, 1], help="Values of mp_pickle_messages")
+    tp.add_argument("--offline-ratios", nargs="+", type=float, default=[0.0], help="Values of offline_ratio")
+    tp.add_argument("--steps", type=int, default=20, help="Number of measured training steps")
+    tp.add_argument("--warmup", type=int, default=3, help="Number of training steps before measuring")
+    tp.add_argument("--hps", type=json.loads, default={}, help="JSON dict of hps overriding the task defaults")
+    tp.add_argument("--device", default="cpu")
+    tp.add_argument("-o", "--output", help="Write the results to this JSON file")
+
+    qt = subparsers.add_parser("quantization", help="Measure the accuracy and speed of the int8 quantized models")
+    qt.add_argument("--num-trajs", type=int, default=256, help="Number of held-out trajectories")
+    qt.add_argument("--checkpoint", help="A model_state.pt of SEHFragTrainer, instead of a random sampling model")
+    qt.add_argument("--pretrained", action="store_true", help="Download the sEH proxy's weights, instead of random")
+    qt.add_argument("--num-threads", type=int, default=1, help="Number of torch threads")
+    qt.add_argument("--repeats", type=int, default=5)
+    qt.add_argument("--min-time", type=float, default=0.2, help="Minimum duration (in seconds) of each repeat")
+    qt.add_argument("-o", "--output", help="Write the report to this JSON file")
+
+    args = parser.parse_args(argv)
+    if args.command == "throughput":
+        return _throughput(args)
+    if args.command == "quantization":
+        return _quantization(args)
+    # Importing the module registers the benchmarks
+    from gflownet.benchmarks import micro  # noqa: F401
+
+    if args.command == "list":
+        print("\n".join(core.BENCHMARKS.keys()))
+        return 0
+    if args.command == "run":
+        results = core.run_benchmarks(args.filter, args.repeats, args.min_time, args.num_threads)
+        if args.output is not None:
+            core.save_results(results, args.output)
+        if args.compare is None:
+            return 0
+        baseline = core.load_results(args.compare)
+    else:
+        baseline, results = core.load_results(args.baseline), core.load_results(args.results)
+    rows = core.compare(baseline, results, args.threshold)
+    print(core.format_comparison(rows))
+    # A non-zero exit code lets CI fail on regressions
+    return int(any(r["status"] == "regression" for r in rows))
+
+
+def _throughput(args):
+    from gflownet.benchmarks import throughput
+
+    results = throughput.sweep(
+        args.task,
+        args.workers,
+        args.batch_sizes,
+        [bool(i) for i in args.pickle_messages],
+        args.offline_ratios,
+        num_steps=args.steps,
+        warmup_steps=args.warmup,
+        extra_hps=args.hps,
+        device=args.device,
+    )
+    if args.output is not None:
+        core.save_results({"meta": core.environment_info(), "results": results}, args.output)
+    return int(any("error" in r for r in results))
+
+
+def _quantization(args):
+    from gflownet.benchmarks import quantization
+
+    report = quantization.run(
+        args.num_trajs, args.checkpoint, args.pretrained, args.num_threads, args.repeats, args.min_time
+    )
+    print(quantization.format_report(report))
+    if args.output is not None:
+        core.save_results(report, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
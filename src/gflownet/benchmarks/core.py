@@ -0,0 +1,177 @@
+import fnmatch
+import json
+import platform
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+# A benchmark's setup function builds its inputs, and returns the function to time along with the
+# number of items (e.g. graphs, trajectories) each call processes.
+SetupFn = Callable[[], Tuple[Callable[[], Any], int]]
+
+BENCHMARKS: Dict[str, Tuple[SetupFn, str]] = {}
+
+
+def benchmark(name: str, unit: str = "call"):
+    """Registers a benchmark setup function under `name`, `unit` is what the benchmark's items are"""
+
+    def decorator(setup: SetupFn) -> SetupFn:
+        assert name not in BENCHMARKS, f"Benchmark {name} is already registered"
+        BENCHMARKS[name] = (setup, unit)
+        return setup
+
+    return decorator
+
+
+def time_fn(fn: Callable[[], Any], repeats: int = 5, min_time: float = 0.2) -> Dict[str, float]:
+    """Times `fn`, calling it enough times per repeat that a repeat lasts at least `min_time` seconds
+
+    Returns
+    -------
+    timings: Dict[str, float]
+        The median, min, mean and std (over repeats) of the time per call in seconds, and the number
+        of calls per repeat.
+    """
+    fn()  # Warmup
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - t0
+        if elapsed >= min_time or number >= 2**20:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    times = [elapsed / number]
+    for _ in range(repeats - 1):
+        t0 = time.perf_counter()
+        for _ in range(number):
+            fn()
+        times.append((time.perf_counter() - t0) / number)
+    return {
+        "median_s": float(np.median(times)),
+        "min_s": float(np.min(times)),
+        "mean_s": float(np.mean(times)),
+        "std_s": float(np.std(times)),
+        "number": number,
+        "repeats": repeats,
+    }
+
+
+def run_benchmarks(
+    patterns: Optional[List[str]] = None,
+    repeats: int = 5,
+    min_time: float = 0.2,
+    num_threads: int = 1,
+    seed: int = 142857,
+    verbose=True,
+) -> Dict[str, Any]:
+    """Runs the registered benchmarks whose name matches any of the glob `patterns` (all if None)
+
+    Benchmarks run on CPU with `num_threads` torch threads, and every benchmark's inputs are
+    generated with the same `seed`. Benchmarks whose setup raises an ImportError (e.g. because of a
+    missing optional dependency) are reported as skipped.
+
+    Returns
+    -------
+    results: Dict[str, Any]
+        A JSON-serializable dict, `{"meta": {...}, "results": {name: {...}}}`.
+    """
+    prev_num_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    try:
+        results = _run_benchmarks(patterns, repeats, min_time, seed, verbose)
+        return {"meta": environment_info(), "results": results}
+    finally:
+        torch.set_num_threads(prev_num_threads)
+
+
+def _run_benchmarks(patterns, repeats, min_time, seed, verbose) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    for name, (setup, unit) in BENCHMARKS.items():
+        if patterns is not None and not any(fnmatch.fnmatch(name, p) for p in patterns):
+            continue
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        try:
+            fn, num_items = setup()
+        except ImportError as e:
+            results[name] = {"skipped": f"ImportError: {e}"}
+            if verbose:
+                print(f"{name:<50} skipped ({e})")
+            continue
+        timings = time_fn(fn, repeats, min_time)
+        results[name] = {**timings, "items": num_items, "unit": unit, "items_per_s": num_items / timings["median_s"]}
+        if verbose:
+            print(f"{name:<50} {timings['median_s'] * 1e3:10.3f} ms {num_items / timings['median_s']:12.1f} {unit}/s")
+    return results
+
+
+def environment_info() -> Dict[str, Any]:
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "torch": torch.__version__,
+        "num_threads": torch.get_num_threads(),
+    }
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Any], threshold: float = 0.1) -> List[Dict[str, Any]]:
+    """Compares the median times of two benchmark runs
+
+    Parameters
+    ----------
+    baseline: Dict[str, Any]
+        The results of a previous run, as returned by `run_benchmarks`.
+    results: Dict[str, Any]
+        The results to compare to the baseline.
+    threshold: float
+        The relative slowdown above which a benchmark is flagged as a regression (and, conversely,
+        the speedup above which it is flagged as an improvement).
+
+    Returns
+    -------
+    rows: List[Dict[str, Any]]
+        For each benchmark present in both runs, its name, both median times, the ratio of the new
+        time to the baseline's, and a status, one of "regression", "improvement", "ok" or "skipped".
+    """
+    rows = []
+    for name, new in results["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        if "skipped" in old or "skipped" in new:
+            rows.append({"name": name, "baseline_s": None, "new_s": None, "ratio": None, "status": "skipped"})
+            continue
+        ratio = new["median_s"] / old["median_s"]
+        status = "regression" if ratio > 1 + threshold else "improvement" if ratio < 1 / (1 + threshold) else "ok"
+        rows.append(
+            {"name": name, "baseline_s": old["median_s"], "new_s": new["median_s"], "ratio": ratio, "status": status}
+        )
+    return rows
+
+
+def format_comparison(rows: List[Dict[str, Any]]) -> str:
+    lines = [f"{'benchmark':<50} {'baseline ms':>12} {'new ms':>12} {'ratio':>8}  status"]
+    for r in rows:
+        if r["status"] == "skipped":
+            lines.append(f"{r['name']:<50} {'':>12} {'':>12} {'':>8}  skipped")
+            continue
+        lines.append(
+            f"{r['name']:<50} {r['baseline_s'] * 1e3:12.3f} {r['new_s'] * 1e3:12.3f} {r['ratio']:8.3f}  {r['status']}"
+        )
+    return "\n".join(lines)
+
+
+def save_results(results: Dict[str, Any], path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(path: str) -> Dict[str, Any]:
+    with open(path, "r") as f:
+        return json.load(f)
@@ -0,0 +1,287 @@
+"""Micro-benchmarks of the environments, contexts, sampling, TB losses, the sEH proxy and metrics.
+
+All inputs are synthetic: graphs and trajectories are sampled from randomly initialized models, and
+the sEH proxy has random weights, so no data or network access is needed.
+"""
+
+import copy
+import functools
+
+import numpy as np
+import torch
+
+from gflownet.algo.trajectory_balance import TrajectoryBalance
+from gflownet.benchmarks.core import benchmark
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphActionType, GraphBuildingEnv
+from gflownet.envs.mol_building_env import MolBuildingEnvContext
+from gflownet.models.graph_transformer import GraphTransformerGFN
+
+SEED = 142857
+NUM_COND_DIM = 32
+# The number of trajectories sampled for the benchmarks that need data
+NUM_TRAJS = 64
+TB_HPS = {"illegal_action_logreward": -75, "bootstrap_own_reward": False, "tb_epsilon": None}
+CONTEXTS = ["mol", "frag"]
+
+
+@functools.lru_cache()
+def _setup(kind: str, subtb: bool = False):
+    """Returns the (ctx, env, algo, model) of an sEH-like (frag) or QM9-like (mol) setup"""
+    if kind == "frag":
+        ctx = FragMolBuildingEnvContext(max_frags=9, num_cond_dim=NUM_COND_DIM)
+    else:
+        ctx = MolBuildingEnvContext(["C", "N", "O", "F"], num_cond_dim=NUM_COND_DIM)
+    env = GraphBuildingEnv()
+    algo = TrajectoryBalance(env, ctx, np.random.default_rng(SEED), TB_HPS, max_nodes=9)
+    if subtb:
+        # TrajectoryBalance precomputes the SubTB indices on CUDA, we want them on CPU
+        algo.is_doing_subTB = True
+        algo._subtb_max_len = 128
+        algo._init_subtb(torch.device("cpu"))
+    torch.manual_seed(SEED)
+    model = GraphTransformerGFN(ctx, num_emb=64, num_layers=3)
+    return ctx, env, algo, model
+
+
+def _cond_info(n: int):
+    return torch.rand((n, NUM_COND_DIM), generator=torch.Generator().manual_seed(SEED))
+
+
+@functools.lru_cache()
+def _trajectories(kind: str):
+    """Trajectories sampled from a random model, along with their replayed states and actions"""
+    ctx, env, algo, model = _setup(kind)
+    torch.manual_seed(SEED)
+    algo.rng = algo.graph_sampler.rng = np.random.default_rng(SEED)
+    with torch.no_grad():
+        trajs = algo.create_training_data_from_own_samples(model, NUM_TRAJS, _cond_info(NUM_TRAJS), 0.0)
+    graphs, torch_graphs, actions, _ = trajs.replay(env, ctx)
+    return trajs, graphs, torch_graphs, actions
+
+
+def _training_batch(kind: str, subtb: bool = False):
+    ctx, env, algo, model = _setup(kind, subtb)
+    trajs = _trajectories(kind)[0]
+    log_rewards = torch.rand((len(trajs),), generator=torch.Generator().manual_seed(SEED)).log()
+    batch = algo.construct_batch(trajs, _cond_info(len(trajs)), log_rewards)
+    batch.num_offline, batch.num_online = 0, len(trajs)
+    return batch
+
+
+def _fwd_cat(kind: str):
+    ctx, env, algo, model = _setup(kind)
+    torch_graphs = _trajectories(kind)[2]
+    with torch.no_grad():
+        fwd_cat, *_ = model(ctx.collate(torch_graphs), _cond_info(len(torch_graphs)))
+    return fwd_cat, len(torch_graphs)
+
+
+def _register_context_benchmarks(kind: str):
+    @benchmark(f"env/step/{kind}", unit="step")
+    def env_step():
+        env = _setup(kind)[1]
+        graphs, actions = _trajectories(kind)[1], _trajectories(kind)[3]
+        pairs = [(g, a) for g, a in zip(graphs, actions) if a.action is not GraphActionType.Stop]
+
+        def f():
+            for g, a in pairs:
+                env.step(g, a)
+
+        return f, len(pairs)
+
+    @benchmark(f"env/parents/{kind}", unit="graph")
+    def env_parents():
+        env = _setup(kind)[1]
+        graphs = [g for g in _trajectories(kind)[1] if len(g)]
+        return (lambda: [env.parents(g) for g in graphs]), len(graphs)
+
+    @benchmark(f"env/count_backward_transitions/{kind}", unit="graph")
+    def env_count_backward_transitions():
+        env = _setup(kind)[1]
+        graphs = [g for g in _trajectories(kind)[1] if len(g)]
+        return (lambda: [env.count_backward_transitions(g) for g in graphs]), len(graphs)
+
+    @benchmark(f"ctx/graph_to_Data/{kind}", unit="graph")
+    def ctx_graph_to_Data():
+        ctx = _setup(kind)[0]
+        graphs = _trajectories(kind)[1]
+        return (lambda: [ctx.graph_to_Data(g) for g in graphs]), len(graphs)
+
+    @benchmark(f"ctx/collate/{kind}", unit="graph")
+    def ctx_collate():
+        ctx = _setup(kind)[0]
+        torch_graphs = _trajectories(kind)[2]
+        return (lambda: ctx.collate(torch_graphs)), len(torch_graphs)
+
+    @benchmark(f"cat/sample/{kind}", unit="graph")
+    def cat_sample():
+        fwd_cat, n = _fwd_cat(kind)
+        return fwd_cat.sample, n
+
+    @benchmark(f"cat/log_prob/{kind}", unit="graph")
+    def cat_log_prob():
+        fwd_cat, n = _fwd_cat(kind)
+        actions = fwd_cat.sample()
+
+        def f():
+            fwd_cat.logprobs = None  # Don't use the cached log-softmax
+            return fwd_cat.log_prob(actions)
+
+        return f, n
+
+    @benchmark(f"cat/logsoftmax/{kind}", unit="graph")
+    def cat_logsoftmax():
+        fwd_cat, n = _fwd_cat(kind)
+
+        def f():
+            fwd_cat.logprobs = None
+            return fwd_cat.logsoftmax()
+
+        return f, n
+
+
+for _kind in CONTEXTS:
+    _register_context_benchmarks(_kind)
+
+
+@benchmark("sampler/sample_from_model/frag", unit="traj")
+def sample_from_model():
+    ctx, env, algo, model = _setup("frag")
+    cond_info = _cond_info(NUM_TRAJS)
+
+    def f():
+        with torch.no_grad():
+            return algo.graph_sampler.sample_from_model(model, NUM_TRAJS, cond_info, torch.device("cpu"))
+
+    return f, NUM_TRAJS
+
+
+@benchmark("tb/construct_batch/frag", unit="traj")
+def tb_construct_batch():
+    ctx, env, algo, model = _setup("frag")
+    trajs = _trajectories("frag")[0]
+    cond_info, log_rewards = _cond_info(len(trajs)), torch.zeros((len(trajs),))
+    return (lambda: algo.construct_batch(trajs, cond_info, log_rewards)), len(trajs)
+
+
+def _compute_batch_losses(subtb: bool):
+    ctx, env, algo, model = _setup("frag", subtb)
+    batch = _training_batch("frag", subtb)
+
+    def f():
+        loss, _ = algo.compute_batch_losses(model, batch)
+        loss.backward()
+
+    return f, batch.traj_lens.shape[0]
+
+
+@benchmark("tb/compute_batch_losses/frag", unit="traj")
+def tb_compute_batch_losses():
+    return _compute_batch_losses(False)
+
+
+@benchmark("tb/compute_batch_losses_subtb/frag", unit="traj")
+def tb_compute_batch_losses_subtb():
+    return _compute_batch_losses(True)
+
+
+def _seh_inputs():
+    from gflownet.models import bengio2021flow
+
+    ctx = _setup("frag")[0]
+    trajs = _trajectories("frag")[0]
+    mols = [ctx.graph_to_mol(g) for g, v in zip(trajs.results, trajs.is_valid) if v]
+    torch.manual_seed(SEED)
+    # The same architecture as bengio2021flow.load_original_model, but with random weights
+    model = bengio2021flow.MPNNet(
+        num_feat=14 + 1 + bengio2021flow.NUM_ATOMIC_NUMBERS, num_vec=0, dim=64, num_out_per_mol=1, num_conv_steps=12
+    )
+    model.eval()
+    return bengio2021flow, mols, model
+
+
+@benchmark("train/optimizer_step/frag", unit="step")
+def train_optimizer_step():
+    """Gradient clipping, the Adam step and the EMA update of SEHFragTrainer.step (without the backward pass)"""
+    from gflownet.train import FusedOptimizerStep
+
+    ctx, env, algo, model = _setup("frag")
+    model = copy.deepcopy(model)
+    hps = {
+        "learning_rate": 1e-4,
+        "Z_learning_rate": 1e-4,
+        "momentum": 0.9,
+        "weight_decay": 1e-8,
+        "adam_eps": 1e-8,
+        "lr_decay": 20000,
+        "Z_lr_decay": 20000,
+        "clip_grad_type": "norm",
+        "clip_grad_param": 10,
+        "sampling_tau": 0.99,
+    }
+    step = FusedOptimizerStep(model, hps, copy.deepcopy(model))
+    grads = [torch.randn(p.shape, generator=torch.Generator().manual_seed(SEED)) for p in model.parameters()]
+
+    def f():
+        for p, g in zip(model.parameters(), grads):
+            p.grad = g.clone()
+        step(torch.zeros(()).requires_grad_())
+
+    return f, 1
+
+
+@benchmark("seh/featurize/frag", unit="mol")
+def seh_featurize():
+    bengio2021flow, mols, model = _seh_inputs()
+    return (lambda: [bengio2021flow.mol2graph(m) for m in mols]), len(mols)
+
+
+@benchmark("seh/forward/frag", unit="mol")
+def seh_forward():
+    bengio2021flow, mols, model = _seh_inputs()
+    batch = bengio2021flow.mols2batch([bengio2021flow.mol2graph(m) for m in mols])
+
+    def f():
+        with torch.no_grad():
+            return model(batch)
+
+    return f, len(mols)
+
+
+@benchmark("seh/forward_quantized/frag", unit="mol")
+def seh_forward_quantized():
+    """The int8 dynamically quantized proxy, see gflownet.benchmarks.quantization for its accuracy"""
+    from gflownet.utils.compile import compile_for_inference
+
+    bengio2021flow, mols, model = _seh_inputs()
+    batch = bengio2021flow.mols2batch([bengio2021flow.mol2graph(m) for m in mols])
+    model = compile_for_inference(model, "quantize")
+    return (lambda: model(batch)), len(mols)
+
+
+@benchmark("seh/featurize_forward/frag", unit="mol")
+def seh_featurize_forward():
+    bengio2021flow, mols, model = _seh_inputs()
+
+    def f():
+        with torch.no_grad():
+            return model(bengio2021flow.mols2batch([bengio2021flow.mol2graph(m) for m in mols]))
+
+    return f, len(mols)
+
+
+@benchmark("metrics/is_pareto_efficient", unit="point")
+def metrics_is_pareto_efficient():
+    from gflownet.utils import metrics
+
+    costs = np.random.default_rng(SEED).uniform(size=(1000, 2))
+    return (lambda: metrics.is_pareto_efficient(costs)), len(costs)
+
+
+@benchmark("metrics/hypervolume", unit="point")
+def metrics_hypervolume():
+    from gflownet.utils import metrics
+
+    flat_rewards = torch.tensor(np.random.default_rng(SEED).uniform(size=(256, 3)))
+    return (lambda: metrics.get_hypervolume(flat_rewards)), len(flat_rewards)
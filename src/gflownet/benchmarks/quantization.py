@@ -0,0 +1,213 @@
+"""Accuracy and speed of the int8 dynamically quantized inference modules (see gflownet.utils.compile) relative
+to fp32, on CPU:
+
+- for the sEH proxy (bengio2021flow.MPNNet), the error of the rewards of held-out molecules,
+- for the sampling model (GraphTransformerGFN), the divergence of the action distributions on the states of
+  held-out trajectories.
+
+The held-out trajectories (and their molecules) are sampled from the sampling model, which is randomly
+initialized unless a checkpoint of SEHFragTrainer is given. The proxy has random weights unless `pretrained`
+is set, which downloads the original weights.
+"""
+
+import functools
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import scipy.stats as stats
+import torch
+import torch.nn as nn
+import torch_geometric.data as gd
+from rdkit import RDLogger
+from torch import Tensor
+from torch_scatter import scatter
+
+from gflownet.algo.graph_sampling import GraphSampler
+from gflownet.benchmarks.core import environment_info, time_fn
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphActionCategorical, GraphBuildingEnv
+from gflownet.models import bengio2021flow
+from gflownet.models.graph_transformer import GraphTransformerGFN
+from gflownet.utils.compile import QUANTIZE_MODE, compile_for_inference
+from gflownet.utils.transforms import thermometer
+
+SEED = 142857
+# The SEHFragTrainer hyperparameters that the report depends on, overridden by those of a checkpoint
+DEFAULT_HPS = {
+    "num_emb": 128,
+    "num_layers": 4,
+    "max_nodes": 9,
+    "num_thermometer_dim": 32,
+    "temperature_dist_params": (0.5, 32.0),
+    "self_loop_attr": "mean",
+}
+
+
+def distribution_errors(ref: GraphActionCategorical, cat: GraphActionCategorical) -> Dict[str, Tensor]:
+    """Per-graph divergences of the action distribution `cat` from `ref`
+
+    Returns
+    -------
+    errors: Dict[str, Tensor]
+        The KL divergence KL(ref || cat) ("kl"), the total variation distance ("tv"), and whether the most
+        likely actions are the same ("argmax_agreement"), each of shape (num_graphs,).
+    """
+    ref_lp, lp = ref.logsoftmax(), cat.logsoftmax()
+
+    def per_graph(xs):
+        return sum(scatter(x, b, dim=0, dim_size=ref.num_graphs, reduce="sum").sum(1) for x, b in zip(xs, ref.batch))
+
+    kl = per_graph([i.exp() * (i - j) for i, j in zip(ref_lp, lp)])
+    tv = per_graph([(i.exp() - j.exp()).abs() for i, j in zip(ref_lp, lp)]) / 2
+    agreement = [a == b for a, b in zip(ref.argmax(ref.logits), cat.argmax(cat.logits))]
+    return {"kl": kl, "tv": tv, "argmax_agreement": torch.tensor(agreement, dtype=torch.float)}
+
+
+def _summary(x: Tensor, prefix: str) -> Dict[str, float]:
+    return {f"{prefix}_mean": x.mean().item(), f"{prefix}_max": x.max().item()}
+
+
+def _speed(fp32_fn, quantized_fn, n: int, repeats: int, min_time: float) -> Dict[str, float]:
+    fp32, quantized = time_fn(fp32_fn, repeats, min_time)["min_s"], time_fn(quantized_fn, repeats, min_time)["min_s"]
+    return {"fp32_items_per_s": n / fp32, "quantized_items_per_s": n / quantized, "speedup": fp32 / quantized}
+
+
+def proxy_report(
+    model: nn.Module, mols: List[Any], batch_size: int = 64, repeats: int = 5, min_time: float = 0.2
+) -> Dict[str, float]:
+    """Compares the sEH proxy outputs of its fp32 and quantized versions on `mols` (RDKit molecules), and
+    measures their throughput in molecules per second, on batches of `batch_size` molecules"""
+    quantized = compile_for_inference(model, QUANTIZE_MODE)
+    batches = [
+        bengio2021flow.mols2batch([bengio2021flow.mol2graph(m) for m in mols[i : i + batch_size]])
+        for i in range(0, len(mols), batch_size)
+    ]
+    with torch.no_grad():
+        ref = torch.cat([model(b).reshape(-1) for b in batches])
+        out = torch.cat([quantized(b).reshape(-1) for b in batches])
+    err = (out - ref).abs()
+    return {
+        "num_mols": len(mols),
+        **_summary(err, "abs_err"),
+        # The error relative to the spread of the rewards
+        "rel_mae": (err.mean() / ref.std()).item(),
+        "pearson": float(stats.pearsonr(ref.numpy(), out.numpy())[0]),
+        "spearman": float(stats.spearmanr(ref.numpy(), out.numpy())[0]),
+        **_speed(lambda: model(batches[0]), lambda: quantized(batches[0]), batches[0].num_graphs, repeats, min_time),
+    }
+
+
+def policy_report(
+    model: GraphTransformerGFN,
+    ctx: FragMolBuildingEnvContext,
+    torch_graphs: List[gd.Data],
+    cond_info: Tensor,
+    batch_size: int = 256,
+    repeats: int = 5,
+    min_time: float = 0.2,
+) -> Dict[str, float]:
+    """Compares the action distributions of the fp32 sampling model and of its quantized inference module on
+    the states `torch_graphs` (with conditional information `cond_info`), and measures their throughput in
+    states per second, on batches of `batch_size` states"""
+    quantized = compile_for_inference(model, QUANTIZE_MODE)
+    errors: Dict[str, List[Tensor]] = {}
+    batches = []
+    for i in range(0, len(torch_graphs), batch_size):
+        batch, cond = ctx.collate(torch_graphs[i : i + batch_size]), cond_info[i : i + batch_size]
+        batches.append((batch, cond))
+        with torch.no_grad():
+            (ref_cat, ref_out), (cat, out) = model(batch, cond), quantized(batch, cond)
+        for k, v in distribution_errors(ref_cat, cat).items():
+            errors.setdefault(k, []).append(v)
+        errors.setdefault("graph_out_abs_err", []).append((out - ref_out).abs().reshape(-1))
+    errors = {k: torch.cat(v) for k, v in errors.items()}
+    batch, cond = batches[0]
+
+    def fp32():
+        with torch.no_grad():
+            return model(batch, cond)
+
+    return {
+        "num_states": len(torch_graphs),
+        **_summary(errors["kl"], "kl"),
+        **_summary(errors["tv"], "tv"),
+        "argmax_agreement": errors["argmax_agreement"].mean().item(),
+        **_summary(errors["graph_out_abs_err"], "graph_out_abs_err"),
+        **_speed(fp32, lambda: quantized(batch, cond), batch.num_graphs, repeats, min_time),
+    }
+
+
+@functools.lru_cache()
+def _sampling_setup(checkpoint: Optional[str]):
+    hps = dict(DEFAULT_HPS)
+    state = None
+    if checkpoint is not None:
+        state = torch.load(checkpoint, map_location="cpu")
+        hps.update({k: v for k, v in state["hps"].items() if k in DEFAULT_HPS})
+    ctx = FragMolBuildingEnvContext(max_frags=hps["max_nodes"], num_cond_dim=hps["num_thermometer_dim"])
+    torch.manual_seed(SEED)
+    model = GraphTransformerGFN(
+        ctx, num_emb=hps["num_emb"], num_layers=hps["num_layers"], self_loop_attr=hps["self_loop_attr"]
+    )
+    if state is not None:
+        model.load_state_dict(state["models_state_dict"][0])
+    model.eval()
+    return hps, ctx, model
+
+
+def held_out_trajectories(checkpoint: Optional[str], num_trajs: int):
+    """Samples `num_trajs` trajectories from the (fp32) sampling model, with uniformly distributed
+    temperatures, and returns the molecules, the states of every step and their conditional information"""
+    hps, ctx, model = _sampling_setup(checkpoint)
+    env = GraphBuildingEnv()
+    rng = np.random.default_rng(SEED)
+    sampler = GraphSampler(ctx, env, 128, hps["max_nodes"], rng)
+    beta = torch.tensor(rng.uniform(*hps["temperature_dist_params"], num_trajs), dtype=torch.float)
+    cond_info = thermometer(beta, hps["num_thermometer_dim"], 0, hps["temperature_dist_params"][1])
+    with torch.no_grad():
+        trajs = sampler.sample_from_model(model, num_trajs, cond_info, torch.device("cpu"))
+    graphs, torch_graphs, actions, _ = trajs.replay(env, ctx)
+    mols = []
+    for g, valid in zip(trajs.results, trajs.is_valid):
+        mol = ctx.graph_to_mol(g) if valid else None
+        if mol is not None and mol.GetNumAtoms() > 0:
+            mols.append(mol)
+    return mols, torch_graphs, cond_info.repeat_interleave(trajs.traj_lens, 0)
+
+
+def run(
+    num_trajs: int = 256,
+    checkpoint: Optional[str] = None,
+    pretrained: bool = False,
+    num_threads: int = 1,
+    repeats: int = 5,
+    min_time: float = 0.2,
+) -> Dict[str, Any]:
+    """Returns the accuracy and speed reports of the quantized sEH proxy and sampling model, see the module
+    docstring"""
+    RDLogger.DisableLog("rdApp.*")
+    torch.set_num_threads(num_threads)
+    mols, torch_graphs, cond_info = held_out_trajectories(checkpoint, num_trajs)
+    hps, ctx, model = _sampling_setup(checkpoint)
+    if pretrained:
+        proxy = bengio2021flow.load_original_model()
+    else:
+        torch.manual_seed(SEED)
+        # The same architecture as bengio2021flow.load_original_model, but with random weights
+        proxy = bengio2021flow.MPNNet(
+            num_feat=14 + 1 + bengio2021flow.NUM_ATOMIC_NUMBERS, num_vec=0, dim=64, num_out_per_mol=1, num_conv_steps=12
+        )
+    proxy.eval()
+    return {
+        "meta": {**environment_info(), "checkpoint": checkpoint, "pretrained_proxy": pretrained},
+        "proxy": proxy_report(proxy, mols, repeats=repeats, min_time=min_time),
+        "policy": policy_report(model, ctx, torch_graphs, cond_info, repeats=repeats, min_time=min_time),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    lines = []
+    for key in ["proxy", "policy"]:
+        lines.append(f"{key}:")
+        lines += [f"  {k:<24} {v:.4g}" for k, v in report[key].items()]
+    return "\n".join(lines)
@@ -0,0 +1,279 @@
+"""End-to-end training throughput of the sEH fragment trainers.
+
+Each configuration (task, number of DataLoader workers, batch size, message pickling, offline ratio)
+is run in a fresh process: a trainer is set up with a deterministic stand-in for the sEH proxy (so
+no network access or GPU is needed), and `num_steps` training steps are timed after `warmup_steps`.
+"""
+
+import glob
+import itertools
+import multiprocessing
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch_geometric.data as gd
+from rdkit import Chem
+from torch_geometric.nn import global_mean_pool
+
+from gflownet.models import bengio2021flow
+from gflownet.tasks.seh_frag import SEHFragTrainer, SEHTask
+from gflownet.tasks.seh_frag_moo import SEHMOOFragTrainer, SEHMOOTask
+from gflownet.utils.multiprocessing_proxy import num_bytes
+
+
+class StubSEHProxy(nn.Module):
+    """A deterministic stand-in for the sEH proxy of `bengio2021flow.load_original_model`.
+
+    It takes the same inputs (batches of `bengio2021flow.mol2graph` graphs) and outputs one value in
+    [0, 8] per molecule, a fixed (seeded) random readout of the mean atom features.
+    """
+
+    def __init__(self, seed: int = 142857):
+        super().__init__()
+        num_feat = 14 + 1 + bengio2021flow.NUM_ATOMIC_NUMBERS
+        self.lin = nn.Linear(num_feat, 1)
+        g = torch.Generator().manual_seed(seed)
+        self.lin.weight.data = torch.randn((1, num_feat), generator=g)
+        self.lin.bias.data = torch.zeros((1,))
+        self.requires_grad_(False)
+
+    def forward(self, data: gd.Batch):
+        return torch.sigmoid(global_mean_pool(self.lin(data.x), data.batch)) * 8
+
+
+class StubSEHTask(SEHTask):
+    def _load_task_models(self):
+        model, self.device = self._wrap_model(StubSEHProxy())
+        return {"seh": model}
+
+
+class StubSEHMOOTask(SEHMOOTask):
+    def _load_task_models(self):
+        model, self.device = self._wrap_model(StubSEHProxy())
+        return {"seh": model}
+
+
+class ThroughputTrainerMixin:
+    """Records the MPModelProxy instances of a trainer, so that their traffic can be measured"""
+
+    def _make_mp_proxy(self, model, **kwargs):
+        proxy = super()._make_mp_proxy(model, count_bytes=True, **kwargs)
+        if not hasattr(self, "mp_proxies"):
+            self.mp_proxies = []
+        self.mp_proxies.append(proxy)
+        return proxy
+
+
+class StubSEHFragTrainer(ThroughputTrainerMixin, SEHFragTrainer):
+    def setup_task(self):
+        self.task = StubSEHTask(
+            dataset=self.training_data,
+            temperature_distribution=self.hps["temperature_sample_dist"],
+            temperature_parameters=self.hps["temperature_dist_params"],
+            num_thermometer_dim=self.hps["num_thermometer_dim"],
+            wrap_model=self._wrap_model_mp,
+        )
+
+
+class StubSEHMOOFragTrainer(ThroughputTrainerMixin, SEHMOOFragTrainer):
+    def setup_task(self):
+        self.task = StubSEHMOOTask(
+            objectives=self.hps["objectives"],
+            dataset=self.training_data,
+            temperature_sample_dist=self.hps["temperature_sample_dist"],
+            temperature_parameters=self.hps["temperature_dist_params"],
+            num_thermometer_dim=self.hps["num_thermometer_dim"],
+            wrap_model=self._wrap_model_mp,
+            use_pref_thermometer=self.hps["use_pref_thermometer"],
+        )
+
+
+TRAINERS = {"seh_frag": StubSEHFragTrainer, "seh_frag_moo": StubSEHMOOFragTrainer}
+
+
+def _synthetic_offline_data(trainer, n: int, seed: int = 142857):
+    """Molecules sampled from the (untrained) model, with random flat rewards"""
+    n_obj = len(trainer.hps.get("objectives", ["seh"]))
+    rng = np.random.default_rng(seed)
+    trainer.task.rng = np.random.default_rng(seed)
+    cond_info = trainer.task.sample_conditional_information(n)["encoding"]
+    with torch.no_grad():
+        trajs = trainer.algo.create_training_data_from_own_samples(trainer.sampling_model, n, cond_info, 0.0)
+    graphs = [g for g, v in zip(trajs.results, trajs.is_valid) if v and len(g)]
+    return [(g, torch.tensor(rng.uniform(size=n_obj), dtype=torch.float32)) for g in graphs]
+
+
+def _peak_rss_mb(pid) -> Optional[float]:
+    """The peak resident set size of a process, in MB (Linux only, None elsewhere)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _child_pids() -> List[int]:
+    pids = []
+    for path in glob.glob("/proc/self/task/*/children"):
+        with open(path) as f:
+            pids += [int(i) for i in f.read().split()]
+    return pids
+
+
+def _count_unique_mols(mols: List[Any]) -> int:
+    """The number of distinct molecules among the RDKit molecules of `mols` (offline batches carry graphs)"""
+    return len(set(Chem.MolToSmiles(m) for m in mols if isinstance(m, Chem.Mol)))
+
+
+def measure(
+    task: str,
+    num_workers: int,
+    batch_size: int,
+    pickle_messages: bool,
+    offline_ratio: float,
+    num_steps: int = 20,
+    warmup_steps: int = 3,
+    extra_hps: Optional[Dict[str, Any]] = None,
+    device: str = "cpu",
+) -> Dict[str, Any]:
+    """Runs `warmup_steps + num_steps` training steps of a task and measures its throughput
+
+    Returns
+    -------
+    results: Dict[str, Any]
+        The configuration, and
+        - steps_per_s, trajs_per_s: measured over the last `num_steps` steps;
+        - unique_mols, unique_mols_per_s: the number of distinct molecules sampled (on-policy) in the
+          batches of the last `num_steps` steps, and per second. These are None with the `pack_batches`
+          hp, since packed batches don't carry their molecules;
+        - peak_rss_mb_main, peak_rss_mb_workers: the peak RSS of the main process and of each
+          worker process (Linux only);
+        - ipc_bytes_per_step: the size of the batches received from the workers and of the messages
+          exchanged with the model proxies (see `num_bytes`), per step.
+    """
+    log_dir = tempfile.mkdtemp(prefix="gflownet_throughput_")
+    hps = {
+        "log_dir": log_dir,
+        "num_training_steps": warmup_steps + num_steps,
+        "num_data_loader_workers": num_workers,
+        "global_batch_size": batch_size,
+        "mp_pickle_messages": pickle_messages,
+        "offline_ratio": offline_ratio,
+        "validate_every": 0,
+        "algo": "TB",
+        **(extra_hps or {}),
+    }
+    dev = torch.device(device)
+    trainer = TRAINERS[task](hps, dev)
+    trainer.model.to(dev)
+    trainer.sampling_model.to(dev)
+    if offline_ratio > 0:
+        trainer.training_data = trainer.task.dataset = _synthetic_offline_data(trainer, 4 * batch_size)
+    it = iter(trainer.build_training_data_loader())
+    for i in range(warmup_steps):
+        trainer.train_batch(next(it).to(dev), 0, i)
+    proxies = getattr(trainer, "mp_proxies", [])
+    proxy_bytes = sum(p.num_bytes_received + p.num_bytes_sent for p in proxies)
+    batch_bytes = 0
+    mols: List[Any] = []
+    t0 = time.time()
+    for i in range(num_steps):
+        batch = next(it)
+        if num_workers > 0:
+            batch_bytes += num_bytes(batch)
+        mols += getattr(batch, "mols", [])
+        trainer.train_batch(batch.to(dev), 0, warmup_steps + i)
+    elapsed = time.time() - t0
+    proxy_bytes = sum(p.num_bytes_received + p.num_bytes_sent for p in proxies) - proxy_bytes
+    workers_rss = [_peak_rss_mb(pid) for pid in _child_pids()]
+    del it  # Shuts the workers down
+    unique_mols = None if trainer.pack_batches else _count_unique_mols(mols)
+    return {
+        "task": task,
+        "num_workers": num_workers,
+        "batch_size": batch_size,
+        "pickle_messages": pickle_messages,
+        "offline_ratio": offline_ratio,
+        "num_steps": num_steps,
+        "steps_per_s": num_steps / elapsed,
+        "trajs_per_s": num_steps * batch_size / elapsed,
+        "unique_mols": unique_mols,
+        "unique_mols_per_s": unique_mols / elapsed if unique_mols is not None else None,
+        "peak_rss_mb_main": _peak_rss_mb("self"),
+        "peak_rss_mb_workers": [i for i in workers_rss if i is not None],
+        "ipc_bytes_per_step": (batch_bytes + proxy_bytes) / num_steps,
+    }
+
+
+def _measure_in_subprocess(kwargs, queue):
+    try:
+        queue.put(measure(**kwargs))
+    except Exception as e:
+        queue.put({**kwargs, "error": repr(e)})
+
+
+def sweep(
+    tasks: List[str],
+    num_workers: List[int],
+    batch_sizes: List[int],
+    pickle_messages: List[bool],
+    offline_ratios: List[float],
+    verbose=True,
+    **kwargs,
+) -> List[Dict[str, Any]]:
+    """Measures every combination of the given settings, each in a fresh process, see `measure`"""
+    # Forked, and not spawned, since the DataLoader workers of the trainer must be forked
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for task, nw, bs, pm, ratio in itertools.product(tasks, num_workers, batch_sizes, pickle_messages, offline_ratios):
+        config = dict(task=task, num_workers=nw, batch_size=bs, pickle_messages=pm, offline_ratio=ratio, **kwargs)
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_measure_in_subprocess, args=(config, queue))
+        proc.start()
+        results.append(queue.get())
+        proc.join()
+        if verbose:
+            print(format_table(results[-1:], header=len(results) == 1))
+    return results
+
+
+# (key, header, width, format spec) of the columns of the table
+_COLUMNS = [
+    ("task", "task", 14, ""),
+    ("num_workers", "workers", 7, ""),
+    ("batch_size", "batch", 6, ""),
+    ("pickle_messages", "pickle", 6, ""),
+    ("offline_ratio", "offline", 7, ".2f"),
+    ("steps_per_s", "steps/s", 8, ".3f"),
+    ("trajs_per_s", "trajs/s", 8, ".1f"),
+    ("unique_mols_per_s", "mols/s", 8, ".1f"),
+    ("peak_rss_mb_main", "rss MB", 8, ".0f"),
+    ("peak_rss_mb_workers", "wkr MB", 8, ".0f"),
+    ("ipc_bytes_per_step", "IPC B/step", 12, ".0f"),
+]
+
+
+def format_table(results: List[Dict[str, Any]], header=True) -> str:
+    """Formats results as a table, the worker RSS column is the max over workers"""
+    lines = [" ".join(f"{h:>{w}}" for _, h, w, _ in _COLUMNS)] if header else []
+    for r in results:
+        if "error" in r:
+            lines.append(f"{r['task']:>14} {r['num_workers']:>7} {r['batch_size']:>6}  error: {r['error']}")
+            continue
+        values = {**r, "pickle_messages": str(r["pickle_messages"])}
+        values["peak_rss_mb_main"] = r["peak_rss_mb_main"] or 0
+        values["peak_rss_mb_workers"] = max(r["peak_rss_mb_workers"], default=0)
+        # Unmeasured values (None) are shown as "-"
+        lines.append(
+            " ".join(
+                f"{values[k]:>{w}{spec}}" if values[k] is not None else f"{'-':>{w}}" for k, _, w, spec in _COLUMNS
+            )
+        )
+    return "\n".join(lines)
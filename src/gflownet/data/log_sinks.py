@@ -0,0 +1,156 @@
+import glob
+import multiprocessing.util
+import os
+import queue
+import threading
+from typing import Dict, List, Union
+
+import numpy as np
+
+# A column is either a list of strings (e.g. SMILES) or a 1d numeric array
+Column = Union[List[str], np.ndarray]
+
+
+class LogSink:
+    """The interface of the logs SamplingIterator writes generated objects to.
+
+    Logged data comes in as columns, e.g. `{"smi": [...], "r": np.array([...]), ...}`, all of the
+    same length, and always with the same keys for a given sink."""
+
+    # Extension of the files (or file prefix, for sinks writing multiple files) passed to `connect`
+    file_extension = ""
+
+    def connect(self, path: str):
+        """Opens the log at `path`, appending to it if it exists"""
+        raise NotImplementedError()
+
+    def insert_columns(self, columns: Dict[str, Column]):
+        """Logs a number of rows, given as columns"""
+        raise NotImplementedError()
+
+    def close(self):
+        """Writes all pending data and closes the log"""
+        raise NotImplementedError()
+
+
+class ParquetLog(LogSink):
+    file_extension = ".parquet"
+
+    def __init__(self, row_group_size=4096, max_file_size=256 * 2**20, max_queued=16):
+        """A log writing Parquet files. Columns are accumulated in memory (as numpy arrays, without
+        going through Python rows) until `row_group_size` rows are available, at which point they
+        are written as a row group by a background thread. Once a file exceeds `max_file_size`
+        bytes, a new file is started.
+
+        Connecting to `dir/name.parquet` writes the files `dir/name_00000.parquet`,
+        `dir/name_00001.parquet`, etc.; see `read_parquet_logs` to read them.
+
+        Parameters
+        ----------
+        row_group_size: int
+            The number of rows in each row group.
+        max_file_size: int
+            The size (in bytes) after which a new file is started.
+        max_queued: int
+            The maximum number of row groups waiting to be written, after which logging blocks.
+        """
+        self.row_group_size = row_group_size
+        self.max_file_size = max_file_size
+        self.max_queued = max_queued
+        self.is_connected = False
+        self._error = None
+
+    def connect(self, path: str):
+        if self.is_connected:
+            self.close()
+        self._prefix = path[: -len(self.file_extension)] if path.endswith(self.file_extension) else path
+        # Never overwrite the files of a previous connection
+        self._part = len(glob.glob(f"{glob.escape(self._prefix)}_*{self.file_extension}"))
+        self._buffers: Dict[str, List[Column]] = {}
+        self._num_buffered = 0
+        self._queue: queue.Queue = queue.Queue(maxsize=self.max_queued)
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+        # Flush when the process exits, including DataLoader workers, which don't run atexit hooks
+        self._finalizer = multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+        self.is_connected = True
+
+    def insert_columns(self, columns: Dict[str, Column]):
+        if self._error is not None:
+            raise self._error
+        for k, v in columns.items():
+            self._buffers.setdefault(k, []).append(v)
+        self._num_buffered += len(next(iter(columns.values())))
+        if self._num_buffered >= self.row_group_size:
+            self._flush_buffers()
+
+    def _flush_buffers(self):
+        if self._num_buffered == 0:
+            return
+        columns = {
+            k: sum(v, []) if isinstance(v[0], list) else np.concatenate(v).reshape(-1) for k, v in self._buffers.items()
+        }
+        self._buffers = {}
+        self._num_buffered = 0
+        self._queue.put(columns)
+
+    def _writer_loop(self):
+        writer = None
+        path = None
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            while True:
+                columns = self._queue.get()
+                if columns is None:
+                    break
+                table = pa.table({k: pa.array(v) for k, v in columns.items()})
+                if writer is None:
+                    path = f"{self._prefix}_{self._part:05d}{self.file_extension}"
+                    writer = pq.ParquetWriter(path, table.schema)
+                writer.write_table(table)
+                if os.path.getsize(path) >= self.max_file_size:
+                    writer.close()
+                    writer = None
+                    self._part += 1
+        except Exception as e:
+            self._error = e
+            # Keep consuming so that producers don't block forever on a full queue
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if writer is not None:
+                writer.close()
+
+    def close(self):
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        self._finalizer.cancel()
+        self._flush_buffers()
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+def read_parquet_logs(log_dir: str, prefix: str = "generated_mols_"):
+    """Reads the Parquet files written by the ParquetLog of every worker as a single dataset
+
+    Parameters
+    ----------
+    log_dir: str
+        The directory containing the logs, e.g. `{hps['log_dir']}/train`.
+    prefix: str
+        The prefix of the log files.
+
+    Returns
+    -------
+    dataset: pyarrow.dataset.Dataset
+        The dataset, which can be scanned lazily, or loaded with e.g. `.to_table().to_pandas()`.
+    """
+    import pyarrow.dataset as ds
+
+    files = sorted(glob.glob(os.path.join(glob.escape(log_dir), f"{prefix}*{ParquetLog.file_extension}")))
+    return ds.dataset(files, format="parquet")
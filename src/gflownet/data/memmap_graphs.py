@@ -0,0 +1,234 @@
+"""A flat, memory-mapped storage format for the graphs and rewards of an offline training set.
+
+Unpickling a list of networkx graphs is slow, and the resulting Python objects are progressively
+copied into every DataLoader worker as their reference counts are touched. Instead, the graphs are
+stored as CSR arrays (the nodes and edges of graph i are rows node_ptr[i]:node_ptr[i+1] and
+edge_ptr[i]:edge_ptr[i+1]), with node and edge attributes stored as integer codes into small
+vocabularies. The arrays are memory-mapped, so they are shared by all workers through the page
+cache, and a graph is only materialized when it is indexed.
+
+    python -m gflownet.data.memmap_graphs DATA_DIR
+
+converts the `training_set_graphs.pkl`, `training_set_rewards.pkl` and `part_idxs.pkl` files of
+`DATA_DIR` to `DATA_DIR/training_set_mmap/`, see MemmapTrainingDataset.
+"""
+
+import argparse
+import json
+import os
+import pickle  # nosec
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from gflownet.envs.graph_building_env import Graph
+
+FORMAT_VERSION = 1
+# Edge attributes whose name starts with the id of one of the edge's endpoints (e.g. the
+# f"{u}_attach" attributes of fragment graphs) are stored relative to that endpoint
+_SRC, _DST = "{src}", "{dst}"
+
+
+def _relative_key(key: str, u: Any, v: Any) -> str:
+    for prefix, template in [(f"{u}_", _SRC), (f"{v}_", _DST)]:
+        if key.startswith(prefix):
+            return template + key[len(prefix) - 1 :]
+    return key
+
+
+def _absolute_key(key: str, u: Any, v: Any) -> str:
+    if key.startswith(_SRC):
+        return f"{u}{key[len(_SRC):]}"
+    if key.startswith(_DST):
+        return f"{v}{key[len(_DST):]}"
+    return key
+
+
+def _encode(values: List[Dict[str, Any]]):
+    """Encodes a list of attribute dicts as one int32 column of vocabulary codes per attribute
+    (-1 when the attribute is missing)"""
+    vocabs: Dict[str, Dict[Any, int]] = {}
+    for d in values:
+        for k, v in d.items():
+            v = v.item() if isinstance(v, np.generic) else v
+            vocab = vocabs.setdefault(k, {})
+            if v not in vocab:
+                vocab[v] = len(vocab)
+    columns = {k: np.full(len(values), -1, dtype=np.int32) for k in vocabs}
+    for i, d in enumerate(values):
+        for k, v in d.items():
+            columns[k][i] = vocabs[k][v.item() if isinstance(v, np.generic) else v]
+    return {k: list(vocab) for k, vocab in vocabs.items()}, columns
+
+
+def convert_graphs(
+    graphs: Sequence[Graph],
+    rewards: Sequence[Any],
+    path: str,
+    parts: Optional[Any] = None,
+    reward_names: Optional[List[str]] = None,
+):
+    """Writes graphs, their rewards, and (optionally) the index arrays of data parts to the `path`
+    directory, to be read with MemmapGraphs/MemmapTrainingDataset.
+
+    Parameters
+    ----------
+    graphs: Sequence[Graph]
+        The graphs. Node ids must be integers, and attribute values must be hashable.
+    rewards: Sequence[Any]
+        The (flat) rewards of each graph, all of the same shape.
+    path: str
+        The output directory.
+    parts: Optional[Any]
+        A list, or dict, of arrays of graph indices (e.g. the content of `part_idxs.pkl`).
+    reward_names: Optional[List[str]]
+        The name of each column of the rewards, if they are 1d.
+    """
+    node_ids, node_attrs, edges, edge_attrs = [], [], [], []
+    node_ptr = np.zeros(len(graphs) + 1, dtype=np.int64)
+    edge_ptr = np.zeros(len(graphs) + 1, dtype=np.int64)
+    for i, g in enumerate(graphs):
+        for n in g.nodes:
+            node_ids.append(n)
+            node_attrs.append(g.nodes[n])
+        for u, v in g.edges:
+            edges.append((u, v))
+            edge_attrs.append({_relative_key(k, u, v): a for k, a in g.edges[u, v].items()})
+        node_ptr[i + 1] = len(node_ids)
+        edge_ptr[i + 1] = len(edges)
+    node_vocabs, node_columns = _encode(node_attrs)
+    edge_vocabs, edge_columns = _encode(edge_attrs)
+
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, "node_ptr.npy"), node_ptr)
+    np.save(os.path.join(path, "edge_ptr.npy"), edge_ptr)
+    np.save(os.path.join(path, "node_ids.npy"), np.array(node_ids, dtype=np.int32))
+    np.save(os.path.join(path, "edges.npy"), np.array(edges, dtype=np.int32).reshape((-1, 2)))
+    for j, k in enumerate(node_vocabs):
+        np.save(os.path.join(path, f"node_attr_{j}.npy"), node_columns[k])
+    for j, k in enumerate(edge_vocabs):
+        np.save(os.path.join(path, f"edge_attr_{j}.npy"), edge_columns[k])
+    np.save(os.path.join(path, "rewards.npy"), np.stack([np.asarray(r, dtype=np.float32) for r in rewards]))
+    part_keys = []
+    if parts is not None:
+        for k, idxs in parts.items() if isinstance(parts, dict) else enumerate(parts):
+            part_keys.append(k)
+            np.save(os.path.join(path, f"part_{k}.npy"), np.asarray(idxs, dtype=np.int64))
+    # The vocabularies are small, but their values needn't be JSON serializable (e.g. RDKit enums)
+    with open(os.path.join(path, "vocabs.pkl"), "wb") as f:
+        pickle.dump({"node_attrs": list(node_vocabs.items()), "edge_attrs": list(edge_vocabs.items())}, f)
+    meta = {
+        "version": FORMAT_VERSION,
+        "num_graphs": len(graphs),
+        # The order of the attribute columns
+        "node_attrs": list(node_vocabs),
+        "edge_attrs": list(edge_vocabs),
+        "parts": part_keys,
+        "reward_names": reward_names,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+class MemmapGraphs:
+    """A read-only sequence of the graphs (and rewards) written by `convert_graphs`.
+
+    Graphs are rebuilt when indexed, with the same node and edge order as the original graphs (so that
+    e.g. `ctx.graph_to_Data` is unchanged). Pickling this object (e.g. to send it to spawned DataLoader
+    workers) doesn't copy the arrays, they are memory-mapped again when unpickled.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        assert self.meta["version"] == FORMAT_VERSION, f"Unsupported graph format {self.meta['version']}"
+        with open(os.path.join(path, "vocabs.pkl"), "rb") as f:
+            self.vocabs = pickle.load(f)  # nosec
+        self._open()
+
+    def _load(self, name):
+        return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+    def _open(self):
+        self.node_ptr = self._load("node_ptr")
+        self.edge_ptr = self._load("edge_ptr")
+        self.node_ids = self._load("node_ids")
+        self.edges = self._load("edges")
+        self.node_attrs = [
+            (k, vocab, self._load(f"node_attr_{j}")) for j, (k, vocab) in enumerate(self.vocabs["node_attrs"])
+        ]
+        self.edge_attrs = [
+            (k, vocab, self._load(f"edge_attr_{j}")) for j, (k, vocab) in enumerate(self.vocabs["edge_attrs"])
+        ]
+        self.rewards = self._load("rewards")
+
+    def __getstate__(self):
+        return {"path": self.path, "meta": self.meta, "vocabs": self.vocabs}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.meta["num_graphs"]
+
+    def __getitem__(self, idx: int) -> Graph:
+        g = Graph()
+        ns, ne = int(self.node_ptr[idx]), int(self.node_ptr[idx + 1])
+        node_codes = [(k, vocab, codes[ns:ne]) for k, vocab, codes in self.node_attrs]
+        for i, n in enumerate(self.node_ids[ns:ne].tolist()):
+            g.add_node(n, **{k: vocab[c[i]] for k, vocab, c in node_codes if c[i] >= 0})
+        es, ee = int(self.edge_ptr[idx]), int(self.edge_ptr[idx + 1])
+        edge_codes = [(k, vocab, codes[es:ee]) for k, vocab, codes in self.edge_attrs]
+        for i, (u, v) in enumerate(self.edges[es:ee].tolist()):
+            g.add_edge(u, v, **{_absolute_key(k, u, v): vocab[c[i]] for k, vocab, c in edge_codes if c[i] >= 0})
+        return g
+
+    def reward(self, idx: int) -> torch.Tensor:
+        return torch.from_numpy(np.array(self.rewards[idx]))
+
+    def part_idxs(self, part: Any) -> np.ndarray:
+        assert part in self.meta["parts"], f"Unknown part {part}, the data has parts {self.meta['parts']}"
+        return self._load(f"part_{part}")
+
+
+class MemmapTrainingDataset(Dataset):
+    """The memory-mapped equivalent of seh_frag's TrainingDataset: the (graph, reward) pairs of a part
+    of the data, where graphs are materialized only when indexed."""
+
+    def __init__(self, path: str, part: Optional[Any] = None):
+        self.data = MemmapGraphs(path)
+        self.in_part_idxs = self.data.part_idxs(part) if part is not None else np.arange(len(self.data))
+
+    def __len__(self):
+        return len(self.in_part_idxs)
+
+    def __getitem__(self, idx):
+        valid_idx = int(self.in_part_idxs[idx])
+        return self.data[valid_idx], self.data.reward(valid_idx)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converts pickled offline training data to a memory-mapped format")
+    parser.add_argument("data_dir", help="The directory of training_set_{graphs,rewards}.pkl and part_idxs.pkl")
+    parser.add_argument("-o", "--output", help="Defaults to DATA_DIR/training_set_mmap")
+    args = parser.parse_args(argv)
+
+    def load(name):
+        with open(os.path.join(args.data_dir, name), "rb") as f:
+            return pickle.load(f)  # nosec
+
+    parts = load("part_idxs.pkl") if os.path.exists(os.path.join(args.data_dir, "part_idxs.pkl")) else None
+    convert_graphs(
+        load("training_set_graphs.pkl"),
+        load("training_set_rewards.pkl"),
+        args.output or os.path.join(args.data_dir, "training_set_mmap"),
+        parts,
+    )
+
+
+if __name__ == "__main__":
+    main()
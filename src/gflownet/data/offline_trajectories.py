@@ -0,0 +1,310 @@
+"""Precomputed forward trajectories of the graphs of a static offline dataset.
+
+Generating the trajectory of an offline graph (`generate_forward_trajectory`), its P_B
+log-probabilities and its states' Data instances is costly, and is otherwise done for every offline
+graph of every batch. This module precomputes `k` random trajectories per graph once, and stores them
+as flat memory-mapped arrays, which DataLoader workers share through the page cache:
+
+    python -m gflownet.data.offline_trajectories DATA_DIR -k 8 [--store-states] [--num-workers 8]
+
+reads the graphs of `DATA_DIR/training_set_graphs.pkl` and writes the trajectories to
+`DATA_DIR/training_set_trajectories/`. The command line only handles fragment graphs
+(FragMolBuildingEnvContext); call `build_offline_trajectories` directly for other environment
+contexts. See OfflineTrajectoryStore and OfflineTrajectoryDataset.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import pickle  # nosec
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+import torch_geometric.data as gd
+from torch.utils.data import Dataset
+
+from gflownet.data.trajectory_batch import TrajectoryBatch
+from gflownet.envs.graph_building_env import (
+    Graph,
+    GraphBuildingEnv,
+    GraphBuildingEnvContext,
+    generate_forward_trajectory,
+)
+
+FORMAT_VERSION = 1
+
+
+def _generate(args) -> Dict[str, Any]:
+    """Generates the trajectories of a chunk of graphs, run by the workers of `build_offline_trajectories`"""
+    graphs, ctx, k, seed, correct_idempotent, store_states = args
+    # generate_forward_trajectory uses numpy's global RNG
+    np.random.seed(seed)
+    env = GraphBuildingEnv()
+    traj_lens: List[int] = []
+    actions: List[Sequence[int]] = []
+    log_p_B: List[float] = []
+    states: List[gd.Data] = []
+    for g in graphs:
+        for _ in range(k):
+            traj = generate_forward_trajectory(g)
+            # As in TrajectoryBalance.create_training_data_from_graphs
+            n_back = [env.count_backward_transitions(gp, check_idempotent=correct_idempotent) for gp, _ in traj[1:]]
+            log_p_B += [-np.log(i) for i in n_back] + [0.0]
+            traj_lens.append(len(traj))
+            for s, a in traj:
+                d = ctx.graph_to_Data(s)
+                actions.append(ctx.GraphAction_to_aidx(d, a))
+                if store_states:
+                    states.append(d)
+    return {
+        "traj_lens": np.array(traj_lens, dtype=np.int64),
+        "actions": np.array(actions, dtype=np.int32).reshape((-1, 3)),
+        "log_p_B": np.array(log_p_B, dtype=np.float32),
+        "states": _flatten_states(states) if store_states else None,
+    }
+
+
+def _flatten_states(states: List[gd.Data]) -> Dict[str, Tuple[int, np.ndarray, np.ndarray]]:
+    """Concatenates each attribute of the states along its concatenation dimension (as used by
+    `gd.Batch`). Returns, for each attribute, that dimension, the concatenated values, and the size
+    of each state's attribute along that dimension."""
+    flat = {}
+    for key in states[0].keys:
+        values = [d[key] for d in states]
+        dim = states[0].__cat_dim__(key, values[0]) % values[0].dim()
+        sizes = np.array([v.shape[dim] for v in values], dtype=np.int64)
+        flat[key] = (dim, torch.cat(values, dim).numpy(), sizes)
+    return flat
+
+
+def build_offline_trajectories(
+    graphs: List[Graph],
+    ctx: GraphBuildingEnvContext,
+    path: str,
+    k: int = 8,
+    seed: int = 142857,
+    correct_idempotent: bool = False,
+    store_states: bool = False,
+    num_workers: int = 0,
+    chunk_size: int = 256,
+):
+    """Generates `k` random forward trajectories for each graph, and writes them to the `path` directory.
+
+    Parameters
+    ----------
+    graphs: List[Graph]
+        The graphs of the dataset, the trajectories of `graphs[i]` are rows [i * k, (i + 1) * k).
+    ctx: GraphBuildingEnvContext
+        The context used for training, actions are stored as this context's action indices.
+    path: str
+        The directory in which the arrays are written.
+    k: int
+        The number of trajectories per graph.
+    seed: int
+        The seed of the random trajectories.
+    correct_idempotent: bool
+        Whether P_B counts idempotent backward transitions once (must match the algorithm's setting).
+    store_states: bool
+        If True, the Data instance of every state (as given by `ctx.graph_to_Data`) is stored as well,
+        so that they needn't be recomputed when a batch is constructed. This takes significantly more
+        disk space.
+    num_workers: int
+        The number of processes generating trajectories, 0 to generate them in this process.
+    chunk_size: int
+        The number of graphs processed at a time by each worker.
+    """
+    chunks = [
+        (graphs[i : i + chunk_size], ctx, k, seed + i, correct_idempotent, store_states)
+        for i in range(0, len(graphs), chunk_size)
+    ]
+    if num_workers > 0:
+        with multiprocessing.Pool(num_workers) as pool:
+            results = pool.map(_generate, chunks)
+    else:
+        results = [_generate(i) for i in chunks]
+
+    os.makedirs(path, exist_ok=True)
+    traj_lens = np.concatenate([r["traj_lens"] for r in results])
+    traj_ptr = np.zeros(len(traj_lens) + 1, dtype=np.int64)
+    np.cumsum(traj_lens, out=traj_ptr[1:])
+    np.save(os.path.join(path, "traj_ptr.npy"), traj_ptr)
+    np.save(os.path.join(path, "actions.npy"), np.concatenate([r["actions"] for r in results]))
+    np.save(os.path.join(path, "log_p_B.npy"), np.concatenate([r["log_p_B"] for r in results]))
+    state_dims = {}
+    if store_states:
+        states = [r["states"] for r in results]
+        for key in states[0]:
+            dim = state_dims[key] = states[0][key][0]
+            np.save(os.path.join(path, f"state_{key}.npy"), np.concatenate([s[key][1] for s in states], dim))
+            sizes = np.concatenate([s[key][2] for s in states])
+            ptr = np.zeros(len(sizes) + 1, dtype=np.int64)
+            np.cumsum(sizes, out=ptr[1:])
+            np.save(os.path.join(path, f"state_{key}_ptr.npy"), ptr)
+    meta = {
+        "version": FORMAT_VERSION,
+        "num_graphs": len(graphs),
+        "num_trajs_per_graph": k,
+        "correct_idempotent": correct_idempotent,
+        "state_dims": state_dims,
+    }
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+
+
+class OfflineTrajectoryStore:
+    """Read-only access to the trajectories written by `build_offline_trajectories`.
+
+    Arrays are memory-mapped, so that opening the store is instantaneous and that its pages are shared
+    by all the processes reading it (including spawned processes, to which the store is pickled without
+    its arrays). Only the sampled trajectories are copied into memory.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        assert meta["version"] == FORMAT_VERSION, f"Unsupported offline trajectories format {meta['version']}"
+        self.path = path
+        self.num_graphs: int = meta["num_graphs"]
+        self.num_trajs_per_graph: int = meta["num_trajs_per_graph"]
+        self.correct_idempotent: bool = meta["correct_idempotent"]
+        self.state_dims: Dict[str, int] = meta["state_dims"]
+        self._open()
+
+    def _open(self):
+        def load(name):
+            return np.load(os.path.join(self.path, f"{name}.npy"), mmap_mode="r")
+
+        self.traj_ptr = load("traj_ptr")
+        self.actions = load("actions")
+        self.log_p_B = load("log_p_B")
+        self.states = {k: (load(f"state_{k}"), load(f"state_{k}_ptr")) for k in self.state_dims}
+
+    def __getstate__(self):
+        # Pickling memory-mapped arrays would copy them, they are mapped again when unpickled instead
+        return {k: v for k, v in self.__dict__.items() if k not in ["traj_ptr", "actions", "log_p_B", "states"]}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self.num_graphs
+
+    @property
+    def has_states(self) -> bool:
+        return len(self.state_dims) > 0
+
+    def _state(self, t: int) -> gd.Data:
+        fields = {}
+        for k, dim in self.state_dims.items():
+            values, ptr = self.states[k]
+            s = (slice(None),) * dim + (slice(ptr[t], ptr[t + 1]),)
+            fields[k] = torch.from_numpy(np.array(values[s]))
+        return gd.Data(**fields)
+
+    def sample(
+        self, graph_idcs: np.ndarray, rng: np.random.Generator, results: Optional[List[Graph]] = None
+    ) -> TrajectoryBatch:
+        """Samples one of the stored trajectories of each of the graphs `graph_idcs`
+
+        Parameters
+        ----------
+        graph_idcs: np.ndarray
+            The (store) indices of N graphs.
+        rng: np.random.Generator
+            The generator used to pick the trajectories.
+        results: Optional[List[Graph]]
+            The graphs themselves, used as the `results` of the trajectories. If None, the results
+            are recovered by `TrajectoryBatch.replay`.
+
+        Returns
+        -------
+        trajs: TrajectoryBatch
+            The N trajectories, with their P_B log-probabilities, and their states if the store has them.
+        """
+        graph_idcs = np.asarray(graph_idcs, dtype=np.int64)
+        n = len(graph_idcs)
+        t = graph_idcs * self.num_trajs_per_graph + rng.integers(0, self.num_trajs_per_graph, n)
+        starts, ends = self.traj_ptr[t], self.traj_ptr[t + 1]
+        steps = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)]) if n else np.zeros(0, np.int64)
+        return TrajectoryBatch(
+            traj_lens=torch.from_numpy(ends - starts),
+            actions=torch.from_numpy(self.actions[steps].astype(np.int64)).reshape((-1, 3)),
+            results=list(results) if results is not None else [None] * n,
+            log_p_B=torch.from_numpy(self.log_p_B[steps].astype(np.float32)),
+            states=[self._state(i) for i in steps] if self.has_states else None,
+        )
+
+
+class OfflineTrajectoryDataset(Dataset):
+    """Wraps a dataset of (graph, flat_rewards) pairs whose graphs have precomputed trajectories.
+
+    SamplingIterator uses `sample_trajectories` rather than generating the trajectories of the
+    offline graphs itself.
+    """
+
+    def __init__(self, dataset: Dataset, store: OfflineTrajectoryStore, store_idxs: Optional[Sequence[int]] = None):
+        """
+        Parameters
+        ----------
+        dataset: Dataset
+            A dataset of (graph, flat_rewards) pairs.
+        store: OfflineTrajectoryStore
+            The trajectories of the dataset's graphs.
+        store_idxs: Optional[Sequence[int]]
+            The store index of the graph of each item of `dataset`, if they differ (e.g. when the
+            dataset is a subset of the graphs the store was built from).
+        """
+        self.dataset = dataset
+        self.store = store
+        self.store_idxs = np.asarray(store_idxs, dtype=np.int64) if store_idxs is not None else None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return self.dataset[idx]
+
+    def sample_trajectories(self, idcs: np.ndarray, graphs: List[Graph], rng: np.random.Generator) -> TrajectoryBatch:
+        store_idcs = self.store_idxs[idcs] if self.store_idxs is not None else idcs
+        return self.store.sample(store_idcs, rng, results=graphs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Precomputes the trajectories of an offline dataset's graphs. Only stores for the fragment "
+        "environment (FragMolBuildingEnvContext, as used by SEHFragTrainer) can be built from the command line, "
+        "use build_offline_trajectories for other contexts."
+    )
+    parser.add_argument("data_dir", help="The directory of training_set_graphs.pkl")
+    parser.add_argument("-o", "--output", help="Defaults to DATA_DIR/training_set_trajectories")
+    parser.add_argument("-k", type=int, default=8, help="Number of trajectories per graph")
+    parser.add_argument("--max-frags", type=int, default=9, help="max_nodes of the fragment environment context")
+    parser.add_argument(
+        "--correct-idempotent", action="store_true", help="Must match the tb_correct_idempotent hp of the trainer"
+    )
+    parser.add_argument("--store-states", action="store_true", help="Also store the Data instance of every state")
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=142857)
+    args = parser.parse_args(argv)
+
+    from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+
+    with open(os.path.join(args.data_dir, "training_set_graphs.pkl"), "rb") as f:
+        graphs = pickle.load(f)  # nosec
+    build_offline_trajectories(
+        graphs,
+        FragMolBuildingEnvContext(max_frags=args.max_frags),
+        args.output or os.path.join(args.data_dir, "training_set_trajectories"),
+        k=args.k,
+        seed=args.seed,
+        correct_idempotent=args.correct_idempotent,
+        store_states=args.store_states,
+        num_workers=args.num_workers,
+    )
+
+
+if __name__ == "__main__":
+    main()
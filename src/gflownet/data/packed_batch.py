@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Tuple
+
+import torch
+import torch_geometric.data as gd
+from torch import Tensor
+
+# Non-tensor values that are sent with the header rather than dropped, dicts are expected to be
+# small dicts of logged values, such as `extra_info`
+_HEADER_TYPES = (int, float, bool, str, type(None), dict)
+
+
+class PackedBatch:
+    """A lean representation of a `gd.Batch` meant to be sent from a DataLoader worker to the main
+    process.
+
+    All the tensors of the batch (including the `_slice_dict`/`_inc_dict` tensors torch_geometric
+    and GraphActionCategorical rely on, other underscored tensors such as those set by
+    `augment_virtual_nodes`, and those of nested batches, e.g. EnvelopeQL's `batch_prime`) are
+    copied into one contiguous buffer per dtype, which are allocated in shared memory when
+    packing happens in a worker. Alongside the buffers travels a small header describing where each
+    tensor lives, and the scalar attributes of the batch (e.g. `num_online`, `extra_info`). Only
+    those need to be pickled; each buffer is sent as a single shared-memory handle.
+
+    There is one buffer per dtype rather than a single byte buffer because torch 1.10 cannot view
+    a uint8 tensor as a dtype of a different element size. A batch only holds a handful of dtypes,
+    so moving it to a device is still only a few transfers.
+
+    Any other Python payload (e.g. the list of RDKit molecules in `batch.mols`) is dropped, since it
+    isn't used for training; generated molecules are logged by the workers themselves.
+    """
+
+    def __init__(self, buffers: Dict[torch.dtype, Tensor], header: Tuple):
+        """
+        Parameters
+        ----------
+        buffers: Dict[torch.dtype, Tensor]
+            For each dtype, a 1d tensor containing the data of all the tensors of the batch of that dtype.
+        header: Tuple
+            The header describing the batch, see `PackedBatch.from_batch`.
+        """
+        self.buffers = buffers
+        self.header = header
+
+    @classmethod
+    def from_batch(cls, batch: gd.Batch) -> "PackedBatch":
+        """Packs a batch
+
+        Parameters
+        ----------
+        batch: gd.Batch
+            A batch, e.g. as returned by an algorithm's `construct_batch`.
+
+        Returns
+        -------
+        packed: PackedBatch
+            The packed batch.
+        """
+        tensors: List[Tensor] = []
+        header = _make_header(batch, tensors)
+        layout = []
+        sizes: Dict[torch.dtype, int] = {}
+        for t in tensors:
+            offset = sizes.get(t.dtype, 0)
+            layout.append((t.dtype, t.shape, offset, t.numel()))
+            sizes[t.dtype] = offset + t.numel()
+        buffers = {dtype: torch.empty(size, dtype=dtype) for dtype, size in sizes.items()}
+        if torch.utils.data.get_worker_info() is not None:
+            # Writing directly into shared memory avoids a copy when the buffers are sent to the main process
+            for buffer in buffers.values():
+                buffer.share_memory_()
+        for t, (dtype, _, o, n) in zip(tensors, layout):
+            buffers[dtype][o : o + n].copy_(t.reshape(-1))
+        return cls(buffers, (header, layout))
+
+    def to_batch(self) -> gd.Batch:
+        """Unpacks the batch, the returned batch's tensors are views of `self.buffers`.
+
+        Returns
+        -------
+        batch: gd.Batch
+            The batch.
+        """
+        header, layout = self.header
+        tensors = [self.buffers[dtype][o : o + n].view(shape) for dtype, shape, o, n in layout]
+        return _from_header(header, tensors)
+
+    def to(self, device: torch.device, non_blocking: bool = False) -> gd.Batch:
+        """Unpacks the batch and moves it to `device`"""
+        if torch.device(device) != torch.device("cpu"):
+            # Only one transfer per dtype is needed to get everything on the device
+            buffers = {k: v.to(device, non_blocking=non_blocking) for k, v in self.buffers.items()}
+            return PackedBatch(buffers, self.header).to_batch()
+        return self.to_batch()
+
+    def pin_memory(self) -> "PackedBatch":
+        return PackedBatch({k: v.pin_memory() for k, v in self.buffers.items()}, self.header)
+
+
+def _make_header(batch: gd.Batch, tensors: List[Tensor]) -> Dict[str, Any]:
+    """Appends the tensors of `batch` to `tensors`, and returns a header referring to them by index"""
+
+    def idx(t):
+        tensors.append(t.contiguous())
+        return len(tensors) - 1
+
+    header: Dict[str, Any] = {"tensors": {}, "batches": {}, "scalars": {}}
+    for k, v in batch.to_dict().items():
+        if isinstance(v, Tensor):
+            header["tensors"][k] = idx(v)
+        elif isinstance(v, gd.Batch):
+            header["batches"][k] = _make_header(v, tensors)
+        elif isinstance(v, _HEADER_TYPES):
+            header["scalars"][k] = v
+    header["num_graphs"] = batch.num_graphs
+    header["slice_dict"] = {k: idx(v) for k, v in getattr(batch, "_slice_dict", {}).items()}
+    header["inc_dict"] = {k: idx(v) for k, v in getattr(batch, "_inc_dict", {}).items() if isinstance(v, Tensor)}
+    # Underscored attributes are kept by torch_geometric outside of the batch's data (see augment_virtual_nodes)
+    header["private"] = {k: idx(v) for k, v in vars(batch._store).items() if isinstance(v, Tensor)}
+    return header
+
+
+def _from_header(header: Dict[str, Any], tensors: List[Tensor]) -> gd.Batch:
+    batch = gd.Batch()
+    for k, i in header["tensors"].items():
+        batch[k] = tensors[i]
+    for k, v in header["batches"].items():
+        batch[k] = _from_header(v, tensors)
+    for k, v in header["scalars"].items():
+        batch[k] = v
+    batch._num_graphs = header["num_graphs"]
+    batch._slice_dict = {k: tensors[i] for k, i in header["slice_dict"].items()}
+    batch._inc_dict = {k: tensors[i] for k, i in header["inc_dict"].items()}
+    for k, i in header["private"].items():
+        setattr(batch, k, tensors[i])
+    return batch
@@ -0,0 +1,87 @@
+import queue
+import threading
+from typing import Iterable
+
+import torch
+
+
+class _Stop:
+    pass
+
+
+class DevicePrefetcher:
+    """Prefetches batches from an iterable (e.g. a DataLoader) in a background thread, and moves them
+    to `device` ahead of time.
+
+    Up to `depth` batches are kept ready. On CUDA, batches are copied into pinned host memory and
+    sent to the device with non-blocking copies on a side stream, so that transfers overlap with the
+    training step; consumers wait on the copy's event rather than on the whole side stream. On CPU
+    this simply takes the retrieval (e.g. unpickling) of batches off the training thread.
+    """
+
+    def __init__(self, iterable: Iterable, device: torch.device, depth: int = 2):
+        """
+        Parameters
+        ----------
+        iterable: Iterable
+            The source of batches, batches must have a `to(device)` method (e.g. gd.Batch).
+        device: torch.device
+            The device batches should be moved to.
+        depth: int
+            The maximum number of batches being prefetched at a time.
+        """
+        self.device = torch.device(device)
+        self._is_cuda = self.device.type == "cuda"
+        self._stream = torch.cuda.Stream(self.device) if self._is_cuda else None
+        self._queue: queue.Queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iterable,), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self, iterable):
+        try:
+            for batch in iterable:
+                if self._stop.is_set():
+                    return
+                event = None
+                if self._is_cuda:
+                    batch = batch.pin_memory()
+                    with torch.cuda.stream(self._stream):
+                        batch = batch.to(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(self._stream)
+                else:
+                    batch = batch.to(self.device)
+                self._put((batch, event))
+        except Exception as e:
+            # Surface the error in the consuming thread
+            self._put((e, None))
+            return
+        self._put((_Stop(), None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, event = self._queue.get()
+        if isinstance(batch, _Stop):
+            raise StopIteration
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            stream.wait_event(event)
+            # The batch's memory was allocated on the side stream, tell the allocator it is used here
+            batch.apply(lambda t: t.record_stream(stream) or t)
+        return batch
+
+    def close(self):
+        self._stop.set()
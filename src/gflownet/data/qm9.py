@@ -1,3 +1,5 @@
+import argparse
+import os
 import tarfile
 
 import numpy as np
@@ -5,38 +7,119 @@ import pandas as pd
 import rdkit.Chem as Chem
 from torch.utils.data import Dataset
 
+from gflownet.data.memmap_graphs import MemmapGraphs, convert_graphs
+
+QM9_LABELS = ["rA", "rB", "rC", "mu", "alpha", "homo", "lumo", "gap", "r2", "zpve", "U0", "U", "H", "G", "Cv"]
+QM9_ELEMENTS = ["H", "C", "N", "F", "O"]
+
+
+def load_tar(xyz_file) -> pd.DataFrame:
+    """Reads the (possibly compressed) tar archive of QM9's .xyz files into a SMILES + labels DataFrame"""
+    labels = QM9_LABELS
+    all_mols = []
+    with tarfile.open(xyz_file, "r") as f:
+        for pt in f:
+            if not pt.isfile():
+                continue
+            data = f.extractfile(pt).read().decode().splitlines()
+            # Some values are written in Mathematica's notation, e.g. 1.2*^-6
+            values = [float(i.replace("*^", "e")) for i in data[1].split()[2:]]
+            all_mols.append(data[-2].split()[:1] + values[: len(labels)])
+    return pd.DataFrame(all_mols, columns=["SMILES"] + labels)
+
+
+def load_df(h5_file=None, xyz_file=None) -> pd.DataFrame:
+    if h5_file is not None:
+        return pd.HDFStore(h5_file, "r")["df"]
+    elif xyz_file is not None:
+        return load_tar(xyz_file)
+    raise ValueError("Either h5_file or xyz_file must be provided")
+
+
+def _split(n, train, split_seed, ratio):
+    rng = np.random.default_rng(split_seed)
+    idcs = np.arange(n)
+    rng.shuffle(idcs)
+    if train:
+        return idcs[: int(np.floor(ratio * n))]
+    return idcs[int(np.floor(ratio * n)) :]
+
 
 class QM9Dataset(Dataset):
     def __init__(self, h5_file=None, xyz_file=None, train=True, target="gap", split_seed=142857, ratio=0.9):
-        if h5_file is not None:
-            self.df = pd.HDFStore(h5_file, "r")["df"]
-        elif xyz_file is not None:
-            self.load_tar()
-        rng = np.random.default_rng(split_seed)
-        idcs = np.arange(len(self.df))  # TODO: error if there is no h5_file provided. Should h5 be required
-        rng.shuffle(idcs)
+        self.df = load_df(h5_file, xyz_file)
         self.target = target
-        if train:
-            self.idcs = idcs[: int(np.floor(ratio * len(self.df)))]
-        else:
-            self.idcs = idcs[int(np.floor(ratio * len(self.df))) :]
+        self.idcs = _split(len(self.df), train, split_seed, ratio)
 
     def get_stats(self, percentile=0.95):
         y = self.df[self.target]
         return y.min(), y.max(), np.sort(y)[int(y.shape[0] * percentile)]
 
-    def load_tar(self, xyz_file):
-        f = tarfile.TarFile(xyz_file, "r")
-        labels = ["rA", "rB", "rC", "mu", "alpha", "homo", "lumo", "gap", "r2", "zpve", "U0", "U", "H", "G", "Cv"]
-        all_mols = []
-        for pt in f:
-            pt = f.extractfile(pt)
-            data = pt.read().decode().splitlines()
-            all_mols.append(data[-2].split()[:1] + list(map(float, data[1].split()[2:])))
-        self.df = pd.DataFrame(all_mols, columns=["SMILES"] + labels)
-
     def __len__(self):
         return len(self.idcs)
 
     def __getitem__(self, idx):
         return (Chem.MolFromSmiles(self.df["SMILES"][self.idcs[idx]]), self.df[self.target][self.idcs[idx]])
+
+
+def preprocess_qm9(path, ctx, h5_file=None, xyz_file=None):
+    """Converts QM9 to the graphs of `ctx` (a MolBuildingEnvContext) and stores them, along with all the
+    labels, in the memory-mapped format of gflownet.data.memmap_graphs, to be read by
+    PreprocessedQM9Dataset. Molecules RDKit can't parse are dropped, the graph index of each row of QM9's
+    DataFrame (-1 if dropped) is stored in `row_graphs.npy`, so that the dataset is split like QM9Dataset."""
+    df = load_df(h5_file, xyz_file)
+    mols = [Chem.MolFromSmiles(i) for i in df["SMILES"]]
+    keep = [i for i, m in enumerate(mols) if m is not None]
+    labels = [i for i in QM9_LABELS if i in df.columns]
+    convert_graphs(
+        [ctx.mol_to_graph(mols[i]) for i in keep],
+        df[labels].values[keep].astype(np.float32),
+        path,
+        reward_names=labels,
+    )
+    row_graphs = np.full(len(df), -1, dtype=np.int64)
+    row_graphs[keep] = np.arange(len(keep))
+    np.save(os.path.join(path, "row_graphs.npy"), row_graphs)
+
+
+class PreprocessedQM9Dataset(Dataset):
+    """QM9Dataset's equivalent for the data written by `preprocess_qm9`, which yields (graph, target) pairs
+    rather than (mol, target) pairs. Items are read from memory-mapped arrays, no SMILES parsing or pandas
+    indexing is done."""
+
+    def __init__(self, path, train=True, target="gap", split_seed=142857, ratio=0.9):
+        self.data = MemmapGraphs(path)
+        self.target = target
+        self.target_idx = self.data.meta["reward_names"].index(target)
+        # The split is made on the rows of QM9's DataFrame, as in QM9Dataset, before dropping the rows whose
+        # molecule couldn't be parsed
+        row_graphs = np.load(os.path.join(path, "row_graphs.npy"))
+        idcs = row_graphs[_split(len(row_graphs), train, split_seed, ratio)]
+        self.idcs = idcs[idcs >= 0]
+
+    def get_stats(self, percentile=0.95):
+        y = np.array(self.data.rewards[:, self.target_idx])
+        return y.min(), y.max(), np.sort(y)[int(y.shape[0] * percentile)]
+
+    def __len__(self):
+        return len(self.idcs)
+
+    def __getitem__(self, idx):
+        i = self.idcs[idx]
+        return self.data[i], float(self.data.rewards[i, self.target_idx])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Converts QM9 to memory-mapped MolBuildingEnvContext graphs")
+    parser.add_argument("output")
+    parser.add_argument("--h5-file")
+    parser.add_argument("--xyz-file", help="The tar archive of QM9's .xyz files")
+    args = parser.parse_args(argv)
+
+    from gflownet.envs.mol_building_env import MolBuildingEnvContext
+
+    preprocess_qm9(args.output, MolBuildingEnvContext(QM9_ELEMENTS), args.h5_file, args.xyz_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+from typing import Dict, NamedTuple, Optional
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch import Tensor
+
+from gflownet.data.trajectory_batch import TrajectoryBatch
+
+
+class ReplayedTrajectories(NamedTuple):
+    trajs: TrajectoryBatch
+    cond_info: Tensor
+    log_rewards: Tensor
+    flat_rewards: Tensor
+    preferences: Optional[Tensor]
+
+
+class ReplayBuffer:
+    """A bounded buffer of (valid) trajectories and their rewards, shared by all DataLoader workers.
+
+    Trajectories are stored compactly, as the action indices of each step (see TrajectoryBatch)
+    along with their conditional information encoding, log-reward and flat rewards. Neither graphs
+    nor reward proxies are needed to replay them, states are recovered from the actions when a
+    batch is constructed.
+
+    All storage is preallocated in shared memory when the buffer is created, so the buffer must be
+    created in the main process before the DataLoader workers are started. Workers then add their
+    trajectories to, and sample from, the same buffer. Once full, the oldest trajectories are
+    evicted first.
+    """
+
+    def __init__(
+        self,
+        capacity: int,
+        max_traj_len: int,
+        cond_info_dim: int,
+        num_objectives: int = 1,
+        num_preferences: int = 0,
+        store_bck_actions: bool = False,
+        sampling: str = "uniform",
+        alpha: float = 1.0,
+        recency_half_life: float = 1000.0,
+        warmup: int = 0,
+    ):
+        """
+        Parameters
+        ----------
+        capacity: int
+            The maximum number of trajectories kept in the buffer.
+        max_traj_len: int
+            The maximum number of steps of a trajectory, longer trajectories are not stored.
+        cond_info_dim: int
+            The dimension of the conditional information encoding of each trajectory.
+        num_objectives: int
+            The number of flat rewards of each trajectory.
+        num_preferences: int
+            The dimension of each trajectory's preference vector (`cond_info["preferences"]`), 0 if
+            the task has none.
+        store_bck_actions: bool
+            If True, the backward actions of each step are stored (required when P_B is parameterized).
+        sampling: str
+            How trajectories are sampled from the buffer:
+            - "uniform": uniformly;
+            - "reward": proportionally to exp(alpha * log_reward), i.e. R^alpha;
+            - "recency": proportionally to 2^(-age / recency_half_life), where the age of a trajectory
+              is the number of trajectories added after it.
+        alpha: float
+            The prioritization exponent of "reward" sampling.
+        recency_half_life: float
+            The half-life (in number of added trajectories) of "recency" sampling.
+        warmup: int
+            The number of trajectories the buffer must contain before it can be sampled, see `can_sample`.
+        """
+        assert sampling in ["uniform", "reward", "recency"], f"Unknown replay sampling {sampling}"
+        self.capacity = capacity
+        self.max_traj_len = max_traj_len
+        self.sampling = sampling
+        self.alpha = alpha
+        self.recency_half_life = recency_half_life
+        self.warmup = warmup
+        C, L = capacity, max_traj_len
+        self.traj_lens = torch.zeros((C,), dtype=torch.long).share_memory_()
+        self.actions = torch.zeros((C, L, 3), dtype=torch.int32).share_memory_()
+        self.bck_actions = torch.zeros((C, L, 3), dtype=torch.int32).share_memory_() if store_bck_actions else None
+        self.log_p_B = torch.zeros((C, L)).share_memory_()
+        self.is_sink = torch.zeros((C, L), dtype=torch.bool).share_memory_()
+        self.cond_info = torch.zeros((C, cond_info_dim)).share_memory_()
+        self.log_rewards = torch.zeros((C,)).share_memory_()
+        self.flat_rewards = torch.zeros((C, num_objectives)).share_memory_()
+        self.preferences = torch.zeros((C, num_preferences)).share_memory_() if num_preferences else None
+        # The insertion index of each entry, and the total number of trajectories ever added
+        self.insertion_idx = torch.zeros((C,), dtype=torch.long).share_memory_()
+        self.num_added = torch.zeros((1,), dtype=torch.long).share_memory_()
+        self.lock = mp.Lock()
+
+    def __len__(self):
+        return min(int(self.num_added[0]), self.capacity)
+
+    def can_sample(self) -> bool:
+        return len(self) > 0 and len(self) >= self.warmup
+
+    def add(
+        self,
+        trajs: TrajectoryBatch,
+        cond_info: Tensor,
+        log_rewards: Tensor,
+        flat_rewards: Tensor,
+        preferences: Optional[Tensor] = None,
+    ) -> int:
+        """Adds the valid trajectories of `trajs` (that are at most `max_traj_len` long) to the buffer,
+        evicting the oldest trajectories if the buffer is full.
+
+        Parameters
+        ----------
+        trajs: TrajectoryBatch
+            N trajectories, with their `log_p_B` (and `bck_actions` if they are stored).
+        cond_info: Tensor
+            The conditional information encoding of each trajectory, shape (N, cond_info_dim).
+        log_rewards: Tensor
+            The log-reward of each trajectory, shape (N,).
+        flat_rewards: Tensor
+            The flat rewards of each trajectory, shape (N, num_objectives).
+        preferences: Optional[Tensor]
+            The preferences of each trajectory, shape (N, num_preferences), if the buffer stores them.
+
+        Returns
+        -------
+        num_added: int
+            The number of trajectories that were added.
+        """
+        keep = (trajs.is_valid & (trajs.traj_lens <= self.max_traj_len)).nonzero()[:, 0]
+        n = min(len(keep), self.capacity)
+        if n == 0:
+            return 0
+        keep = keep[-n:]
+        lens = trajs.traj_lens[keep]
+        # The steps of the kept trajectories, and the column of their slot in the buffer's rows (steps
+        # past the end of a trajectory are left as is, they are never read)
+        step_mask = torch.arange(self.max_traj_len)[None, :] < lens[:, None]
+        step_idx = (trajs.step_ptr[keep][:, None] + torch.arange(self.max_traj_len)[None, :])[step_mask]
+        col_idx = step_mask.nonzero()[:, 1]
+        with self.lock:
+            start = int(self.num_added[0])
+            rows = (start + torch.arange(n)) % self.capacity
+            row_idx = rows[:, None].expand_as(step_mask)[step_mask]
+            self.traj_lens[rows] = lens
+            self.actions[row_idx, col_idx] = trajs.actions[step_idx].int()
+            if self.bck_actions is not None:
+                self.bck_actions[row_idx, col_idx] = trajs.bck_actions[step_idx].int()
+            self.log_p_B[row_idx, col_idx] = trajs.log_p_B[step_idx].float()
+            if trajs.is_sink is not None:
+                self.is_sink[row_idx, col_idx] = trajs.is_sink[step_idx].bool()
+            else:
+                # e.g. when concatenated with offline trajectories, which have no sink information
+                self.is_sink[row_idx, col_idx] = False
+            self.cond_info[rows] = cond_info[keep].float()
+            self.log_rewards[rows] = log_rewards[keep].float()
+            self.flat_rewards[rows] = flat_rewards[keep].reshape((n, -1)).float()
+            if self.preferences is not None and preferences is not None:
+                self.preferences[rows] = preferences[keep].float()
+            self.insertion_idx[rows] = start + torch.arange(n)
+            self.num_added[0] = start + n
+        return n
+
+    def sample(self, n: int, rng: np.random.Generator) -> ReplayedTrajectories:
+        """Samples `n` trajectories (with replacement) according to `self.sampling`.
+
+        Since states are not stored, the `results` of the returned TrajectoryBatch are None, they are
+        recovered by `TrajectoryBatch.replay`.
+        """
+        with self.lock:
+            size = len(self)
+            if self.sampling == "uniform":
+                idx = rng.integers(0, size, n)
+            else:
+                if self.sampling == "reward":
+                    logits = self.alpha * self.log_rewards[:size].double()
+                else:
+                    age = self.num_added[0] - 1 - self.insertion_idx[:size]
+                    logits = -np.log(2) * age.double() / self.recency_half_life
+                p = torch.softmax(logits, 0).numpy()
+                idx = rng.choice(size, n, p=p / p.sum())
+            idx = torch.as_tensor(idx, dtype=torch.long)
+            lens = self.traj_lens[idx]
+            step_mask = torch.arange(self.max_traj_len)[None, :] < lens[:, None]
+            replayed = ReplayedTrajectories(
+                trajs=TrajectoryBatch(
+                    traj_lens=lens,
+                    actions=self.actions[idx][step_mask].long(),
+                    results=[None] * n,
+                    log_p_B=self.log_p_B[idx][step_mask],
+                    bck_actions=self.bck_actions[idx][step_mask].long() if self.bck_actions is not None else None,
+                    is_sink=self.is_sink[idx][step_mask].long(),
+                    infos=[{"replayed": True} for _ in range(n)],
+                ),
+                cond_info=self.cond_info[idx],
+                log_rewards=self.log_rewards[idx],
+                flat_rewards=self.flat_rewards[idx],
+                preferences=self.preferences[idx] if self.preferences is not None else None,
+            )
+        return replayed
+
+    def _storage(self) -> Dict[str, Tensor]:
+        names = ["traj_lens", "actions", "bck_actions", "log_p_B", "is_sink", "cond_info", "log_rewards"]
+        names += ["flat_rewards", "preferences", "insertion_idx", "num_added"]
+        return {k: getattr(self, k) for k in names if getattr(self, k) is not None}
+
+    def state_dict(self) -> Dict[str, Tensor]:
+        """The contents of the buffer (views of its shared memory, which must be copied to be kept)"""
+        return self._storage()
+
+    def load_state_dict(self, state: Dict[str, Tensor]):
+        """Copies the contents of a buffer with the same shapes into this buffer, in place, so that the
+        workers see them"""
+        storage = self._storage()
+        if storage.keys() != state.keys() or any(v.shape != state[k].shape for k, v in storage.items()):
+            raise ValueError("The saved replay buffer doesn't have the capacity or shapes of this one")
+        with self.lock:
+            for k, v in storage.items():
+                v.copy_(state[k])
@@ -1,7 +1,11 @@
+import multiprocessing.util
 import os
+import queue
 import sqlite3
+import threading
+import time
 from collections.abc import Iterable
-from typing import Callable, List
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import networkx as nx
 import numpy as np
@@ -10,6 +14,13 @@ import torch.nn as nn
 from rdkit import Chem, RDLogger
 from torch.utils.data import Dataset, IterableDataset
 
+from gflownet.data.log_sinks import LogSink, ParquetLog
+from gflownet.data.packed_batch import PackedBatch
+from gflownet.data.replay_buffer import ReplayBuffer
+from gflownet.utils.checkpoint import get_rng_state, set_rng_state
+from gflownet.utils.profiling import WorkerCProfiler
+from gflownet.utils.timing import timers
+
 
 class SamplingIterator(IterableDataset):
     """This class allows us to parallelise and train faster.
@@ -35,6 +46,15 @@ class SamplingIterator(IterableDataset):
         log_dir: str = None,
         sample_cond_info=True,
         random_action_prob=0.0,
+        pack_batches=False,
+        log_write_behind=False,
+        log_format="sqlite",
+        timers_enabled=False,
+        cprofile_window: Optional[Tuple[int, int]] = None,
+        cprofile_dir: str = None,
+        replay_buffer: Optional[ReplayBuffer] = None,
+        replay_ratio: float = 0.0,
+        rng_states: Optional[Dict[int, Dict[str, Any]]] = None,
     ):
         """Parameters
         ----------
@@ -59,6 +79,33 @@ class SamplingIterator(IterableDataset):
         sample_cond_info: bool
             If True (default), then the dataset is a dataset of points used in offline training.
             If False, then the dataset is a dataset of preferences (e.g. used to validate the model)
+        random_action_prob: float
+            The probability of taking a uniformly random action when sampling.
+        pack_batches: bool
+            If True, yields PackedBatch instances rather than gd.Batch instances, see PackedBatch.
+        log_write_behind: bool
+            If True, generated molecules are written to the log by a background thread, see SQLiteLog.
+        log_format: str
+            The format of the logs, "sqlite" (see SQLiteLog) or "parquet" (see ParquetLog).
+        timers_enabled: bool
+            If True, the time spent in each stage of sampling (see gflownet.utils.timing) is added to
+            each batch's `extra_info`.
+        cprofile_window: Optional[Tuple[int, int]]
+            If not None, the [start, end) indices of the batches (in the order the DataLoader yields
+            them) during which each worker runs cProfile, see WorkerCProfiler.
+        cprofile_dir: str
+            Where the cProfile stats of each worker are written.
+        replay_buffer: Optional[ReplayBuffer]
+            If not None, the valid on-policy trajectories are added to this buffer, shared by all
+            workers, and replayed in later batches.
+        replay_ratio: float
+            The ratio of on-policy trajectories in the batch that are replayed from `replay_buffer`
+            (once it can be sampled) rather than freshly sampled, each replayed trajectory saves a
+            reward computation.
+        rng_states: Optional[Dict[int, Dict[str, Any]]]
+            If not None, the state of the random number generators of each worker (by worker id, 0 without
+            workers) to resume sampling from, as recorded in the `rng_state` of the batches it yields (see
+            gflownet.utils.checkpoint). Workers without a state are seeded as usual.
 
         """
         self.data = dataset
@@ -75,6 +122,7 @@ class SamplingIterator(IterableDataset):
         self.sample_online_once = True  # TODO: deprecate this, disallow len(data) == 0 entirely
         self.sample_cond_info = sample_cond_info
         self.random_action_prob = random_action_prob
+        self.pack_batches = pack_batches
         self.log_molecule_smis = not hasattr(self.ctx, "not_a_molecule_env")  # TODO: make this a proper flag
         if not sample_cond_info:
             # Slightly weird semantics, but if we're sampling x given some fixed (data) cond info
@@ -86,8 +134,22 @@ class SamplingIterator(IterableDataset):
         # don't want to initialize per-worker things just yet, such as where the log the worker writes
         # to. This must be done in __iter__, which is called by the DataLoader once this instance
         # has been copied into a new python process.
-        self.log = SQLiteLog()
+        self.log: LogSink
+        if log_format == "sqlite":
+            self.log = SQLiteLog(write_behind=log_write_behind)
+        elif log_format == "parquet":
+            self.log = ParquetLog()
+        else:
+            raise ValueError(f"Unknown log format {log_format}")
         self.log_hooks: List[Callable] = []
+        self.timers_enabled = timers_enabled
+        self.cprofile_window = cprofile_window
+        self.cprofile_dir = cprofile_dir
+        self.replay_buffer = replay_buffer
+        self.rng_states = rng_states
+        self.replay_batch_size = (
+            int(np.round(self.online_batch_size * replay_ratio)) if replay_buffer is not None else 0
+        )
 
     def add_log_hook(self, hook: Callable):
         self.log_hooks.append(hook)
@@ -132,18 +194,38 @@ class SamplingIterator(IterableDataset):
         self._wid = worker_info.id if worker_info is not None else 0
         # Now that we know we are in a worker instance, we can initialize per-worker things
         self.rng = self.algo.rng = self.task.rng = np.random.default_rng(142857 + self._wid)
+        if self.rng_states is not None and self._wid in self.rng_states:
+            self._set_rng_state(self.rng_states[self._wid], worker_info is not None)
+            # Only resumed once, later epochs (of finite datasets) start over
+            self.rng_states = None
         self.ctx.device = self.device
+        timers.enabled = self.timers_enabled
         if self.log_dir is not None:
             os.makedirs(self.log_dir, exist_ok=True)
-            self.log_path = f"{self.log_dir}/generated_mols_{self._wid}.db"
+            self.log_path = f"{self.log_dir}/generated_mols_{self._wid}{self.log.file_extension}"
             self.log.connect(self.log_path)
 
-        for idcs in self._idx_iterator():
+        cprofiler = None
+        if self.cprofile_window is not None:
+            num_workers = worker_info.num_workers if worker_info is not None else 1
+            cprofiler = WorkerCProfiler(self.cprofile_window, self.cprofile_dir, self._wid, num_workers)
+
+        for batch_idx, idcs in enumerate(self._idx_iterator()):
+            if cprofiler is not None:
+                cprofiler.step(batch_idx)
             num_offline = idcs.shape[0]  # This is in [0, self.offline_batch_size]
+            num_replayed = 0
+            if self.replay_batch_size > 0 and self.sample_cond_info and self.replay_buffer.can_sample():
+                # Replayed trajectories take the place of some of the on-policy trajectories
+                num_replayed = self.replay_batch_size
+                with timers("replay_sample"):
+                    replayed = self.replay_buffer.sample(num_replayed, self.rng)
             # Sample conditional info such as temperature, trade-off weights, etc.
 
             if self.sample_cond_info:
-                cond_info = self.task.sample_conditional_information(num_offline + self.online_batch_size)
+                cond_info = self.task.sample_conditional_information(
+                    num_offline + self.online_batch_size - num_replayed
+                )
                 # Sample some dataset data
                 mols, flat_rewards = map(list, zip(*[self.data[i] for i in idcs])) if len(idcs) else ([], [])
                 # flat_rewards = (
@@ -152,18 +234,22 @@ class SamplingIterator(IterableDataset):
                 # graphs = [self.ctx.mol_to_graph(m) for m in mols]
                 graphs = mols
                 # graphs = [self.ctx.mol_to_graph(m) for m in mols] if (len(mols) == 0 or type(mols[0]) is not nx.classes.graph.Graph) else mols
-                trajs = self.algo.create_training_data_from_graphs(graphs)
-                num_online = self.online_batch_size
+                if hasattr(self.data, "sample_trajectories"):
+                    # The trajectories were precomputed, see data/offline_trajectories.py
+                    trajs = self.data.sample_trajectories(idcs, graphs, self.rng)
+                else:
+                    trajs = self.algo.create_training_data_from_graphs(graphs)
+                num_online = self.online_batch_size - num_replayed
             else:  # If we're not sampling the conditionals, then the idcs refer to listed preferences
                 num_online = num_offline
                 num_offline = 0
                 cond_info = self.task.encode_conditional_information(torch.stack([self.data[i] for i in idcs]))
-                trajs, flat_rewards = [], []
+                trajs, flat_rewards = self.algo.create_training_data_from_graphs([]), []
 
             is_valid = torch.ones(num_offline + num_online).bool()
             # Sample some on-policy data
             if num_online > 0:
-                with torch.no_grad():
+                with torch.no_grad(), timers("sample"):
                     trajs += self.algo.create_training_data_from_own_samples(
                         self.model,
                         num_online,
@@ -173,17 +259,16 @@ class SamplingIterator(IterableDataset):
                 if self.algo.bootstrap_own_reward:
                     # The model can be trained to predict its own reward,
                     # i.e. predict the output of cond_info_to_logreward
-                    pred_reward = [i["reward_pred"].cpu().item() for i in trajs[num_offline:]]
-                    flat_rewards += pred_reward
+                    pred_reward = trajs.reward_pred[num_offline:].cpu()
+                    flat_rewards += list(pred_reward)
                 else:
                     # Otherwise, query the task for flat rewards
-                    valid_idcs = torch.tensor(
-                        [i + num_offline for i in range(num_online) if trajs[i + num_offline]["is_valid"]]
-                    ).long()
+                    valid_idcs = trajs.is_valid[num_offline:].nonzero()[:, 0] + num_offline
                     # fetch the valid trajectories endpoints
-                    mols = [self.ctx.graph_to_mol(trajs[i]["result"]) for i in valid_idcs]
+                    mols = [self.ctx.graph_to_mol(trajs.results[i]) for i in valid_idcs]
                     # ask the task to compute their reward
-                    preds, m_is_valid = self.task.compute_flat_rewards(mols)
+                    with timers("compute_flat_rewards"):
+                        preds, m_is_valid = self.task.compute_flat_rewards(mols)
                     assert preds.ndim == 2, "FlatRewards should be (mbsize, n_objectives), even if n_objectives is 1"
                     # The task may decide some of the mols are invalid, we have to again filter those
                     valid_idcs = valid_idcs[m_is_valid]
@@ -197,29 +282,50 @@ class SamplingIterator(IterableDataset):
                     is_valid[num_offline:] = False
                     is_valid[valid_idcs] = True
                     flat_rewards += list(pred_reward)
-                    # Override the is_valid key in case the task made some mols invalid
-                    for i in range(num_online):
-                        trajs[num_offline + i]["is_valid"] = is_valid[num_offline + i].item()
+                    # Override is_valid in case the task made some mols invalid
+                    trajs.is_valid[num_offline:] = is_valid[num_offline:]
                     if self.log_molecule_smis:
-                        for i, m in zip(valid_idcs, valid_mols):
-                            trajs[i]["smi"] = Chem.MolToSmiles(m)
+                        for i, m in zip(valid_idcs.tolist(), valid_mols):
+                            trajs.infos[i]["smi"] = Chem.MolToSmiles(m)
             flat_rewards = torch.stack(flat_rewards)
             # Compute scalar rewards from conditional information & flat rewards
             log_rewards = self.task.cond_info_to_logreward(cond_info, flat_rewards)
             log_rewards[torch.logical_not(is_valid)] = self.algo.illegal_action_logreward
+            batch_trajs, batch_cond_info, batch_log_rewards = trajs, cond_info["encoding"], log_rewards
+            batch_flat_rewards, batch_preferences = flat_rewards, cond_info.get("preferences", None)
+            if num_replayed > 0:
+                # Replayed trajectories come last, after the offline and on-policy trajectories
+                batch_trajs = trajs + replayed.trajs
+                batch_cond_info = torch.cat([batch_cond_info, replayed.cond_info])
+                batch_log_rewards = torch.cat([batch_log_rewards, replayed.log_rewards])
+                batch_flat_rewards = torch.cat([batch_flat_rewards, replayed.flat_rewards])
+                if batch_preferences is not None:
+                    batch_preferences = torch.cat([batch_preferences, replayed.preferences])
+            if self.replay_buffer is not None and num_online > 0 and self.sample_cond_info:
+                preferences = cond_info.get("preferences", None)
+                with timers("replay_add"):
+                    self.replay_buffer.add(
+                        trajs[num_offline:],
+                        cond_info["encoding"][num_offline:],
+                        log_rewards[num_offline:],
+                        flat_rewards[num_offline:],
+                        preferences[num_offline:] if preferences is not None else None,
+                    )
             # Construct batch
-            batch = self.algo.construct_batch(trajs, cond_info["encoding"], log_rewards)
+            with timers("construct_batch"):
+                batch = self.algo.construct_batch(batch_trajs, batch_cond_info, batch_log_rewards)
             batch.num_offline = num_offline
             batch.num_online = num_online
-            batch.flat_rewards = flat_rewards
+            batch.num_replayed = num_replayed
+            batch.flat_rewards = batch_flat_rewards
             batch.mols = mols
-            batch.preferences = cond_info.get("preferences", None)
+            batch.preferences = batch_preferences
             # TODO: we could very well just pass the cond_info dict to construct_batch above,
             # and the algo can decide what it wants to put in the batch object
 
             if not self.sample_cond_info:
                 # If we're using a dataset of preferences, the user may want to know the id of the preference
-                for i, j in zip(trajs, idcs):
+                for i, j in zip(trajs.infos, idcs):
                     i["data_idx"] = j
 
             # Converts back into natural rewards for logging purposes
@@ -228,59 +334,110 @@ class SamplingIterator(IterableDataset):
             rewards = torch.exp(log_rewards / cond_info["beta"])
 
             if num_online > 0 and self.log_dir is not None:
-                self.log_generated(
-                    trajs[num_offline:],
-                    rewards[num_offline:],
-                    flat_rewards[num_offline:],
-                    {k: v[num_offline:] for k, v in cond_info.items()},
-                )
+                with timers("log_generated"):
+                    self.log_generated(
+                        trajs[num_offline:],
+                        rewards[num_offline:],
+                        flat_rewards[num_offline:],
+                        {k: v[num_offline:] for k, v in cond_info.items()},
+                    )
             if num_online > 0:
                 extra_info = {}
-                for hook in self.log_hooks:
-                    extra_info.update(
-                        hook(
-                            trajs[num_offline:],
-                            rewards[num_offline:],
-                            flat_rewards[num_offline:],
-                            {k: v[num_offline:] for k, v in cond_info.items()},
+                with timers("log_hooks"):
+                    for hook in self.log_hooks:
+                        extra_info.update(
+                            hook(
+                                trajs[num_offline:],
+                                rewards[num_offline:],
+                                flat_rewards[num_offline:],
+                                {k: v[num_offline:] for k, v in cond_info.items()},
+                            )
                         )
-                    )
+                if self.replay_buffer is not None:
+                    extra_info["replay_buffer_size"] = len(self.replay_buffer)
                 batch.extra_info = extra_info
-            yield batch
+            if self.timers_enabled:
+                # Timings of this worker are sent along with the batch, see GFNTrainer.train_batch
+                batch.extra_info = {**getattr(batch, "extra_info", {}), **timers.pop()}
+            # The state from which this worker samples its next batch, see GFNTrainer.state_dict
+            batch.rng_state = {"worker": self._wid, **self._get_rng_state(worker_info is not None)}
+            yield PackedBatch.from_batch(batch) if self.pack_batches else batch
+        if self.log_dir is not None:
+            self.log.close()
+        if cprofiler is not None:
+            cprofiler.close()
+
+    def _generators(self) -> Dict[str, np.random.Generator]:
+        generators = {"iterator": self.rng, "algo": self.algo.rng, "task": self.task.rng}
+        if hasattr(self.algo, "graph_sampler"):
+            generators["graph_sampler"] = self.algo.graph_sampler.rng
+        return generators
+
+    def _get_rng_state(self, in_worker: bool) -> Dict[str, Any]:
+        # The process-wide generators of the main process are checkpointed by the trainer itself
+        return get_rng_state(self._generators(), process=in_worker)
+
+    def _set_rng_state(self, state: Dict[str, Any], in_worker: bool):
+        if not in_worker:
+            state = {k: v for k, v in state.items() if k in ["generators", "names"]}
+        generators = set_rng_state(state)
+        self.rng, self.algo.rng, self.task.rng = generators["iterator"], generators["algo"], generators["task"]
+        if "graph_sampler" in generators:
+            self.algo.graph_sampler.rng = generators["graph_sampler"]
 
     def log_generated(self, trajs, rewards, flat_rewards, cond_info):
         if self.log_molecule_smis:
             mols = [
-                Chem.MolToSmiles(self.ctx.graph_to_mol(trajs[i]["result"])) if trajs[i]["is_valid"] else ""
-                for i in range(len(trajs))
+                Chem.MolToSmiles(self.ctx.graph_to_mol(g)) if is_valid else ""
+                for g, is_valid in zip(trajs.results, trajs.is_valid.tolist())
             ]
         else:
-            mols = [nx.algorithms.graph_hashing.weisfeiler_lehman_graph_hash(t["result"], None, "v") for t in trajs]
+            mols = [nx.algorithms.graph_hashing.weisfeiler_lehman_graph_hash(g, None, "v") for g in trajs.results]
 
-        flat_rewards = flat_rewards.reshape((len(flat_rewards), -1)).data.numpy().tolist()
-        rewards = rewards.data.numpy().tolist()
-        preferences = cond_info.get("preferences", torch.zeros((len(mols), 0))).data.numpy().tolist()
+        # Columns are kept as numpy arrays, sinks that need rows (e.g. SQLiteLog) convert them
+        columns = {"smi": mols, "r": rewards.data.numpy()}
+        flat_rewards = flat_rewards.reshape((len(flat_rewards), -1)).data.numpy()
+        columns.update({f"fr_{i}": flat_rewards[:, i] for i in range(flat_rewards.shape[1])})
+        preferences = cond_info.get("preferences", torch.zeros((len(mols), 0))).data.numpy()
+        columns.update({f"pref_{i}": preferences[:, i] for i in range(preferences.shape[1])})
         logged_keys = [k for k in sorted(cond_info.keys()) if k not in ["encoding", "preferences"]]
+        # Conditional information can be either tensors or numpy arrays (e.g. the sampled temperatures)
+        columns.update({f"ci_{k}": np.asarray(cond_info[k]).reshape(len(mols)) for k in logged_keys})
+        self.log.insert_columns(columns)
 
-        data = [
-            [mols[i], rewards[i]] + flat_rewards[i] + preferences[i] + [cond_info[k][i].item() for k in logged_keys]
-            for i in range(len(trajs))
-        ]
-        data_labels = (
-            ["smi", "r"]
-            + [f"fr_{i}" for i in range(len(flat_rewards[0]))]
-            + [f"pref_{i}" for i in range(len(preferences[0]))]
-            + [f"ci_{k}" for k in logged_keys]
-        )
-        self.log.insert_many(data, data_labels)
 
+class SQLiteLog(LogSink):
+    file_extension = ".db"
+
+    def __init__(self, timeout=300, write_behind=False, commit_every=1000, commit_interval=10.0, max_queued=64):
+        """Creates a log instance, but does not connect it to any db.
 
-class SQLiteLog:
-    def __init__(self, timeout=300):
-        """Creates a log instance, but does not connect it to any db."""
+        Parameters
+        ----------
+        timeout: float
+            How long to wait (in seconds) for the database lock.
+        write_behind: bool
+            If True, `insert_many` only queues rows, which are written by a background thread that
+            commits every `commit_every` rows or `commit_interval` seconds, whichever comes first. The
+            database then uses WAL journaling and `synchronous=NORMAL`. Otherwise rows are written and
+            committed synchronously.
+        commit_every: int
+            Write-behind mode only, the number of rows after which to commit.
+        commit_interval: float
+            Write-behind mode only, the maximum time (in seconds) rows are left uncommitted.
+        max_queued: int
+            Write-behind mode only, the maximum number of `insert_many` calls waiting to be written,
+            after which `insert_many` blocks.
+        """
         self.is_connected = False
         self.db = None
         self.timeout = timeout
+        self.write_behind = write_behind
+        self.commit_every = commit_every
+        self.commit_interval = commit_interval
+        self.max_queued = max_queued
+        self._thread = None
+        self._error = None
 
     def connect(self, db_path: str):
         """Connects to db_path
@@ -290,7 +447,24 @@ class SQLiteLog:
         db_path: str
             The sqlite3 database path. If it does not exist, it will be created.
         """
+        if self.is_connected:
+            self.close()
+        if self.write_behind:
+            # The connection is created and used only by the writer thread
+            self._queue: queue.Queue = queue.Queue(maxsize=self.max_queued)
+            self._thread = threading.Thread(target=self._write_behind_loop, args=(db_path,), daemon=True)
+            self._thread.start()
+            # Flush when the process exits, including DataLoader workers, which don't run atexit hooks
+            self._finalizer = multiprocessing.util.Finalize(self, self.close, exitpriority=10)
+        else:
+            self._open(db_path)
+        self.is_connected = True
+
+    def _open(self, db_path: str):
         self.db = sqlite3.connect(db_path, timeout=self.timeout)
+        if self.write_behind:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
         cur = self.db.cursor()
         self._has_results_table = len(
             cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='results'").fetchall()
@@ -305,11 +479,72 @@ class SQLiteLog:
         self._has_results_table = True
         cur.close()
 
-    def insert_many(self, rows, column_names):
-        assert all([type(x) is str or not isinstance(x, Iterable) for x in rows[0]]), "rows must only contain scalars"
+    def _insert(self, rows, column_names):
         if not self._has_results_table:
             self._make_results_table([type(i) for i in rows[0]], column_names)
         cur = self.db.cursor()
         cur.executemany(f'insert into results values ({",".join("?"*len(rows[0]))})', rows)  # nosec
         cur.close()
-        self.db.commit()
+
+    def insert_many(self, rows, column_names):
+        assert all([type(x) is str or not isinstance(x, Iterable) for x in rows[0]]), "rows must only contain scalars"
+        if not self.write_behind:
+            self._insert(rows, column_names)
+            self.db.commit()
+            return
+        if self._error is not None:
+            raise self._error
+        self._queue.put((rows, column_names))
+
+    def insert_columns(self, columns):
+        rows = list(zip(*[v if isinstance(v, list) else v.tolist() for v in columns.values()]))
+        self.insert_many(rows, list(columns.keys()))
+
+    def _write_behind_loop(self, db_path: str):
+        try:
+            self._open(db_path)
+            num_uncommitted = 0
+            last_commit = time.monotonic()
+            while True:
+                try:
+                    item = self._queue.get(timeout=max(0.0, last_commit + self.commit_interval - time.monotonic()))
+                except queue.Empty:
+                    item = ()
+                if item is None:
+                    break
+                if len(item):
+                    self._insert(*item)
+                    num_uncommitted += len(item[0])
+                if num_uncommitted and (
+                    num_uncommitted >= self.commit_every or time.monotonic() - last_commit >= self.commit_interval
+                ):
+                    self.db.commit()
+                    num_uncommitted = 0
+                    last_commit = time.monotonic()
+                elif not num_uncommitted:
+                    last_commit = time.monotonic()
+            self.db.commit()
+        except Exception as e:
+            self._error = e
+            # Keep consuming so that producers don't block forever on a full queue
+            while self._queue.get() is not None:
+                pass
+        finally:
+            if self.db is not None:
+                self.db.close()
+
+    def close(self):
+        """Writes all pending rows, commits, and closes the connection."""
+        if not self.is_connected:
+            return
+        self.is_connected = False
+        if self.write_behind:
+            self._finalizer.cancel()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self._error is not None:
+                raise self._error
+        else:
+            self.db.close()
+        self.db = None
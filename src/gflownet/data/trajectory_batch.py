@@ -0,0 +1,247 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+import torch_geometric.data as gd
+from torch import Tensor
+
+from gflownet.envs.graph_building_env import (
+    Graph,
+    GraphAction,
+    GraphActionType,
+    GraphBuildingEnv,
+    GraphBuildingEnvContext,
+)
+
+
+def _cat_optional(tensors: List[Optional[Tensor]]) -> Optional[Tensor]:
+    if any(i is None for i in tensors):
+        return None
+    return torch.cat(tensors, 0)
+
+
+class TrajectoryBatch:
+    """A batch of trajectories stored as flat arrays (struct-of-arrays).
+
+    Rather than keeping a list of `(Graph, GraphAction)` tuples per trajectory, every per-step
+    quantity of every trajectory is concatenated into a single tensor (or list), trajectory after
+    trajectory, and `traj_lens` says how many steps belong to each trajectory. Actions are stored
+    as the `(action_type, row, col)` indices of a GraphActionCategorical. Apart from the final graph
+    of each trajectory, states are not stored; they are implicitly defined by the actions, and are
+    recovered with `replay` when a training batch is constructed (unless `states` are given, e.g. for
+    precomputed offline trajectories).
+    """
+
+    def __init__(
+        self,
+        traj_lens: Tensor,
+        actions: Tensor,
+        results: List[Optional[Graph]],
+        is_valid: Optional[Tensor] = None,
+        log_p_F: Optional[Tensor] = None,
+        log_p_B: Optional[Tensor] = None,
+        bck_actions: Optional[Tensor] = None,
+        is_sink: Optional[Tensor] = None,
+        logZ: Optional[Tensor] = None,
+        reward_pred: Optional[Tensor] = None,
+        infos: Optional[List[Dict[str, Any]]] = None,
+        states: Optional[List[Optional[gd.Data]]] = None,
+    ):
+        """
+        Parameters
+        ----------
+        traj_lens: Tensor
+            The number of steps of each trajectory, shape (N,). We refer to the sum of traj_lens as T.
+        actions: Tensor
+            The action index taken at each step, shape (T, 3).
+        results: List[Graph]
+            The final graph of each trajectory, len N. Results can be None (e.g. for trajectories
+            sampled from a ReplayBuffer), in which case they are recovered by `replay`.
+        is_valid: Optional[Tensor]
+            Whether each trajectory is valid, shape (N,). Defaults to all True.
+        log_p_F: Optional[Tensor]
+            The log-probability of each step under the sampling policy, shape (T,).
+        log_p_B: Optional[Tensor]
+            The log-probability of each step under the (fixed) backward policy, shape (T,).
+        bck_actions: Optional[Tensor]
+            The backward action index of each step, shape (T, 3), see `GraphSampler`.
+        is_sink: Optional[Tensor]
+            Whether each step is a sink (i.e. terminal) step, shape (T,).
+        logZ: Optional[Tensor]
+            The logZ prediction of each trajectory, shape (N,).
+        reward_pred: Optional[Tensor]
+            The predicted reward of each trajectory, shape (N,).
+        infos: Optional[List[Dict[str, Any]]]
+            Extra per-trajectory information, e.g. SMILES strings or dataset indices, len N.
+        states: Optional[List[Optional[gd.Data]]]
+            The Data instance of the state of each step (as given by `ctx.graph_to_Data`), len T. Missing
+            (None) states are recomputed by `replay`.
+        """
+        self.traj_lens = traj_lens
+        self.actions = actions
+        self.results = results
+        self.is_valid = is_valid if is_valid is not None else torch.ones(len(results), dtype=torch.bool)
+        self.log_p_F = log_p_F
+        self.log_p_B = log_p_B
+        self.bck_actions = bck_actions
+        self.is_sink = is_sink
+        self.logZ = logZ
+        self.reward_pred = reward_pred
+        self.infos = infos if infos is not None else [{} for _ in results]
+        self.states = states
+
+    @classmethod
+    def from_graph_trajectories(
+        cls,
+        trajs: List[List[Tuple[Graph, GraphAction]]],
+        ctx: GraphBuildingEnvContext,
+        log_p_B: Optional[List[Tensor]] = None,
+    ) -> "TrajectoryBatch":
+        """Converts trajectories of `(Graph, GraphAction)` pairs, as e.g. returned by
+        `generate_forward_trajectory`, into a TrajectoryBatch.
+
+        Parameters
+        ----------
+        trajs: List[List[Tuple[Graph, GraphAction]]]
+            A list of N trajectories, the last graph of each trajectory is taken to be its result.
+        ctx: GraphBuildingEnvContext
+            The context used to convert graphs and actions.
+        log_p_B: Optional[List[Tensor]]
+            If not None, the log-probabilities of the backward policy for each trajectory.
+
+        Returns
+        -------
+        trajs: TrajectoryBatch
+            The batch of trajectories.
+        """
+        actions = [ctx.GraphAction_to_aidx(ctx.graph_to_Data(g), a) for tj in trajs for g, a in tj]
+        return cls(
+            traj_lens=torch.tensor([len(tj) for tj in trajs], dtype=torch.long),
+            actions=torch.tensor(actions, dtype=torch.long).reshape((-1, 3)),
+            results=[tj[-1][0] for tj in trajs],
+            log_p_B=(torch.cat(log_p_B) if len(log_p_B) else torch.zeros(0)) if log_p_B is not None else None,
+        )
+
+    @classmethod
+    def cat(cls, batches: List["TrajectoryBatch"]) -> "TrajectoryBatch":
+        """Concatenates trajectory batches. Optional fields are kept only if all (non-empty) batches have them,
+        except for `states`, which are None for the steps of batches that don't have them."""
+        batches = [i for i in batches if len(i)] or batches[:1]
+        has_states = any(i.states is not None for i in batches)
+        return cls(
+            traj_lens=torch.cat([i.traj_lens for i in batches]),
+            actions=torch.cat([i.actions for i in batches]),
+            results=sum([i.results for i in batches], []),
+            is_valid=torch.cat([i.is_valid for i in batches]),
+            log_p_F=_cat_optional([i.log_p_F for i in batches]),
+            log_p_B=_cat_optional([i.log_p_B for i in batches]),
+            bck_actions=_cat_optional([i.bck_actions for i in batches]),
+            is_sink=_cat_optional([i.is_sink for i in batches]),
+            logZ=_cat_optional([i.logZ for i in batches]),
+            reward_pred=_cat_optional([i.reward_pred for i in batches]),
+            infos=sum([i.infos for i in batches], []),
+            states=sum([i.states or [None] * i.num_steps for i in batches], []) if has_states else None,
+        )
+
+    def __add__(self, other: "TrajectoryBatch") -> "TrajectoryBatch":
+        return TrajectoryBatch.cat([self, other])
+
+    def __len__(self):
+        return len(self.results)
+
+    @property
+    def num_steps(self) -> int:
+        return self.actions.shape[0]
+
+    @property
+    def step_ptr(self) -> Tensor:
+        """The index of the first step of each trajectory, followed by the total number of steps, shape (N + 1,)"""
+        ptr = torch.zeros(len(self) + 1, dtype=torch.long)
+        torch.cumsum(self.traj_lens, 0, out=ptr[1:])
+        return ptr
+
+    def __getitem__(self, idx: slice) -> "TrajectoryBatch":
+        """Returns the trajectories in the range `idx`. Tensors of the new batch are views of this
+        batch's tensors, and the info dicts are shared, so in-place modifications are reflected in
+        this batch."""
+        if not isinstance(idx, slice):
+            raise TypeError(f"TrajectoryBatch can only be indexed with slices, got {type(idx)}")
+        start, stop, stride = idx.indices(len(self))
+        assert stride == 1, "TrajectoryBatch does not support strided slices"
+        ptr = self.step_ptr
+        s, e = int(ptr[start]), int(ptr[max(start, stop)])
+
+        def per_traj(x):
+            return x[start:stop] if x is not None else None
+
+        def per_step(x):
+            return x[s:e] if x is not None else None
+
+        return TrajectoryBatch(
+            traj_lens=per_traj(self.traj_lens),
+            actions=per_step(self.actions),
+            results=per_traj(self.results),
+            is_valid=per_traj(self.is_valid),
+            log_p_F=per_step(self.log_p_F),
+            log_p_B=per_step(self.log_p_B),
+            bck_actions=per_step(self.bck_actions),
+            is_sink=per_step(self.is_sink),
+            logZ=per_traj(self.logZ),
+            reward_pred=per_traj(self.reward_pred),
+            infos=per_traj(self.infos),
+            states=per_step(self.states),
+        )
+
+    def replay(
+        self, env: GraphBuildingEnv, ctx: GraphBuildingEnvContext
+    ) -> Tuple[List[Graph], List[gd.Data], List[GraphAction], List[GraphAction]]:
+        """Recovers the states and GraphActions of every step by replaying the trajectories' actions.
+        Missing (None) results are filled in, assuming the trajectories are valid. The Data instances
+        of `self.states` are reused rather than recomputed.
+
+        Parameters
+        ----------
+        env: GraphBuildingEnv
+            The environment in which the trajectories were generated.
+        ctx: GraphBuildingEnvContext
+            The context in which the trajectories were generated.
+
+        Returns
+        -------
+        graphs: List[Graph]
+            The graph of the state of each step, len T.
+        torch_graphs: List[gd.Data]
+            The Data instance of the state of each step (as given by `ctx.graph_to_Data`), len T.
+        actions: List[GraphAction]
+            The forward action taken at each step, len T.
+        bck_actions: List[GraphAction]
+            The backward action leading back to the previous state at each step, len T. For the
+            first step of each trajectory this is a Stop action.
+        """
+        graphs, torch_graphs, actions, bck_actions = [], [], [], []
+        ptr = self.step_ptr.tolist()
+        aidx = self.actions.tolist()
+        is_sink = self.is_sink.tolist() if self.is_sink is not None else [0] * len(aidx)
+        states = self.states if self.states is not None else [None] * len(aidx)
+        for i in range(len(self)):
+            g = env.new()
+            bck_a = GraphAction(GraphActionType.Stop)
+            for t in range(ptr[i], ptr[i + 1]):
+                gd = states[t] if states[t] is not None else ctx.graph_to_Data(g)
+                a = ctx.aidx_to_GraphAction(gd, aidx[t])
+                graphs.append(g)
+                torch_graphs.append(gd)
+                actions.append(a)
+                bck_actions.append(bck_a)
+                if t == ptr[i + 1] - 1:
+                    if self.results[i] is None:
+                        # The result is the last state, or the state the last action leads to
+                        self.results[i] = g if a.action is GraphActionType.Stop else env.step(g, a)
+                    break
+                bck_a = env.reverse(g, a)
+                # A sink step can only be followed by a padding state, which is the trajectory's result
+                # (a sink step's action is Stop, so this is also the current state)
+                if is_sink[t]:
+                    g = self.results[i] if self.results[i] is not None else g
+                else:
+                    g = env.step(g, a)
+        return graphs, torch_graphs, actions, bck_actions
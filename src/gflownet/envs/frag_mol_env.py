@@ -6,7 +6,14 @@ import rdkit.Chem as Chem
 import torch
 import torch_geometric.data as gd
 
-from gflownet.envs.graph_building_env import Graph, GraphAction, GraphActionType, GraphBuildingEnvContext
+from gflownet.envs.graph_building_env import (
+    Graph,
+    GraphAction,
+    GraphActionType,
+    GraphBuildingEnvContext,
+    augment_virtual_nodes,
+    fast_collate,
+)
 from gflownet.models import bengio2021flow
 
 
@@ -267,9 +274,9 @@ class FragMolBuildingEnvContext(GraphBuildingEnvContext):
 
         Returns
         batch: gd.Batch
-            A torch_geometric Batch object
+            A torch_geometric Batch object, with the virtual node structure of `augment_virtual_nodes`
         """
-        return gd.Batch.from_data_list(graphs, follow_batch=["edge_index"])
+        return augment_virtual_nodes(fast_collate(graphs, follow_batch=["edge_index"]))
 
     def mol_to_graph(self, mol):
         """Convert an RDMol to a Graph"""
@@ -1,6 +1,5 @@
 from typing import List, Tuple
 
-import networkx as nx
 import numpy as np
 import rdkit.Chem as Chem
 import torch
@@ -8,7 +7,14 @@ import torch_geometric.data as gd
 from rdkit.Chem import Mol
 from rdkit.Chem.rdchem import BondType, ChiralType
 
-from gflownet.envs.graph_building_env import Graph, GraphAction, GraphActionType, GraphBuildingEnvContext
+from gflownet.envs.graph_building_env import (
+    Graph,
+    GraphAction,
+    GraphActionType,
+    GraphBuildingEnvContext,
+    augment_virtual_nodes,
+    fast_collate,
+)
 from gflownet.utils.graphs import random_walk_probs
 
 DEFAULT_CHIRAL_TYPES = [ChiralType.CHI_UNSPECIFIED, ChiralType.CHI_TETRAHEDRAL_CW, ChiralType.CHI_TETRAHEDRAL_CCW]
@@ -124,6 +130,26 @@ class MolBuildingEnvContext(GraphBuildingEnvContext):
             "*": 0,  # wildcard atoms have 0 valence until filled in
         }
 
+        # graph_to_Data works on small integer codes rather than on attribute values, these are the
+        # value -> code maps (the code being the index in *_attr_values, 0 being the default) as well
+        # as the per-code lookup tables used to compute valences
+        self._atom_attr_idx = {k: i for i, k in enumerate(self.atom_attrs)}
+        self._atom_attr_codes = {k: {v: i for i, v in enumerate(self.atom_attr_values[k])} for k in self.atom_attrs}
+        self._atom_attr_offsets = np.int64(self.atom_attr_slice[:-1])
+        self._negative_attr_mask = np.bool_([k in self.negative_attrs for k in self.atom_attrs])
+        self._bond_attr_idx = {k: i for i, k in enumerate(self.bond_attrs)}
+        self._bond_attr_codes = {k: {v: i for i, v in enumerate(self.bond_attr_values[k])} for k in self.bond_attrs}
+        self._bond_attr_offsets = np.int64(self.bond_attr_slice[:-1])
+        self._v_max_valence = np.float64([self._max_atom_valence[a] for a in self.atom_attr_values["v"]])
+        self._v_is_N = np.bool_([a == "N" for a in self.atom_attr_values["v"]])
+        # Code 0 of fill_wildcard is None, i.e. not filled, in which case we fall back on "v"
+        self._wildcard_max_valence = np.float64(
+            [0] + [self._max_atom_valence[a] for a in self.atom_attr_values["fill_wildcard"][1:]]
+        )
+        self._charge_values = np.float64(self.atom_attr_values["charge"])
+        self._expl_H_values = np.float64(self.atom_attr_values["expl_H"])
+        self._bond_type_valence = np.float64([self._bond_valence[t] for t in self.bond_attr_values["type"]])
+
         # These values are used by Models to know how many inputs/logits to produce
         self.num_new_node_values = len(atoms)
         self.num_node_attr_logits = len(self.atom_attr_logit_map)
@@ -203,96 +229,107 @@ class MolBuildingEnvContext(GraphBuildingEnvContext):
 
     def graph_to_Data(self, g: Graph) -> gd.Data:
         """Convert a networkx Graph to a torch geometric Data instance"""
-        x = torch.zeros((max(1, len(g.nodes)), self.num_node_dim - self.num_rw_feat))
-        x[0, -1] = len(g.nodes) == 0
-        add_node_mask = torch.ones((x.shape[0], self.num_new_node_values))
-        if self.max_nodes is not None and len(g.nodes) >= self.max_nodes:
+        nodes = list(g.nodes)
+        n, m = len(nodes), len(g.edges)
+        node_pos = {u: i for i, u in enumerate(nodes)}
+        # Encode node attributes as (n, num_attrs) integer codes, and whether they are set at all
+        atom_codes = np.zeros((n, len(self.atom_attrs)), dtype=np.int64)
+        atom_has = np.zeros((n, len(self.atom_attrs)), dtype=np.bool_)
+        for i, ad in enumerate(g.nodes.values()):
+            for k, val in ad.items():
+                j = self._atom_attr_idx[k]
+                atom_codes[i, j] = self._atom_attr_codes[k][val]
+                atom_has[i, j] = True
+        bond_codes = np.zeros((m, len(self.bond_attrs)), dtype=np.int64)
+        bond_has = np.zeros((m, len(self.bond_attrs)), dtype=np.bool_)
+        edges = np.zeros((m, 2), dtype=np.int64)
+        for i, (u, v, ad) in enumerate(g.edges(data=True)):
+            edges[i] = node_pos[u], node_pos[v]
+            for k, val in ad.items():
+                j = self._bond_attr_idx[k]
+                bond_codes[i, j] = self._bond_attr_codes[k][val]
+                bond_has[i, j] = True
+        row_u, row_v = edges[:, 0], edges[:, 1]
+
+        x = np.zeros((max(1, n), self.num_node_dim - self.num_rw_feat), dtype=np.float32)
+        x[0, -1] = n == 0
+        x[np.arange(n)[:, None], self._atom_attr_offsets + atom_codes] = 1
+
+        # Account for charge and explicit Hs in atom as limiting the total valence
+        a_charge, a_expl_H = self._atom_attr_idx["charge"], self._atom_attr_idx["expl_H"]
+        a_v, a_fill = self._atom_attr_idx["v"], self._atom_attr_idx["fill_wildcard"]
+        charge = np.where(atom_has[:, a_charge], self._charge_values[atom_codes[:, a_charge]], 0)
+        expl_H = np.where(atom_has[:, a_expl_H], self._expl_H_values[atom_codes[:, a_expl_H]], 0)
+        fill = atom_codes[:, a_fill]
+        max_atom_valence = np.where(fill > 0, self._wildcard_max_valence[fill], self._v_max_valence[atom_codes[:, a_v]])
+        # Special rule for Nitrogen. This is definitely a heuristic, but to keep things simple we'll
+        # limit Nitrogen's valence to 3 (as per self._max_atom_valence) unless it is charged, then we
+        # make it 5. This keeps RDKit happy (and is probably a good idea anyway).
+        max_atom_valence[self._v_is_N[atom_codes[:, a_v]] & (charge == 1)] = 5
+        max_valence = max_atom_valence - abs(charge) - expl_H
+        # Compute explicitly defined valence, each bond counts towards both of its atoms
+        bond_valence = self._bond_type_valence[bond_codes[:, self._bond_attr_idx["type"]]]
+        explicit_valence = np.bincount(row_u, bond_valence, minlength=n) + np.bincount(row_v, bond_valence, minlength=n)
+
+        add_node_mask = np.ones((x.shape[0], self.num_new_node_values), dtype=np.float32)
+        if self.max_nodes is not None and n >= self.max_nodes:
             add_node_mask *= 0
-        explicit_valence = {}
-        max_valence = {}
-        set_node_attr_mask = torch.ones((x.shape[0], self.num_node_attr_logits))
-        if not len(g.nodes):
+        # If the valence is maxed out, mask out logits that would add a new atom + single bond to this node
+        add_node_mask[:n][explicit_valence >= max_valence] = 0
+
+        # If the attribute is already there, mask out logits (or if the attribute is a negative
+        # attribute and has been filled)
+        attr_is_set = np.where(self._negative_attr_mask, ~atom_has | (atom_codes > 0), atom_has)
+        # If charge (or explicit Hs) is not yet defined make sure there is room in the valence
+        no_room = explicit_valence + 1 > max_valence
+        attr_is_set[:, a_charge] |= ~atom_has[:, a_charge] & no_room
+        attr_is_set[:, a_expl_H] |= ~atom_has[:, a_expl_H] & no_room
+        set_node_attr_mask = np.ones((x.shape[0], self.num_node_attr_logits), dtype=np.float32)
+        if not n:
             set_node_attr_mask *= 0
-        for i, n in enumerate(g.nodes):
-            ad = g.nodes[n]
-            for k, sl in zip(self.atom_attrs, self.atom_attr_slice):
-                idx = self.atom_attr_values[k].index(ad[k]) if k in ad else 0
-                x[i, sl + idx] = 1
-                # If the attribute is already there, mask out logits
-                # (or if the attribute is a negative attribute and has been filled)
-                if k in self.negative_attrs:
-                    if k in ad and idx > 0 or k not in ad:
-                        s, e = self.atom_attr_logit_slice[k]
-                        set_node_attr_mask[i, s:e] = 0
-                elif k in ad:
-                    s, e = self.atom_attr_logit_slice[k]
-                    set_node_attr_mask[i, s:e] = 0
-            # Account for charge and explicit Hs in atom as limiting the total valence
-            max_atom_valence = self._max_atom_valence[ad.get("fill_wildcard", None) or ad["v"]]
-            # Special rule for Nitrogen
-            if ad["v"] == "N" and ad.get("charge", 0) == 1:
-                # This is definitely a heuristic, but to keep things simple we'll limit Nitrogen's valence to 3 (as
-                # per self._max_atom_valence) unless it is charged, then we make it 5.
-                # This keeps RDKit happy (and is probably a good idea anyway).
-                max_atom_valence = 5
-            max_valence[n] = max_atom_valence - abs(ad.get("charge", 0)) - ad.get("expl_H", 0)
-            # Compute explicitly defined valence:
-            explicit_valence[n] = 0
-            for ne in g[n]:
-                explicit_valence[n] += self._bond_valence[g.edges[(n, ne)].get("type", self.bond_attr_defaults["type"])]
-            # If the valence is maxed out, mask out logits that would add a new atom + single bond to this node
-            if explicit_valence[n] >= max_valence[n]:
-                add_node_mask[i, :] = 0
-            # If charge is not yet defined make sure there is room in the valence
-            if "charge" not in ad and explicit_valence[n] + 1 > max_valence[n]:
-                s, e = self.atom_attr_logit_slice["charge"]
-                set_node_attr_mask[i, s:e] = 0
-            # idem for explicit hydrogens
-            if "expl_H" not in ad and explicit_valence[n] + 1 > max_valence[n]:
-                s, e = self.atom_attr_logit_slice["expl_H"]
-                set_node_attr_mask[i, s:e] = 0
+        for j, k in enumerate(self.atom_attrs):
+            s, e = self.atom_attr_logit_slice[k]
+            set_node_attr_mask[np.flatnonzero(attr_is_set[:, j]), s:e] = 0
 
-        edge_attr = torch.zeros((len(g.edges) * 2, self.num_edge_dim))
-        set_edge_attr_mask = torch.zeros((len(g.edges), self.num_edge_attr_logits))
-        for i, e in enumerate(g.edges):
-            ad = g.edges[e]
-            for k, sl in zip(self.bond_attrs, self.bond_attr_slice):
-                idx = self.bond_attr_values[k].index(ad[k]) if k in ad else 0
-                edge_attr[i * 2, sl + idx] = 1
-                edge_attr[i * 2 + 1, sl + idx] = 1
-                if k in ad:  # If the attribute is already there, mask out logits
-                    s, e = self.bond_attr_logit_slice[k]
-                    set_edge_attr_mask[i, s:e] = 0
-            # Check which bonds don't bust the valence of their atoms
-            if "type" not in ad:  # Only if type isn't already set
-                sl, _ = self.bond_attr_logit_slice["type"]
-                for ti, bond_type in enumerate(self.bond_attr_values["type"][1:]):  # [1:] because 0th is default
-                    # -1 because we'd be removing the single bond and replacing it with a double/triple/aromatic bond
-                    is_ok = all([explicit_valence[n] + self._bond_valence[bond_type] - 1 <= max_valence[n] for n in e])
-                    set_edge_attr_mask[i, sl + ti] = float(is_ok)
-        edge_index = (
-            torch.tensor([e for i, j in g.edges for e in [(i, j), (j, i)]], dtype=torch.long).reshape((-1, 2)).T
-        )
+        edge_attr = np.zeros((m * 2, self.num_edge_dim), dtype=np.float32)
+        bond_cols = self._bond_attr_offsets + bond_codes
+        edge_attr[np.arange(0, m * 2, 2)[:, None], bond_cols] = 1
+        edge_attr[np.arange(1, m * 2, 2)[:, None], bond_cols] = 1
+        # Attributes that are already there have their logits masked out, and we only allow the bond
+        # types that don't bust the valence of their atoms
+        set_edge_attr_mask = np.zeros((m, self.num_edge_attr_logits), dtype=np.float32)
+        type_not_set = np.flatnonzero(~bond_has[:, self._bond_attr_idx["type"]])
+        sl, _ = self.bond_attr_logit_slice["type"]
+        for ti, bv in enumerate(self._bond_type_valence[1:]):  # [1:] because 0th is default
+            # -1 because we'd be removing the single bond and replacing it with a double/triple/aromatic bond
+            is_ok = explicit_valence + bv - 1 <= max_valence
+            set_edge_attr_mask[type_not_set, sl + ti] = (is_ok[row_u] & is_ok[row_v])[type_not_set]
 
-        def is_ok_non_edge(e):
-            return all([explicit_valence[i] + 1 <= max_valence[i] for i in e])
+        labels = np.int64(nodes)
+        edge_index = np.empty((2, m * 2), dtype=np.int64)
+        edge_index[0, ::2] = edge_index[1, 1::2] = labels[row_u]
+        edge_index[1, ::2] = edge_index[0, 1::2] = labels[row_v]
 
-        if self.max_edges is not None and len(g.edges) >= self.max_edges:
-            non_edge_index = torch.zeros((2, 0), dtype=torch.long)
+        if self.max_edges is not None and m >= self.max_edges:
+            non_edge_index = np.zeros((2, 0), dtype=np.int64)
         else:
-            gc = nx.complement(g)
-            non_edge_index = torch.tensor([i for i in gc.edges if is_ok_non_edge(i)], dtype=torch.long).T.reshape(
-                (2, -1)
-            )
+            # Non-edges are the upper triangle of the complement of the adjacency matrix, in the same
+            # (row-major) order as `nx.complement(g).edges`, restricted to atoms with room for a bond
+            adj = np.zeros((n, n), dtype=np.bool_)
+            adj[row_u, row_v] = adj[row_v, row_u] = True
+            ne_u, ne_v = np.triu_indices(n, 1)
+            has_room = explicit_valence + 1 <= max_valence
+            is_ok_non_edge = ~adj[ne_u, ne_v] & has_room[ne_u] & has_room[ne_v]
+            non_edge_index = np.stack([labels[ne_u[is_ok_non_edge]], labels[ne_v[is_ok_non_edge]]]).reshape((2, -1))
         data = gd.Data(
-            x,
-            edge_index,
-            edge_attr,
-            non_edge_index=non_edge_index,
-            add_node_mask=add_node_mask,
-            set_node_attr_mask=set_node_attr_mask,
+            torch.from_numpy(x),
+            torch.from_numpy(edge_index),
+            torch.from_numpy(edge_attr),
+            non_edge_index=torch.from_numpy(non_edge_index),
+            add_node_mask=torch.from_numpy(add_node_mask),
+            set_node_attr_mask=torch.from_numpy(set_node_attr_mask),
             add_edge_mask=torch.ones((non_edge_index.shape[1], 1)),  # Already filtered by is_ok_non_edge
-            set_edge_attr_mask=set_edge_attr_mask,
+            set_edge_attr_mask=torch.from_numpy(set_edge_attr_mask),
         )
         if self.num_rw_feat > 0:
             data.x = torch.cat([data.x, random_walk_probs(data, self.num_rw_feat, skip_odd=True)], 1)
@@ -300,7 +337,7 @@ class MolBuildingEnvContext(GraphBuildingEnvContext):
 
     def collate(self, graphs: List[gd.Data]):
         """Batch Data instances"""
-        return gd.Batch.from_data_list(graphs, follow_batch=["edge_index", "non_edge_index"])
+        return augment_virtual_nodes(fast_collate(graphs, follow_batch=["edge_index", "non_edge_index"]))
 
     def mol_to_graph(self, mol: Mol) -> Graph:
         """Convert an RDMol to a Graph"""
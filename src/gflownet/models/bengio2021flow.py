@@ -7,9 +7,12 @@ from
 In particular, this model class allows us to compare to the same
 target proxy used in that paper (sEH binding affinity prediction).
 """
+import argparse
 import gzip
+import inspect
 import os
 import pickle  # nosec
+from typing import Optional
 
 import numpy as np
 import requests  # type: ignore
@@ -20,10 +23,13 @@ from rdkit import RDConfig
 from rdkit.Chem import ChemicalFeatures
 from rdkit.Chem.rdchem import BondType as BT
 from rdkit.Chem.rdchem import HybridizationType
+from torch import Tensor
 from torch_geometric.data import Batch, Data
 from torch_geometric.nn import NNConv, Set2Set
 from torch_sparse import coalesce
 
+from gflownet.utils.compile import QUANTIZABLE_TYPES, QUANTIZE_MODE, compile_module, quantize_module
+
 NUM_ATOMIC_NUMBERS = 56  # Number of atoms used in the molecules (i.e. up to Ba)
 
 # These are the fragments used in the original paper, each fragment is a tuple
@@ -152,38 +158,141 @@ class MPNNet(nn.Module):
         per_mol_out = self.lin3(global_out)  # per mol scalar outputs
         return per_mol_out
 
+    def inference_module(self, mode: str) -> nn.Module:
+        """See gflownet.utils.compile, the model must already be on its final device"""
+        if mode == QUANTIZE_MODE:
+            # All of the Linear, GRU and LSTM (in Set2Set) layers. NNConv's root weight is a torch_geometric
+            # Linear, which stays in fp32.
+            return quantize_module(self, QUANTIZABLE_TYPES)
+        return InferenceMPNNet(self, mode)
+
+
+class ScriptableMPNNetConvs(nn.Module):
+    """The message passing steps of MPNNet.forward (without dropout), on tensors so that they can be compiled
+    (see gflownet.utils.compile). Shares the parameters of the MPNNet it is built from."""
+
+    def __init__(self, mpnn: MPNNet):
+        super().__init__()
+        self.lin0, self.act, self.gru = mpnn.lin0, mpnn.act, mpnn.gru
+        # torch_geometric's message passing layers must be converted to be scriptable (this shares parameters)
+        self.conv = mpnn.conv.jittable() if hasattr(mpnn.conv, "jittable") else mpnn.conv
+        self.num_conv_steps = mpnn.num_conv_steps
+
+    def forward(self, x: Tensor, edge_index: Tensor, edge_attr: Tensor) -> Tensor:
+        out = self.act(self.lin0(x))
+        h = out.unsqueeze(0)
+        for i in range(self.num_conv_steps):
+            m = self.act(self.conv(out, edge_index, edge_attr))
+            out, h = self.gru(m.unsqueeze(0).contiguous(), h.contiguous())
+            out = out.squeeze(0)
+        return out
+
+
+class InferenceMPNNet(nn.Module):
+    """An MPNNet whose message passing steps run compiled (see gflownet.utils.compile), for inference without
+    gradients. Set2Set, which torch_geometric doesn't make scriptable, runs in eager mode."""
 
-def load_original_model():
+    def __init__(self, mpnn: MPNNet, mode: str):
+        super().__init__()
+        self.mpnn = mpnn
+        self.convs = compile_module(ScriptableMPNNetConvs(mpnn), mode)
+
+    def forward(self, data):
+        with torch.no_grad():
+            out = self.convs(data.x, data.edge_index, data.edge_attr)
+            return self.mpnn.lin3(self.mpnn.set2set(out, data.batch))
+
+
+ORIGINAL_PARAMS_URL = "https://github.com/GFNOrg/gflownet/raw/master/mols/data/pretrained_proxy/best_params.pkl.gz"
+# The name of the converted state_dict of the original model in the cache directory
+CACHED_STATE_DICT = "bengio2021flow_seh_proxy.pt"
+# The index in best_params.pkl.gz of each parameter of MPNNet
+ORIGINAL_PARAM_INDICES = {
+    "lin0.weight": 0,
+    "lin0.bias": 1,
+    "conv.bias": 3,
+    "conv.nn.0.weight": 4,
+    "conv.nn.0.bias": 5,
+    "conv.nn.2.weight": 6,
+    "conv.nn.2.bias": 7,
+    "conv.lin.weight": 2,
+    "gru.weight_ih_l0": 8,
+    "gru.weight_hh_l0": 9,
+    "gru.bias_ih_l0": 10,
+    "gru.bias_hh_l0": 11,
+    "set2set.lstm.weight_ih_l0": 16,
+    "set2set.lstm.weight_hh_l0": 17,
+    "set2set.lstm.bias_ih_l0": 18,
+    "set2set.lstm.bias_hh_l0": 19,
+    "lin3.weight": 20,
+    "lin3.bias": 21,
+}
+
+
+def default_cache_dir() -> str:
+    """The directory of the cached proxy weights, $GFLOWNET_CACHE_DIR or ~/.cache/gflownet"""
+    return os.environ.get("GFLOWNET_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "gflownet"))
+
+
+def _original_architecture() -> MPNNet:
     num_feat = 14 + 1 + NUM_ATOMIC_NUMBERS
-    mpnn = MPNNet(num_feat=num_feat, num_vec=0, dim=64, num_out_per_mol=1, num_out_per_stem=105, num_conv_steps=12)
-    f = requests.get(
-        "https://github.com/GFNOrg/gflownet/raw/master/mols/data/pretrained_proxy/best_params.pkl.gz",
-        stream=True,
-        timeout=30,
+    return MPNNet(num_feat=num_feat, num_vec=0, dim=64, num_out_per_mol=1, num_out_per_stem=105, num_conv_steps=12)
+
+
+def cache_original_model(cache_dir: Optional[str] = None, params_file: Optional[str] = None) -> str:
+    """Converts the weights of the original sEH proxy to a state_dict of MPNNet in the cache directory.
+
+    Parameters
+    ----------
+    cache_dir: Optional[str]
+        The cache directory, `default_cache_dir()` by default.
+    params_file: Optional[str]
+        A local copy of best_params.pkl.gz (e.g. for machines without network access), which is otherwise
+        downloaded from ORIGINAL_PARAMS_URL.
+
+    Returns
+    -------
+    path: str
+        The path of the cached state_dict.
+    """
+    if params_file is None:
+        try:
+            f = requests.get(ORIGINAL_PARAMS_URL, stream=True, timeout=30)
+            f.raise_for_status()
+        except requests.RequestException as e:
+            raise RuntimeError(
+                f"Could not download the sEH proxy's weights ({e}). On machines without network access, populate "
+                "the cache with `python -m gflownet.models.bengio2021flow --params-file best_params.pkl.gz`."
+            ) from e
+        params = pickle.load(gzip.open(f.raw))  # nosec
+    else:
+        with gzip.open(params_file) as f:
+            params = pickle.load(f)  # nosec
+    mpnn = _original_architecture()
+    # bond2out isn't part of the original weights (nor used in forward), it is saved with its initial values
+    mpnn.load_state_dict(
+        {**mpnn.state_dict(), **{k: torch.as_tensor(params[i]) for k, i in ORIGINAL_PARAM_INDICES.items()}}
     )
-    params = pickle.load(gzip.open(f.raw))  # nosec
-    param_map = {
-        "lin0.weight": params[0],
-        "lin0.bias": params[1],
-        "conv.bias": params[3],
-        "conv.nn.0.weight": params[4],
-        "conv.nn.0.bias": params[5],
-        "conv.nn.2.weight": params[6],
-        "conv.nn.2.bias": params[7],
-        "conv.lin.weight": params[2],
-        "gru.weight_ih_l0": params[8],
-        "gru.weight_hh_l0": params[9],
-        "gru.bias_ih_l0": params[10],
-        "gru.bias_hh_l0": params[11],
-        "set2set.lstm.weight_ih_l0": params[16],
-        "set2set.lstm.weight_hh_l0": params[17],
-        "set2set.lstm.bias_ih_l0": params[18],
-        "set2set.lstm.bias_hh_l0": params[19],
-        "lin3.weight": params[20],
-        "lin3.bias": params[21],
-    }
-    for k, v in param_map.items():
-        mpnn.get_parameter(k).data = torch.tensor(v)
+    path = os.path.join(cache_dir or default_cache_dir(), CACHED_STATE_DICT)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written atomically, since several jobs may populate the cache at once
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.save(mpnn.state_dict(), tmp_path)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_original_model(cache_dir: Optional[str] = None) -> MPNNet:
+    """Returns the sEH proxy of Bengio et al. (2021). Its weights are loaded from the cache directory (see
+    `default_cache_dir`), without network access, and are only downloaded (and cached) if they are missing.
+    """
+    path = os.path.join(cache_dir or default_cache_dir(), CACHED_STATE_DICT)
+    if not os.path.exists(path):
+        path = cache_original_model(cache_dir)
+    mpnn = _original_architecture()
+    # Memory-mapping (torch >= 2.1) avoids reading the file before copying it into the parameters
+    mmap = {"mmap": True} if "mmap" in inspect.signature(torch.load).parameters else {}
+    mpnn.load_state_dict(torch.load(path, map_location="cpu", **mmap))
     return mpnn
 
 
@@ -304,3 +413,15 @@ def mol2graph(mol, floatX=torch.float, bonds=False, nblocks=False):
 def mols2batch(mols):
     batch = Batch.from_data_list(mols)
     return batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Populates the cache of the sEH proxy's weights")
+    parser.add_argument("--cache-dir", help="The cache directory, default $GFLOWNET_CACHE_DIR or ~/.cache/gflownet")
+    parser.add_argument("--params-file", help="A local copy of best_params.pkl.gz, instead of downloading it")
+    args = parser.parse_args(argv)
+    print(cache_original_model(args.cache_dir, args.params_file))
+
+
+if __name__ == "__main__":
+    main()
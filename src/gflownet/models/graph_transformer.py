@@ -1,12 +1,16 @@
+import contextlib
 from itertools import chain
+from typing import List, Optional, Tuple
 
 import torch
 import torch.nn as nn
 import torch_geometric.data as gd
 import torch_geometric.nn as gnn
-from torch_geometric.utils import add_self_loops
+from torch import Tensor
+from torch_scatter import scatter
 
-from gflownet.envs.graph_building_env import GraphActionCategorical, GraphActionType
+from gflownet.envs.graph_building_env import GraphActionCategorical, GraphActionType, virtual_node_structure
+from gflownet.utils.compile import QUANTIZE_MODE, compile_module, quantize_module
 
 
 def mlp(n_in, n_hid, n_out, n_layer, act=nn.LeakyReLU):
@@ -24,6 +28,10 @@ class GraphTransformer(nn.Module):
     conditional information, since they condition the output). The graph features are projected to
     virtual nodes (one per graph), which are fully connected.
 
+    The self-loops of the augmented graph (see `augment_virtual_nodes`) have as attributes either the mean
+    of the attributes of the edges incoming to their node, or, with `self_loop_attr="learned"`, a learned
+    vector, which avoids a scatter in every forward pass.
+
     The per node outputs are the concatenation of the final (post graph-convolution) node embeddings
     and of the final virtual node embedding of the graph each node corresponds to.
 
@@ -31,7 +39,18 @@ class GraphTransformer(nn.Module):
     virtual node embeddings, and of the conditional information embedding.
     """
 
-    def __init__(self, x_dim, e_dim, g_dim, num_emb=64, num_layers=3, num_heads=2, num_noise=0, ln_type="pre"):
+    def __init__(
+        self,
+        x_dim,
+        e_dim,
+        g_dim,
+        num_emb=64,
+        num_layers=3,
+        num_heads=2,
+        num_noise=0,
+        ln_type="pre",
+        self_loop_attr="mean",
+    ):
         """
         Parameters
         ----------
@@ -50,12 +69,16 @@ class GraphTransformer(nn.Module):
         ln_type: str
             The location of Layer Norm in the transformer, either 'pre' or 'post', default 'pre'.
             (apparently, before is better than after, see https://arxiv.org/pdf/2002.04745.pdf)
+        self_loop_attr: str
+            The attribute of the self-loops, either 'mean' or 'learned', default 'mean'.
         """
         super().__init__()
         self.num_layers = num_layers
         self.num_noise = num_noise
         assert ln_type in ["pre", "post"]
         self.ln_type = ln_type
+        assert self_loop_attr in ["mean", "learned"]
+        self.self_loop_attr = self_loop_attr
 
         self.x2h = mlp(x_dim + num_noise, num_emb, num_emb, 2)
         self.e2h = mlp(e_dim, num_emb, num_emb, 2)
@@ -77,6 +100,12 @@ class GraphTransformer(nn.Module):
                 [],
             )
         )
+        # The edges to and from the virtual nodes have a constant attribute, a bias term
+        virtual_edge_attr = torch.zeros(num_emb)
+        virtual_edge_attr[0] = 1
+        self.register_buffer("virtual_edge_attr", virtual_edge_attr, persistent=False)
+        if self_loop_attr == "learned":
+            self.self_loop_emb = nn.Parameter(virtual_edge_attr.clone())
 
     def forward(self, g: gd.Batch, cond: torch.Tensor):
         """Forward pass
@@ -84,7 +113,9 @@ class GraphTransformer(nn.Module):
         Parameters
         ----------
         g: gd.Batch
-            A standard torch_geometric Batch object. Expects `edge_attr` to be set.
+            A standard torch_geometric Batch object. Expects `edge_attr` to be set. If it doesn't have the
+            attributes set by `augment_virtual_nodes`, they are computed and cached on it (see
+            `virtual_node_structure`).
         cond: torch.Tensor
             The per-graph conditioning information. Shape: (g.num_graphs, self.g_dim).
 
@@ -105,13 +136,15 @@ class GraphTransformer(nn.Module):
         # Augment the edges with a new edge to the conditioning
         # information node. This new node is connected to every node
         # within its graph.
-        u, v = torch.arange(num_total_nodes, device=o.device), g.batch + num_total_nodes
-        aug_edge_index = torch.cat([g.edge_index, torch.stack([u, v]), torch.stack([v, u])], 1)
-        e_p = torch.zeros((num_total_nodes * 2, e.shape[1]), device=g.x.device)
-        e_p[:, 0] = 1  # Manually create a bias term
-        aug_e = torch.cat([e, e_p], 0)
-        aug_edge_index, aug_e = add_self_loops(aug_edge_index, aug_e, "mean")
-        aug_batch = torch.cat([g.batch, torch.arange(c.shape[0], device=o.device)], 0)
+        aug_edge_index, aug_batch = virtual_node_structure(g)
+        num_aug_nodes = num_total_nodes + c.shape[0]
+        aug_e = torch.cat([e, self.virtual_edge_attr.expand(num_total_nodes * 2, -1)], 0)
+        if self.self_loop_attr == "learned":
+            loop_e = self.self_loop_emb.expand(num_aug_nodes, -1)
+        else:
+            # The mean of the attributes of the edges incoming to each node, as add_self_loops(..., "mean")
+            loop_e = scatter(aug_e, aug_edge_index[1, : aug_e.shape[0]], 0, dim_size=num_aug_nodes, reduce="mean")
+        aug_e = torch.cat([aug_e, loop_e], 0)
 
         # Append the conditioning information node embedding to o
         o = torch.cat([o, c], 0)
@@ -138,6 +171,76 @@ class GraphTransformer(nn.Module):
         return o_final, glob
 
 
+def _jittable(module: nn.Module) -> nn.Module:
+    # torch_geometric's message passing layers must be converted to be scriptable (this shares parameters)
+    return module.jittable() if hasattr(module, "jittable") else module
+
+
+class _ScriptableGraphTransformerLayer(nn.Module):
+    def __init__(self, modules: List[nn.Module], ln_type: str):
+        super().__init__()
+        self.gen, self.trans = _jittable(modules[0]), _jittable(modules[1])
+        self.linear, self.norm1, self.ff, self.norm2, self.cscale = modules[2:]
+        self.post_ln = ln_type == "post"
+
+    def forward(self, o: Tensor, c: Tensor, aug_edge_index: Tensor, aug_e: Tensor, aug_batch: Tensor) -> Tensor:
+        cs = self.cscale(c[aug_batch])
+        if self.post_ln:
+            agg = self.gen(o, aug_edge_index, aug_e)
+            l_h = self.linear(self.trans(torch.cat([o, agg], 1), aug_edge_index, aug_e))
+            scale, shift = cs[:, : l_h.shape[1]], cs[:, l_h.shape[1] :]
+            o = self.norm1(o + l_h * scale + shift, aug_batch)
+            return self.norm2(o + self.ff(o), aug_batch)
+        o_norm = self.norm1(o, aug_batch)
+        agg = self.gen(o_norm, aug_edge_index, aug_e)
+        l_h = self.linear(self.trans(torch.cat([o_norm, agg], 1), aug_edge_index, aug_e))
+        scale, shift = cs[:, : l_h.shape[1]], cs[:, l_h.shape[1] :]
+        o = o + l_h * scale + shift
+        return o + self.ff(self.norm2(o, aug_batch))
+
+
+class ScriptableGraphTransformer(nn.Module):
+    """The computations of GraphTransformer.forward, on tensors rather than on a gd.Batch, so that they can be
+    compiled (see gflownet.utils.compile). Shares the parameters of the GraphTransformer it is built from,
+    which must already be on its final device."""
+
+    def __init__(self, transf: GraphTransformer):
+        super().__init__()
+        self.x2h, self.e2h, self.c2h = transf.x2h, transf.e2h, transf.c2h
+        self.layers = nn.ModuleList(
+            [
+                _ScriptableGraphTransformerLayer(list(transf.graph2emb[i * 7 : (i + 1) * 7]), transf.ln_type)
+                for i in range(transf.num_layers)
+            ]
+        )
+        self.learned_self_loops = transf.self_loop_attr == "learned"
+        self.register_buffer("virtual_edge_attr", transf.virtual_edge_attr, persistent=False)
+        self.register_buffer(
+            "self_loop_emb", transf.self_loop_emb if self.learned_self_loops else torch.zeros(0), persistent=False
+        )
+
+    def forward(
+        self, x: Tensor, edge_attr: Tensor, aug_edge_index: Tensor, aug_batch: Tensor, batch: Tensor, cond: Tensor
+    ) -> Tuple[Tensor, Tensor]:
+        """See GraphTransformer.forward and augment_virtual_nodes for the arguments, `x` includes the noise"""
+        o = self.x2h(x)
+        e = self.e2h(edge_attr)
+        c = self.c2h(cond)
+        num_total_nodes, num_graphs = x.shape[0], c.shape[0]
+        num_aug_nodes = num_total_nodes + num_graphs
+        aug_e = torch.cat([e, self.virtual_edge_attr.expand(num_total_nodes * 2, -1)], 0)
+        if self.learned_self_loops:
+            loop_e = self.self_loop_emb.expand(num_aug_nodes, -1)
+        else:
+            loop_e = scatter(aug_e, aug_edge_index[1, : aug_e.shape[0]], 0, dim_size=num_aug_nodes, reduce="mean")
+        aug_e = torch.cat([aug_e, loop_e], 0)
+        o = torch.cat([o, c], 0)
+        for layer in self.layers:
+            o = layer(o, c, aug_edge_index, aug_e, aug_batch)
+        glob = torch.cat([gnn.global_mean_pool(o[:num_total_nodes], batch, num_graphs), o[num_total_nodes:]], 1)
+        return o[:num_total_nodes], glob
+
+
 class GraphTransformerGFN(nn.Module):
     """GraphTransformer class for a GFlowNet which outputs a GraphActionCategorical. Meant for atom-wise
     generation.
@@ -155,6 +258,7 @@ class GraphTransformerGFN(nn.Module):
         ln_type="pre",
         num_graph_out=1,
         do_bck=False,
+        self_loop_attr="mean",
     ):
         """See `GraphTransformer` for argument values"""
         super().__init__()
@@ -166,6 +270,7 @@ class GraphTransformerGFN(nn.Module):
             num_layers=num_layers,
             num_heads=num_heads,
             ln_type=ln_type,
+            self_loop_attr=self_loop_attr,
         )
         num_final = num_emb
         num_glob_final = num_emb * 2
@@ -222,29 +327,50 @@ class GraphTransformerGFN(nn.Module):
         self.emb2graph_out = mlp(num_glob_final, num_emb, num_graph_out, num_mlp_layers)
         # TODO: flag for this
         self.logZ = mlp(env_ctx.num_cond_dim, num_emb * 2, 1, 2)
+        # When set (e.g. to torch.bfloat16), the trunk and the heads run under torch.autocast with this
+        # dtype. Logits and graph outputs are always returned in fp32, and logZ, which is called directly
+        # rather than through forward, is kept in fp32.
+        self.autocast_dtype: Optional[torch.dtype] = None
 
     def _action_type_to_mask(self, t, g):
         return getattr(g, t.mask_name) if hasattr(g, t.mask_name) else torch.ones((1, 1), device=g.x.device)
 
-    def _action_type_to_logit(self, t, emb, g):
-        logits = self.mlps[t.cname](emb[self._action_type_to_graph_part[t]])
+    def _action_type_to_logit(self, t, emb, g, heads):
+        # The categorical's log-softmax and logsumexp are computed in fp32, even when autocasting
+        logits = heads.mlps[t.cname](emb[self._action_type_to_graph_part[t]]).float()
         return self._mask(logits, self._action_type_to_mask(t, g))
 
     def _mask(self, x, m):
         # mask logit vector x with binary mask m, -1000 is a tiny log-value
         return x * m + -1000 * (1 - m)
 
-    def _make_cat(self, g, emb, action_types):
+    def _make_cat(self, g, emb, action_types, heads):
         return GraphActionCategorical(
             g,
-            logits=[self._action_type_to_logit(t, emb, g) for t in action_types],
+            logits=[self._action_type_to_logit(t, emb, g, heads) for t in action_types],
             keys=[self._graph_part_to_key[self._action_type_to_graph_part[t]] for t in action_types],
             masks=[self._action_type_to_mask(t, g) for t in action_types],
             types=action_types,
         )
 
+    def _autocast(self, device):
+        if self.autocast_dtype is None:
+            # Don't disable an autocast context set by the caller
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=device.type, dtype=self.autocast_dtype)
+
     def forward(self, g: gd.Batch, cond: torch.Tensor):
-        node_embeddings, graph_embeddings = self.transf(g, cond)
+        with self._autocast(g.x.device):
+            node_embeddings, graph_embeddings = self.transf(g, cond)
+            return self._heads(g, node_embeddings, graph_embeddings)
+
+    def inference_module(self, mode: str) -> "InferenceGraphTransformerGFN":
+        """See gflownet.utils.compile, the model must already be on its final device"""
+        return InferenceGraphTransformerGFN(self, mode)
+
+    def _heads(self, g: gd.Batch, node_embeddings: Tensor, graph_embeddings: Tensor, heads: Optional[nn.Module] = None):
+        # `heads` holds the `mlps` and `emb2graph_out` modules to use, self's by default
+        heads = self if heads is None else heads
         # "Non-edges" are edges not currently in the graph that we could add
         if hasattr(g, "non_edge_index"):
             ne_row, ne_col = g.non_edge_index
@@ -273,9 +399,43 @@ class GraphTransformerGFN(nn.Module):
             "non_edge": non_edge_embeddings,
         }
 
-        graph_out = self.emb2graph_out(graph_embeddings)
-        fwd_cat = self._make_cat(g, emb, self.action_type_order)
+        graph_out = heads.emb2graph_out(graph_embeddings).float()
+        fwd_cat = self._make_cat(g, emb, self.action_type_order, heads)
         if self.do_bck:
-            bck_cat = self._make_cat(g, emb, self.bck_action_type_order)
+            bck_cat = self._make_cat(g, emb, self.bck_action_type_order, heads)
             return fwd_cat, bck_cat, graph_out
         return fwd_cat, graph_out
+
+
+class InferenceGraphTransformerGFN(nn.Module):
+    """A GraphTransformerGFN whose transformer runs compiled (see gflownet.utils.compile), for sampling
+    without gradients. The output heads and the GraphActionCategoricals are computed in eager mode.
+
+    It shares the parameters of the model it is built from, with the "script" and "compile" modes, so that
+    it follows its updates.
+
+    With the "quantize" mode, the transformer runs in fp32 eager mode, and the output heads are int8
+    dynamically quantized copies of the model's, which are rebuilt when its parameters are updated."""
+
+    def __init__(self, model: GraphTransformerGFN, mode: str):
+        super().__init__()
+        self.model = model
+        self.logZ = model.logZ
+        if mode == QUANTIZE_MODE:
+            # The transformer's matrix multiplications are too small to be sped up by int8
+            self.transf = ScriptableGraphTransformer(model.transf)
+            self.mlps = nn.ModuleDict({k: quantize_module(v) for k, v in model.mlps.items()})
+            self.emb2graph_out = quantize_module(model.emb2graph_out)
+        else:
+            self.transf = compile_module(ScriptableGraphTransformer(model.transf), mode)
+            self.mlps, self.emb2graph_out = model.mlps, model.emb2graph_out
+
+    def forward(self, g: gd.Batch, cond: torch.Tensor):
+        model = self.model
+        with torch.no_grad(), model._autocast(g.x.device):
+            aug_edge_index, aug_batch = virtual_node_structure(g)
+            x = g.x
+            if model.transf.num_noise > 0:
+                x = torch.cat([x, torch.rand(x.shape[0], model.transf.num_noise, device=x.device)], 1)
+            node_embeddings, graph_embeddings = self.transf(x, g.edge_attr, aug_edge_index, aug_batch, g.batch, cond)
+            return model._heads(g, node_embeddings, graph_embeddings, self)
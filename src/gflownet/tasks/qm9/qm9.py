@@ -16,11 +16,11 @@ from torch.utils.data import Dataset
 
 import gflownet.models.mxmnet as mxmnet
 from gflownet.algo.trajectory_balance import TrajectoryBalance
-from gflownet.data.qm9 import QM9Dataset
+from gflownet.data.qm9 import PreprocessedQM9Dataset, QM9Dataset
 from gflownet.envs.graph_building_env import GraphBuildingEnv
 from gflownet.envs.mol_building_env import MolBuildingEnvContext
 from gflownet.models.graph_transformer import GraphTransformerGFN
-from gflownet.train import FlatRewards, GFNTask, GFNTrainer, RewardScalar
+from gflownet.train import FlatRewards, FusedOptimizerStep, GFNTask, GFNTrainer, RewardScalar
 from gflownet.utils.transforms import thermometer
 
 
@@ -158,30 +158,30 @@ class QM9GapTrainer(GFNTrainer):
         self.rng = np.random.default_rng(142857)
         self.env = GraphBuildingEnv()
         self.ctx = MolBuildingEnvContext(["H", "C", "N", "F", "O"], num_cond_dim=32)
-        self.training_data = QM9Dataset(hps["qm9_h5_path"], train=True, target="gap")
-        self.test_data = QM9Dataset(hps["qm9_h5_path"], train=False, target="gap")
-
-        model = GraphTransformerGFN(self.ctx, num_emb=hps["num_emb"], num_layers=hps["num_layers"])
-        self.model = model
-        # Separate Z parameters from non-Z to allow for LR decay on the former
-        Z_params = list(model.logZ.parameters())
-        non_Z_params = [i for i in self.model.parameters() if all(id(i) != id(j) for j in Z_params)]
-        self.opt = torch.optim.Adam(
-            non_Z_params,
-            hps["learning_rate"],
-            (hps["momentum"], 0.999),
-            weight_decay=hps["weight_decay"],
-            eps=hps["adam_eps"],
+        if hps.get("qm9_preprocessed_path") is not None:
+            # Graphs converted with `python -m gflownet.data.qm9`, read from memory-mapped arrays
+            self.training_data = PreprocessedQM9Dataset(hps["qm9_preprocessed_path"], train=True, target="gap")
+            self.test_data = PreprocessedQM9Dataset(hps["qm9_preprocessed_path"], train=False, target="gap")
+        else:
+            self.training_data = QM9Dataset(hps["qm9_h5_path"], train=True, target="gap")
+            self.test_data = QM9Dataset(hps["qm9_h5_path"], train=False, target="gap")
+
+        model = GraphTransformerGFN(
+            self.ctx,
+            num_emb=hps["num_emb"],
+            num_layers=hps["num_layers"],
+            self_loop_attr=hps.get("self_loop_attr", "mean"),
         )
-        self.opt_Z = torch.optim.Adam(Z_params, hps["learning_rate"], (0.9, 0.999))
-        self.lr_sched = torch.optim.lr_scheduler.LambdaLR(self.opt, lambda steps: 2 ** (-steps / hps["lr_decay"]))
-        self.lr_sched_Z = torch.optim.lr_scheduler.LambdaLR(self.opt_Z, lambda steps: 2 ** (-steps / hps["Z_lr_decay"]))
+        self.model = model
 
         self.sampling_tau = hps["sampling_tau"]
         if self.sampling_tau > 0:
             self.sampling_model = copy.deepcopy(model)
         else:
             self.sampling_model = self.model
+        # Z and non-Z parameters are separate parameter groups, to allow for LR decay on the former
+        self.optimizer_step = FusedOptimizerStep(self.model, hps, self.sampling_model)
+        self.opt, self.lr_sched = self.optimizer_step.opt, self.optimizer_step.lr_sched
         eps = hps["tb_epsilon"]
         hps["tb_epsilon"] = ast.literal_eval(eps) if isinstance(eps, str) else eps
         self.algo = TrajectoryBalance(self.env, self.ctx, self.rng, hps, max_nodes=9)
@@ -194,26 +194,9 @@ class QM9GapTrainer(GFNTrainer):
             wrap_model=self._wrap_model_mp,
         )
         self.mb_size = hps["global_batch_size"]
-        self.clip_grad_param = hps["clip_grad_param"]
-        self.clip_grad_callback = {
-            "value": (lambda params: torch.nn.utils.clip_grad_value_(params, self.clip_grad_param)),
-            "norm": (lambda params: torch.nn.utils.clip_grad_norm_(params, self.clip_grad_param)),
-            "none": (lambda x: None),
-        }[hps["clip_grad_type"]]
 
     def step(self, loss: Tensor):
-        loss.backward()
-        for i in self.model.parameters():
-            self.clip_grad_callback(i)
-        self.opt.step()
-        self.opt.zero_grad()
-        self.opt_Z.step()
-        self.opt_Z.zero_grad()
-        self.lr_sched.step()
-        self.lr_sched_Z.step()
-        if self.sampling_tau > 0:
-            for a, b in zip(self.model.parameters(), self.sampling_model.parameters()):
-                b.data.mul_(self.sampling_tau).add_(a.data * (1 - self.sampling_tau))
+        self.optimizer_step(loss)
 
 
 def main():
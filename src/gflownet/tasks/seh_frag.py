@@ -4,11 +4,9 @@ import os
 import pickle
 import shutil
 import socket
-from typing import Any, Callable, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as stats
 import torch
 import torch.nn as nn
 import torch_geometric.data as gd
@@ -16,14 +14,16 @@ from rdkit import RDLogger
 from rdkit.Chem.rdchem import Mol as RDMol
 from torch import Tensor
 from torch.utils.data import Dataset
-import wandb
 
 from gflownet.algo.trajectory_balance import TrajectoryBalance
+from gflownet.data.memmap_graphs import MemmapTrainingDataset
+from gflownet.data.offline_trajectories import OfflineTrajectoryDataset, OfflineTrajectoryStore
 from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
 from gflownet.envs.graph_building_env import GraphBuildingEnv
 from gflownet.models import bengio2021flow, kmeans_classifier
 from gflownet.models.graph_transformer import GraphTransformerGFN
-from gflownet.train import FlatRewards, GFNTask, GFNTrainer, RewardScalar
+from gflownet.train import FlatRewards, FusedOptimizerStep, GFNTask, GFNTrainer, RewardScalar
+from gflownet.utils.misc import wandb_run
 from gflownet.utils.transforms import thermometer
 
 
@@ -48,12 +48,19 @@ class SEHTask(GFNTask):
         part: int = None,
         total_parts: int = None,
         data_dir: str = None,
+        compile_proxy: Optional[str] = None,
+        proxy_cache_dir: Optional[str] = None,
     ):
         self.part = part
         self.total_parts = total_parts
         self.data_dir = data_dir
 
         self._wrap_model = wrap_model
+        # If not None, the proxy is compiled (or quantized, with "quantize") for inference, see
+        # gflownet.utils.compile
+        self.compile_proxy = compile_proxy
+        # See bengio2021flow.load_original_model, the default cache directory is used if None
+        self.proxy_cache_dir = proxy_cache_dir
         self.rng = rng
         self.models = self._load_task_models()
         self.dataset = dataset
@@ -68,8 +75,8 @@ class SEHTask(GFNTask):
         return rp * 8
 
     def _load_task_models(self):
-        model = bengio2021flow.load_original_model()
-        model, self.device = self._wrap_model(model)
+        model = bengio2021flow.load_original_model(self.proxy_cache_dir)
+        model, self.device = self._wrap_model(model, compile_mode=self.compile_proxy)
         models_dict = {"seh": model}
 
         if self.part is not None:
@@ -86,6 +93,8 @@ class SEHTask(GFNTask):
             beta_enc = torch.zeros((n, self.num_thermometer_dim))
         else:
             if self.temperature_sample_dist == "gamma":
+                import scipy.stats as stats
+
                 loc, scale = self.temperature_dist_params
                 beta = self.rng.gamma(loc, scale, n).astype(np.float32)
                 upper_bound = stats.gamma.ppf(0.95, loc, scale=scale)
@@ -126,12 +135,16 @@ class SEHTask(GFNTask):
         if self.part is not None:
             parts = self.models['kmeans'](mols)
 
-            if wandb.run is not None:
+            if wandb_run() is not None:
+                import wandb
+
                 # Count the occurrences of each number
                 counts = np.bincount(parts, minlength=self.total_parts)
                 good_part_frac = counts[self.part] / sum(counts)
                 to_log = {'Specified part fraction': good_part_frac}
                 if wandb.run.step == 1 or wandb.run.step % 250 == 0:
+                    import matplotlib.pyplot as plt
+
                     # Plot the histogram
                     plt.hist(range(self.total_parts), bins=self.total_parts, weights=counts, edgecolor='none')
                     plt.xlabel('Part')
@@ -195,10 +208,17 @@ class SEHFragTrainer(GFNTrainer):
             part=self.hps.get("part"),
             total_parts=self.hps.get("total_parts"),
             data_dir=self.hps.get("data_dir"),
+            compile_proxy=self.hps.get("compile_proxy"),
+            proxy_cache_dir=self.hps.get("proxy_cache_dir"),
         )
 
     def setup_model(self):
-        self.model = GraphTransformerGFN(self.ctx, num_emb=self.hps["num_emb"], num_layers=self.hps["num_layers"])
+        self.model = GraphTransformerGFN(
+            self.ctx,
+            num_emb=self.hps["num_emb"],
+            num_layers=self.hps["num_layers"],
+            self_loop_attr=self.hps.get("self_loop_attr", "mean"),
+        )
 
     def setup_env_context(self):
         self.ctx = FragMolBuildingEnvContext(
@@ -218,62 +238,49 @@ class SEHFragTrainer(GFNTrainer):
         # Add training data if sampling from specified part
         if self.hps.get('part') is not None and self.offline_ratio is not None:
             data_dir = hps['data_dir']
-            with open(f'{data_dir}/training_set_graphs.pkl', 'rb') as file:
-                graphs = pickle.load(file)
-            with open(f'{data_dir}/training_set_rewards.pkl', 'rb') as file:
-                rewards = pickle.load(file)
-            with open(f'{data_dir}/part_idxs.pkl', 'rb') as file:
-                valid_idxs = pickle.load(file)
-            self.training_data = TrainingDataset(valid_idxs[self.hps['part']], graphs, rewards)
+            if self.hps.get("training_data_mmap") is not None:
+                # Data converted with `python -m gflownet.data.memmap_graphs`, graphs are loaded lazily
+                self.training_data = MemmapTrainingDataset(self.hps["training_data_mmap"], self.hps['part'])
+            else:
+                with open(f'{data_dir}/training_set_graphs.pkl', 'rb') as file:
+                    graphs = pickle.load(file)
+                with open(f'{data_dir}/training_set_rewards.pkl', 'rb') as file:
+                    rewards = pickle.load(file)
+                with open(f'{data_dir}/part_idxs.pkl', 'rb') as file:
+                    valid_idxs = pickle.load(file)
+                self.training_data = TrainingDataset(valid_idxs[self.hps['part']], graphs, rewards)
+            if self.hps.get("offline_trajectories") is not None:
+                # Trajectories precomputed with `python -m gflownet.data.offline_trajectories`
+                store = OfflineTrajectoryStore(self.hps["offline_trajectories"])
+                if store.correct_idempotent != self.hps.get("tb_correct_idempotent", False):
+                    raise ValueError(
+                        f"The offline trajectories were built with correct_idempotent={store.correct_idempotent}, "
+                        f"but tb_correct_idempotent={self.hps.get('tb_correct_idempotent', False)}"
+                    )
+                self.training_data = OfflineTrajectoryDataset(
+                    self.training_data, store, self.training_data.in_part_idxs
+                )
 
         self.setup_env_context()
         self.setup_algo()
         self.setup_task()
         self.setup_model()
 
-        # Separate Z parameters from non-Z to allow for LR decay on the former
-        Z_params = list(self.model.logZ.parameters())
-        non_Z_params = [i for i in self.model.parameters() if all(id(i) != id(j) for j in Z_params)]
-        self.opt = torch.optim.Adam(
-            non_Z_params,
-            hps["learning_rate"],
-            (hps["momentum"], 0.999),
-            weight_decay=hps["weight_decay"],
-            eps=hps["adam_eps"],
-        )
-        self.opt_Z = torch.optim.Adam(Z_params, hps["Z_learning_rate"], (0.9, 0.999))
-        self.lr_sched = torch.optim.lr_scheduler.LambdaLR(self.opt, lambda steps: 2 ** (-steps / hps["lr_decay"]))
-        self.lr_sched_Z = torch.optim.lr_scheduler.LambdaLR(self.opt_Z, lambda steps: 2 ** (-steps / hps["Z_lr_decay"]))
-
         self.sampling_tau = hps["sampling_tau"]
         if self.sampling_tau > 0:
             self.sampling_model = copy.deepcopy(self.model)
         else:
             self.sampling_model = self.model
+        # Z and non-Z parameters are separate parameter groups, to allow for LR decay on the former
+        self.optimizer_step = FusedOptimizerStep(self.model, hps, self.sampling_model)
+        self.opt, self.lr_sched = self.optimizer_step.opt, self.optimizer_step.lr_sched
         eps = hps["tb_epsilon"]
         hps["tb_epsilon"] = ast.literal_eval(eps) if isinstance(eps, str) else eps
 
         self.mb_size = hps["global_batch_size"]
-        self.clip_grad_param = hps["clip_grad_param"]
-        self.clip_grad_callback = {
-            "value": (lambda params: torch.nn.utils.clip_grad_value_(params, self.clip_grad_param)),
-            "norm": (lambda params: torch.nn.utils.clip_grad_norm_(params, self.clip_grad_param)),
-            "none": (lambda x: None),
-        }[hps["clip_grad_type"]]
 
     def step(self, loss: Tensor):
-        loss.backward()
-        for i in self.model.parameters():
-            self.clip_grad_callback(i)
-        self.opt.step()
-        self.opt.zero_grad()
-        self.opt_Z.step()
-        self.opt_Z.zero_grad()
-        self.lr_sched.step()
-        self.lr_sched_Z.step()
-        if self.sampling_tau > 0:
-            for a, b in zip(self.model.parameters(), self.sampling_model.parameters()):
-                b.data.mul_(self.sampling_tau).add_(a.data * (1 - self.sampling_tau))
+        self.optimizer_step(loss)
 
 
 class TrainingDataset(Dataset):
@@ -2,7 +2,7 @@ import json
 import os
 import pathlib
 import shutil
-from typing import Any, Callable, Dict, List, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import git
 import numpy as np
@@ -50,8 +50,12 @@ class SEHMOOTask(SEHTask):
         use_pref_thermometer: bool,
         rng: np.random.Generator = None,
         wrap_model: Callable[[nn.Module], nn.Module] = None,
+        compile_proxy: Optional[str] = None,
+        proxy_cache_dir: Optional[str] = None,
     ):
         self._wrap_model = wrap_model
+        self.compile_proxy = compile_proxy
+        self.proxy_cache_dir = proxy_cache_dir
         self.rng = rng
         self.models = self._load_task_models()
         self.objectives = objectives
@@ -71,8 +75,8 @@ class SEHMOOTask(SEHTask):
         return rp
 
     def _load_task_models(self):
-        model = bengio2021flow.load_original_model()
-        model, self.device = self._wrap_model(model)
+        model = bengio2021flow.load_original_model(self.proxy_cache_dir)
+        model, self.device = self._wrap_model(model, compile_mode=self.compile_proxy)
         return {"seh": model}
 
     def sample_conditional_information(self, n: int) -> Dict[str, Tensor]:
@@ -200,6 +204,8 @@ class SEHMOOFragTrainer(SEHFragTrainer):
             num_thermometer_dim=self.hps["num_thermometer_dim"],
             wrap_model=self._wrap_model_mp,
             use_pref_thermometer=self.hps["use_pref_thermometer"],
+            compile_proxy=self.hps.get("compile_proxy"),
+            proxy_cache_dir=self.hps.get("proxy_cache_dir"),
         )
 
     def setup_model(self):
@@ -216,6 +222,7 @@ class SEHMOOFragTrainer(SEHFragTrainer):
                 num_emb=self.hps["num_emb"],
                 num_layers=self.hps["num_layers"],
                 do_bck=self.hps["tb_p_b_is_parameterized"],
+                self_loop_attr=self.hps.get("self_loop_attr", "mean"),
             )
 
         if self.hps["algo"] in ["A2C", "MOQL"]:
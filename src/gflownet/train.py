@@ -1,20 +1,38 @@
+import copy
 import os
-import pathlib
+import threading
+import time
+import warnings
 from typing import Any, Callable, Dict, List, NewType, Optional, Tuple
 
 import torch
 import torch.nn as nn
-import torch.utils.tensorboard
 import torch_geometric.data as gd
 from rdkit.Chem.rdchem import Mol as RDMol
 from torch import Tensor
 from torch.utils.data import DataLoader, Dataset
-import wandb
 
+from gflownet.data.prefetcher import DevicePrefetcher
+from gflownet.data.replay_buffer import ReplayBuffer
 from gflownet.data.sampling_iterator import SamplingIterator
 from gflownet.envs.graph_building_env import GraphActionCategorical, GraphBuildingEnv, GraphBuildingEnvContext
+from gflownet.utils.checkpoint import (
+    AsyncCheckpointer,
+    get_rng_state,
+    latest_checkpoint,
+    load_checkpoint,
+    set_rng_state,
+)
+from gflownet.utils.compile import compile_for_inference
+from gflownet.utils.metric_logging import AsyncMetricWriter, MetricAccumulator
 from gflownet.utils.misc import create_logger
-from gflownet.utils.multiprocessing_proxy import wrap_model_mp
+from gflownet.utils.multiprocessing_proxy import MPModelProxy
+from gflownet.utils.profiling import TorchProfileWindow, default_profile_hps
+from gflownet.utils.timing import timers
+from gflownet.utils.validation import AsyncValidator
+
+# The dtypes of the `amp` and `sampling_amp` hyperparameters
+AMP_DTYPES = {"bf16": torch.bfloat16, "fp16": torch.float16}
 
 # This type represents an unprocessed list of reward signals/conditioning information
 FlatRewards = NewType("FlatRewards", Tensor)  # type: ignore
@@ -82,6 +100,155 @@ class GFNTask:
         raise NotImplementedError()
 
 
+def clip_grads_(params: List[Tensor], clip_grad_type: str, clip_grad_param: float):
+    """Clips the gradients of `params` in place, with as few kernel launches as the torch version allows
+
+    Parameters
+    ----------
+    params: List[Tensor]
+        The parameters.
+    clip_grad_type: str
+        - "value": clips each gradient element to [-clip_grad_param, clip_grad_param];
+        - "norm": rescales each parameter's gradient so that its norm is at most clip_grad_param;
+        - "global_norm": rescales all gradients so that their global norm is at most clip_grad_param;
+        - "none".
+    clip_grad_param: float
+        The clipping threshold.
+    """
+    params = [p for p in params if p.grad is not None]
+    grads = [p.grad for p in params]
+    if clip_grad_type == "none" or not grads:
+        return
+    if clip_grad_type == "value":
+        torch.nn.utils.clip_grad_value_(params, clip_grad_param)
+    elif clip_grad_type == "global_norm":
+        torch.nn.utils.clip_grad_norm_(params, clip_grad_param)
+    elif clip_grad_type == "norm":
+        # The same as calling clip_grad_norm_ on each parameter, but with a single norm and scaling kernel
+        # (with torch >= 1.13) rather than a chain of kernels per parameter
+        with torch.no_grad():
+            if hasattr(torch, "_foreach_norm"):
+                norms = torch.stack(torch._foreach_norm(grads))
+            else:
+                norms = torch.stack([g.norm() for g in grads])
+            coefs = (clip_grad_param / (norms + 1e-6)).clamp(max=1.0)
+            try:
+                torch._foreach_mul_(grads, list(coefs.unbind()))
+            except (TypeError, RuntimeError):  # Older versions can't multiply by a list of tensors
+                for g, c in zip(grads, coefs):
+                    g.mul_(c)
+    else:
+        raise ValueError(f"Unknown clip_grad_type {clip_grad_type}")
+
+
+@torch.no_grad()
+def ema_update_(ema_params: List[Tensor], params: List[Tensor], tau: float):
+    """Updates `ema_params` in place, ema_params = tau * ema_params + (1 - tau) * params"""
+    if hasattr(torch, "_foreach_lerp_"):
+        torch._foreach_lerp_(ema_params, params, 1 - tau)
+    else:
+        torch._foreach_mul_(ema_params, tau)
+        torch._foreach_add_(ema_params, params, alpha=1 - tau)
+
+
+class FusedOptimizerStep:
+    """The parameter update of a training step: backward pass, gradient clipping, a single Adam optimizer
+    with separate parameter groups (and exponential LR decays) for the model and its logZ, and the EMA
+    update of the sampling model.
+
+    The time spent in each part is recorded by `gflownet.utils.timing.timers` (as e.g.
+    `time_train/step/clip` when called from `GFNTrainer.train_batch`).
+
+    With the `amp` hyperparameter set to "fp16", the loss is scaled by a GradScaler, whose scale is
+    removed before clipping, and steps with non-finite gradients are skipped. bf16 needs no scaling.
+    """
+
+    def __init__(self, model: nn.Module, hps: Dict[str, Any], sampling_model: Optional[nn.Module] = None):
+        """
+        Parameters
+        ----------
+        model: nn.Module
+            The model, whose `logZ` submodule is optimized with `Z_learning_rate` and decayed with
+            `Z_lr_decay`, and the rest with `learning_rate`, `momentum`, `weight_decay`, `adam_eps` and
+            `lr_decay`.
+        hps: Dict[str, Any]
+            The hyperparameters, which also include `clip_grad_type`, `clip_grad_param`, `sampling_tau`
+            and `amp`.
+        sampling_model: Optional[nn.Module]
+            If not None (and not `model`), its parameters are updated as an exponential moving average
+            of the model's, with rate `sampling_tau`.
+        """
+        self.params = list(model.parameters())
+        Z_params = list(model.logZ.parameters())
+        non_Z_params = [i for i in self.params if all(id(i) != id(j) for j in Z_params)]
+        self.opt = torch.optim.Adam(
+            [
+                {
+                    "params": non_Z_params,
+                    "lr": hps["learning_rate"],
+                    "betas": (hps["momentum"], 0.999),
+                    "weight_decay": hps["weight_decay"],
+                    "eps": hps["adam_eps"],
+                },
+                {"params": Z_params, "lr": hps.get("Z_learning_rate", hps["learning_rate"]), "betas": (0.9, 0.999)},
+            ],
+        )
+        lr_decay, Z_lr_decay = hps["lr_decay"], hps["Z_lr_decay"]
+        self.lr_sched = torch.optim.lr_scheduler.LambdaLR(
+            self.opt, [lambda steps: 2 ** (-steps / lr_decay), lambda steps: 2 ** (-steps / Z_lr_decay)]
+        )
+        self.clip_grad_type = hps["clip_grad_type"]
+        self.clip_grad_param = hps["clip_grad_param"]
+        self.sampling_tau = hps["sampling_tau"]
+        self.ema_params = None
+        if sampling_model is not None and sampling_model is not model and self.sampling_tau > 0:
+            self.ema_params = list(sampling_model.parameters())
+        self.scaler = torch.cuda.amp.GradScaler() if hps.get("amp") == "fp16" else None
+
+    def state_dict(self) -> Dict[str, Any]:
+        """The state of the optimizer, LR schedulers and GradScaler (the EMA parameters are those of the
+        sampling model)"""
+        return {
+            "opt": self.opt.state_dict(),
+            "lr_sched": self.lr_sched.state_dict(),
+            "scaler": self.scaler.state_dict() if self.scaler is not None else None,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        self.opt.load_state_dict(state["opt"])
+        self.lr_sched.load_state_dict(state["lr_sched"])
+        if self.scaler is not None and state["scaler"] is not None:
+            self.scaler.load_state_dict(state["scaler"])
+
+    def _sync(self):
+        # Without synchronization, CUDA kernels would be timed in whichever part waits on them
+        if timers.enabled and self.params[0].is_cuda:
+            torch.cuda.synchronize()
+
+    def __call__(self, loss: Tensor):
+        with timers("backward"):
+            (loss if self.scaler is None else self.scaler.scale(loss)).backward()
+            self._sync()
+        with timers("clip"):
+            if self.scaler is not None:
+                self.scaler.unscale_(self.opt)
+            clip_grads_(self.params, self.clip_grad_type, self.clip_grad_param)
+            self._sync()
+        with timers("optimizer"):
+            if self.scaler is None:
+                self.opt.step()
+            else:
+                self.scaler.step(self.opt)
+                self.scaler.update()
+            self.opt.zero_grad()
+            self.lr_sched.step()
+            self._sync()
+        if self.ema_params is not None:
+            with timers("ema"):
+                ema_update_(self.ema_params, self.params, self.sampling_tau)
+                self._sync()
+
+
 class GFNTrainer:
     def __init__(self, hps: Dict[str, Any], device: torch.device):
         """A GFlowNet trainer. Contains the main training loop in `run` and should be subclassed.
@@ -114,6 +281,9 @@ class GFNTrainer:
         # The ratio of samples drawn from `self.training_data` during training. The rest is drawn from
         # `self.sampling_model`.
         self.offline_ratio = self.hps.get("offline_ratio", 0.)
+        # If > 0, on-policy trajectories are kept in a replay buffer of that capacity, from which a
+        # `replay_ratio` of the on-policy trajectories of each batch is drawn (see ReplayBuffer).
+        self.replay_capacity = self.hps.get("replay_capacity", 0)
         # idem, but from `self.test_data` during validation.
         self.valid_offline_ratio = 1
         # If True, print messages during training
@@ -125,8 +295,81 @@ class GFNTrainer:
         self._validate_parameters = False
         # Pickle messages to reduce load on shared memory (conversely, increases load on CPU)
         self.pickle_messages = hps.get("mp_pickle_messages", False)
+        # Have workers send batches as shared-memory buffers of tensors (see PackedBatch)
+        self.pack_batches = self.hps.get("pack_batches", False)
+        # Have workers write their logs from a background thread (see SQLiteLog), and in which format
+        # ("sqlite" or "parquet", see gflownet.data.log_sinks)
+        self.log_write_behind = self.hps.get("log_write_behind", False)
+        self.log_format = self.hps.get("log_format", "sqlite")
+        # Time the stages of sampling and training, and log them as time_* scalars (see gflownet.utils.timing)
+        self.timers_enabled = self.hps.get("timers", False)
+        timers.enabled = self.timers_enabled
+        # Training metrics are kept on the device and reduced (with `log_reductions`, see MetricAccumulator)
+        # every `log_every` steps, and written to wandb/tensorboard by a background thread if `async_logging`.
+        # The finiteness check of the loss of every step (`validate_loss`) is then the only per-step sync.
+        self.log_every = self.hps.get("log_every", 1)
+        self.log_reductions = self.hps.get("log_reductions", ["mean"])
+        self.async_logging = self.hps.get("async_logging", True)
+        self.validate_loss = self.hps.get("validate_loss", True)
+        self._log_writer: Optional[AsyncMetricWriter] = None
+        self._log_lock = threading.Lock()
+        # Checkpoints hold the full training state (see `state_dict`), and are written by a background thread
+        # if `async_checkpointing`, keeping the last `checkpoint_keep_last` (all if None). If `resume` is True,
+        # `run` resumes from the latest checkpoint of log_dir (if any), if it is a path, from that checkpoint.
+        self.async_checkpointing = self.hps.get("async_checkpointing", True)
+        self.checkpoint_keep_last = self.hps.get("checkpoint_keep_last")
+        self._checkpointer: Optional[AsyncCheckpointer] = None
+        self._last_checkpoint_step: Optional[int] = None
+        # The rng states of the sampling workers after the last batch each sent, and the id of the worker
+        # sending the next batch (the DataLoader takes batches from its workers in turn)
+        self._worker_rng_states: Dict[int, Dict[str, Any]] = {}
+        self._next_worker = 0
+        # The seed of the training DataLoader's generator, from which it seeds its workers
+        self._loader_seed: Optional[int] = None
+        self._resume_state: Optional[Dict[str, Any]] = None
+        self._train_iterator: Optional[SamplingIterator] = None
+        self.replay_buffer: Optional[ReplayBuffer] = None
+        # If `async_validation`, training doesn't stop for validation, which runs concurrently on a snapshot
+        # of the weights, with at most `max_inflight_validations` snapshots being validated or waiting to be
+        # (see gflownet.utils.validation). The validation model can live on `valid_device`. Results are logged at
+        # the step of their snapshot, once ready. This requires workers, without which the validation thread
+        # would sample with the same context, algorithm and task (and their generators) as training.
+        self.async_validation = self.hps.get("async_validation", False)
+        self.max_inflight_validations = self.hps.get("max_inflight_validations", 1)
+        if self.async_validation and self.num_workers == 0:
+            raise ValueError("async_validation requires num_data_loader_workers > 0")
+        self.valid_device = torch.device(self.hps.get("valid_device") or device)
+        if self.valid_device != torch.device(device) and not self.async_validation:
+            raise ValueError("valid_device requires async_validation")
+        # If set, a window of training steps is profiled, see gflownet.utils.profiling.default_profile_hps
+        self.profile_hps = None
+        if self.hps.get("profile") is not None:
+            self.profile_hps = {**default_profile_hps(), **self.hps["profile"]}
+        # Opt-in mixed precision: if "bf16" or "fp16", the model's forward passes (but not logZ and the
+        # loss) are autocast to that dtype during training and validation, and the sampling model's
+        # during sampling, unless `sampling_amp` says otherwise (it can't when sampling_model is model).
+        # fp16 requires CUDA, and uses a GradScaler (see FusedOptimizerStep).
+        self.amp = self.hps.get("amp")
+        self.sampling_amp = self.hps.get("sampling_amp", self.amp)
+        for amp in (self.amp, self.sampling_amp):
+            if amp is not None and amp not in AMP_DTYPES:
+                raise ValueError(f"Unknown amp dtype {amp}, expected one of {list(AMP_DTYPES)}")
+            if amp == "fp16" and self.device.type != "cuda":
+                raise ValueError("fp16 autocasting requires a CUDA device, use bf16 on CPU")
+        # If "script" or "compile", sampling (and validation) uses a compiled inference module of the model,
+        # which shares its parameters, see gflownet.utils.compile. ("freeze" isn't allowed, as it would
+        # make sampling ignore the parameter updates.) If "quantize", the output heads of the model run in int8
+        # on CPU, in copies that are re-quantized after parameter updates.
+        self.compile_sampling_model = self.hps.get("compile_sampling_model")
+        if self.compile_sampling_model not in (None, "script", "compile", "quantize"):
+            raise ValueError(f"Unknown compile_sampling_model {self.compile_sampling_model}")
+        if self.compile_sampling_model == "quantize" and (self.device.type != "cpu" or self.sampling_amp is not None):
+            raise ValueError("A quantized sampling model requires a CPU device, without sampling_amp")
 
         self.setup()
+        if self.sampling_model is not self.model:
+            self._set_autocast_dtype(self.sampling_model, self.sampling_amp)
+        self._set_autocast_dtype(self.model, self.amp)
 
     def default_hps(self) -> Dict[str, Any]:
         raise NotImplementedError()
@@ -137,24 +380,56 @@ class GFNTrainer:
     def step(self, loss: Tensor):
         raise NotImplementedError()
 
-    def _wrap_model_mp(self, model):
-        """Wraps a nn.Module instance so that it can be shared to `DataLoader` workers."""
-        model.to(self.device)
+    def _set_autocast_dtype(self, model: nn.Module, amp: Optional[str]):
+        # See GraphTransformerGFN.autocast_dtype. The forward passes of the models run in the main process
+        # (even those of workers, through wrap_model_mp), and set up their own (thread-local) autocast.
+        model.autocast_dtype = AMP_DTYPES[amp] if amp is not None else None
+
+    def _wrap_model_mp(self, model, compile_mode: Optional[str] = None, device: Optional[torch.device] = None):
+        """Wraps a nn.Module instance so that it can be shared to `DataLoader` workers. If `compile_mode` is
+        not None, its compiled inference module is used instead (see gflownet.utils.compile). The model is
+        moved to `device` (`self.device` if None)."""
+        device = device or self.device
+        model.to(device)
+        model = compile_for_inference(model, compile_mode)
         if self.num_workers > 0:
-            placeholder = wrap_model_mp(
-                model,
-                self.num_workers,
-                cast_types=(gd.Batch, GraphActionCategorical),
-                pickle_messages=self.pickle_messages,
-            )
-            return placeholder, torch.device("cpu")
-        return model, self.device
+            return self._make_mp_proxy(model).placeholder, torch.device("cpu")
+        return model, device
+
+    def _make_mp_proxy(self, model: nn.Module, **kwargs) -> MPModelProxy:
+        """Creates the proxy serving the calls of `DataLoader` workers to `model`. `kwargs` are passed to
+        MPModelProxy, subclasses can override this to set its options (e.g. `count_bytes`)."""
+        return MPModelProxy(
+            model,
+            self.num_workers,
+            cast_types=(gd.Batch, GraphActionCategorical),
+            pickle_messages=self.pickle_messages,
+            **kwargs,
+        )
 
     def build_callbacks(self):
         return {}
 
+    def _build_replay_buffer(self) -> ReplayBuffer:
+        # Multi-objective tasks have a flat reward and a preference weight per objective
+        objectives = self.hps.get("objectives")
+        return ReplayBuffer(
+            self.replay_capacity,
+            max_traj_len=self.hps.get("replay_max_traj_len", self.algo.graph_sampler.max_len + 1),
+            cond_info_dim=self.ctx.num_cond_dim,
+            num_objectives=len(objectives) if objectives is not None else 1,
+            num_preferences=len(objectives) if objectives is not None else 0,
+            store_bck_actions=getattr(self.algo, "p_b_is_parameterized", False),
+            sampling=self.hps.get("replay_sampling", "uniform"),
+            alpha=self.hps.get("replay_alpha", 1.0),
+            recency_half_life=self.hps.get("replay_recency_half_life", 1000.0),
+            warmup=self.hps.get("replay_warmup", 1000),
+        )
+
     def build_training_data_loader(self) -> DataLoader:
-        model, dev = self._wrap_model_mp(self.sampling_model)
+        model, dev = self._wrap_model_mp(self.sampling_model, self.compile_sampling_model)
+        # The buffer must be created before the workers are, so that its shared memory is inherited
+        self.replay_buffer = replay_buffer = self._build_replay_buffer() if self.replay_capacity > 0 else None
         iterator = SamplingIterator(
             self.training_data,
             model,
@@ -166,7 +441,17 @@ class GFNTrainer:
             ratio=self.offline_ratio,
             log_dir=os.path.join(self.hps["log_dir"], "train"),
             random_action_prob=self.hps.get("random_action_prob", 0.0),
+            pack_batches=self.pack_batches,
+            log_write_behind=self.log_write_behind,
+            log_format=self.log_format,
+            timers_enabled=self.timers_enabled,
+            cprofile_window=self._worker_cprofile_window(),
+            cprofile_dir=os.path.join(self.hps["log_dir"], "profile"),
+            replay_buffer=replay_buffer,
+            replay_ratio=self.hps.get("replay_ratio", 0.5),
+            rng_states=self._worker_rng_states_to_resume(),
         )
+        self._train_iterator = iterator
         for hook in self.sampling_hooks:
             iterator.add_log_hook(hook)
         return torch.utils.data.DataLoader(
@@ -174,13 +459,60 @@ class GFNTrainer:
             batch_size=None,
             num_workers=self.num_workers,
             persistent_workers=self.num_workers > 0,
-            # The 2 here is an odd quirk of torch 1.10, it is fixed and
-            # replaced by None in torch 2.
-            prefetch_factor=1 if self.num_workers else 2,
+            # Without workers, prefetch_factor must be left to its default (2 in
+            # torch 1.10, None in torch 2, which rejects any other value).
+            **({"prefetch_factor": 1} if self.num_workers else {}),
+            # The seed of the workers is drawn from this generator rather than torch's global one, whose
+            # state is checkpointed, and would otherwise depend on when the DataLoader is first iterated
+            generator=torch.Generator().manual_seed(self._training_loader_seed()),
         )
 
-    def build_validation_data_loader(self) -> DataLoader:
-        model, dev = self._wrap_model_mp(self.model)
+    def _training_loader_seed(self) -> int:
+        """Seeds the training DataLoader from torch's global generator, or with the seed of the run being resumed"""
+        resumed = (self._resume_state or {}).get("worker_rng") or {}
+        if resumed.get("loader_seed") is not None:
+            self._loader_seed = resumed["loader_seed"]
+        else:
+            self._loader_seed = int(torch.randint(2**62, ()))
+        return self._loader_seed
+
+    def _worker_rng_states_to_resume(self) -> Optional[Dict[int, Dict[str, Any]]]:
+        if self._resume_state is None or self._resume_state.get("worker_rng") is None:
+            return None
+        saved = self._resume_state["worker_rng"]
+        if saved["num_workers"] != self.num_workers:
+            warnings.warn(
+                f"Resuming with {self.num_workers} workers rather than {saved['num_workers']}, their random "
+                "number generators are seeded anew"
+            )
+            return None
+        if self.num_workers == 0:
+            return saved["states"]
+        # Worker w of the resumed DataLoader sends the first batch if w == 0, so it takes the place of the
+        # worker that would have sent the next batch
+        states = {}
+        for w in range(self.num_workers):
+            state = saved["states"].get((w + saved["next_worker"]) % self.num_workers)
+            if state is not None:
+                states[w] = state
+        return states
+
+    def _worker_cprofile_window(self) -> Optional[Tuple[int, int]]:
+        if self.profile_hps is None or not self.profile_hps["profile_workers"]:
+            return None
+        # The training DataLoader's first batch is used for step start_at_step + 1
+        first_step = self.hps.get("start_at_step", 0) + 1
+        start = self.profile_hps["start_step"] - first_step
+        return (start, start + self.profile_hps["num_steps"])
+
+    def build_validation_data_loader(self, model: Optional[nn.Module] = None) -> DataLoader:
+        """The validation DataLoader, sampling from `model` (`self.model` if None)"""
+        device = self.device
+        if model is None:
+            model = self.model
+        elif self.async_validation:
+            device = self.valid_device
+        model, dev = self._wrap_model_mp(model, self.compile_sampling_model, device)
         iterator = SamplingIterator(
             self.test_data,
             model,
@@ -194,6 +526,10 @@ class GFNTrainer:
             sample_cond_info=self.hps.get("valid_sample_cond_info", True),
             stream=False,
             random_action_prob=self.hps.get("valid_random_action_prob", 0.0),
+            pack_batches=self.pack_batches,
+            log_write_behind=self.log_write_behind,
+            log_format=self.log_format,
+            timers_enabled=self.timers_enabled,
         )
         for hook in self.valid_sampling_hooks:
             iterator.add_log_hook(hook)
@@ -202,15 +538,17 @@ class GFNTrainer:
             batch_size=None,
             num_workers=self.num_workers,
             persistent_workers=self.num_workers > 0,
-            prefetch_factor=1 if self.num_workers else 2,
+            **({"prefetch_factor": 1} if self.num_workers else {}),
         )
 
     def train_batch(self, batch: gd.Batch, epoch_idx: int, batch_idx: int) -> Dict[str, Any]:
         try:
-            loss, info = self.algo.compute_batch_losses(self.model, batch)
-            if not torch.isfinite(loss):
+            with timers("train/compute_batch_losses"):
+                loss, info = self.algo.compute_batch_losses(self.model, batch)
+            if self.validate_loss and not torch.isfinite(loss):
                 raise ValueError("loss is not finite")
-            step_info = self.step(loss)
+            with timers("train/step"):
+                step_info = self.step(loss)
             if self._validate_parameters and not all([torch.isfinite(i).all() for i in self.model.parameters()]):
                 raise ValueError("parameters are not finite")
         except ValueError as e:
@@ -222,13 +560,19 @@ class GFNTrainer:
             info.update(step_info)
         if hasattr(batch, "extra_info"):
             info.update(batch.extra_info)
-        return {k: v.item() if hasattr(v, "item") else v for k, v in info.items()}
-
-    def evaluate_batch(self, batch: gd.Batch, epoch_idx: int = 0, batch_idx: int = 0) -> Dict[str, Any]:
-        loss, info = self.algo.compute_batch_losses(self.model, batch)
+        if self.timers_enabled:
+            # Timings of this process, those of workers are in batch.extra_info
+            info.update(timers.pop())
+        # Scalars are left as (device) tensors, to be reduced by a MetricAccumulator
+        return info
+
+    def evaluate_batch(
+        self, batch: gd.Batch, epoch_idx: int = 0, batch_idx: int = 0, model: Optional[nn.Module] = None
+    ) -> Dict[str, Any]:
+        loss, info = self.algo.compute_batch_losses(self.model if model is None else model, batch)
         if hasattr(batch, "extra_info"):
             info.update(batch.extra_info)
-        return {k: v.item() if hasattr(v, "item") else v for k, v in info.items()}
+        return info
 
     def run(self, logger=None):
         """Trains the GFN for `num_training_steps` minibatches, performing
@@ -238,59 +582,227 @@ class GFNTrainer:
             logger = create_logger(logfile=self.hps["log_dir"] + "/train.log")
         self.model.to(self.device)
         self.sampling_model.to(self.device)
+        self._maybe_resume(logger)
         epoch_length = max(len(self.training_data), 1)
         valid_freq = self.hps.get("validate_every", 0)
         # If checkpoint_every is not specified, checkpoint at every validation epoch
         ckpt_freq = self.hps.get("checkpoint_every", valid_freq)
         train_dl = self.build_training_data_loader()
-        valid_dl = self.build_validation_data_loader()
+        validator = valid_model = None
+        if valid_freq > 0 and self.async_validation:
+            # The model validated by the background thread, into which the snapshots are loaded
+            valid_model = copy.deepcopy(self.model).to(self.valid_device)
+        valid_dl = self.build_validation_data_loader(valid_model)
         callbacks = self.build_callbacks()
+        if valid_model is not None:
+
+            def validate_snapshot(weights, it):
+                valid_model.load_state_dict(weights)
+                self._validate(valid_dl, callbacks, it, logger, valid_model)
+
+            validator = AsyncValidator(validate_snapshot, self.max_inflight_validations)
+        if self._resume_state is not None:
+            self._restore_sampling_state()
         start = self.hps.get("start_at_step", 0) + 1
+        # Batches are moved to the device ahead of time by a background thread, keeping up to
+        # `prefetch_depth` batches ready. If 0, batches are fetched and moved synchronously. This is
+        # only done with worker processes, otherwise the thread would be sampling from the model while
+        # it is being updated.
+        prefetch_depth = self.hps.get("prefetch_depth", 2) if self.num_workers > 0 else 0
+        if prefetch_depth > 0:
+            train_batches = DevicePrefetcher(cycle(train_dl), self.device, prefetch_depth)
+        else:
+            train_batches = (batch.to(self.device) for batch in cycle(train_dl))
+        profiler = None
+        if self.profile_hps is not None:
+            profiler = TorchProfileWindow(self.profile_hps, os.path.join(self.hps["log_dir"], "profile"))
+        metrics = MetricAccumulator(self.log_reductions)
         logger.info("Starting training")
-        for it, batch in zip(range(start, 1 + self.hps["num_training_steps"]), cycle(train_dl)):
+        for it in range(start, 1 + self.hps["num_training_steps"]):
+            if profiler is not None:
+                profiler.step(it)
+            # Time spent waiting for data, if this is large, training is bottlenecked by sampling
+            t0 = time.time()
+            batch = next(train_batches)
+            data_wait_time = time.time() - t0
+            self._record_worker_rng_state(batch)
             epoch_idx = it // epoch_length
             batch_idx = it % epoch_length
-            info = self.train_batch(batch.to(self.device), epoch_idx, batch_idx)
-            self.log(info, it, "train")
-            if self.verbose:
-                logger.info(f"iteration {it} : " + " ".join(f"{k}:{v:.2f}" for k, v in info.items()))
+            info = self.train_batch(batch, epoch_idx, batch_idx)
+            info["data_wait_time"] = data_wait_time
+            metrics.add(info)
+            if len(metrics) >= self.log_every or it == self.hps["num_training_steps"]:
+                info = metrics.reduce()
+                self.log(info, it, "train")
+                if self.verbose:
+                    logger.info(f"iteration {it} : " + " ".join(f"{k}:{v:.2f}" for k, v in info.items()))
 
             if valid_freq > 0 and it % valid_freq == 0:
-                for batch in valid_dl:
-                    info = self.evaluate_batch(batch.to(self.device), epoch_idx, batch_idx)
-                    self.log(info, it, "valid")
-                    logger.info(f"validation - iteration {it} : " + " ".join(f"{k}:{v:.2f}" for k, v in info.items()))
-                end_metrics = {}
-                for c in callbacks.values():
-                    if hasattr(c, "on_validation_end"):
-                        c.on_validation_end(end_metrics)
-                self.log(end_metrics, it, "valid_end")
+                if validator is not None:
+                    validator.submit(self.model, it, self.valid_device)
+                else:
+                    self._validate(valid_dl, callbacks, it, logger, self.model, epoch_idx, batch_idx)
             if ckpt_freq > 0 and it % ckpt_freq == 0:
                 self._save_state(it)
-        self._save_state(self.hps["num_training_steps"])
+        if profiler is not None:
+            profiler.close()
+        if prefetch_depth > 0:
+            train_batches.close()
+        if self._last_checkpoint_step != self.hps["num_training_steps"]:
+            self._save_state(self.hps["num_training_steps"])
+        self._checkpointer.close()
+        if validator is not None:
+            validator.close()
+        self.close_log()
+
+    def _validate(self, valid_dl, callbacks, it, logger, model, epoch_idx=0, batch_idx=0):
+        """Validates `model` as it is at step `it`, logs the metrics of the validation set and those of the
+        callbacks"""
+        device = next(model.parameters()).device
+        # The metrics of the whole validation set are reduced and logged once
+        valid_metrics = MetricAccumulator(self.log_reductions)
+        for batch in valid_dl:
+            valid_metrics.add(self.evaluate_batch(batch.to(device), epoch_idx, batch_idx, model))
+        info = valid_metrics.reduce()
+        self.log(info, it, "valid")
+        logger.info(f"validation - iteration {it} : " + " ".join(f"{k}:{v:.2f}" for k, v in info.items()))
+        end_metrics = {}
+        for c in callbacks.values():
+            if hasattr(c, "on_validation_end"):
+                c.on_validation_end(end_metrics)
+        self.log(end_metrics, it, "valid_end")
+
+    def _record_worker_rng_state(self, batch):
+        if self.num_workers == 0:
+            return
+        # Batches of workers carry the state of their generators (see SamplingIterator)
+        rng_state = getattr(batch, "rng_state", None)
+        if rng_state is not None:
+            self._worker_rng_states[rng_state["worker"]] = rng_state
+            self._next_worker = (rng_state["worker"] + 1) % self.num_workers
+
+    def state_dict(self, it: int) -> Dict[str, Any]:
+        """The state needed to resume training after step `it`: the models, optimizer, replay buffer, step, and
+        the random number generators of the main process and of the sampling workers.
+
+        Training resumes exactly as it would have continued without workers. With workers, each worker
+        continues its stream of random numbers from the last batch it sent that was trained on, but batches
+        they had sampled ahead of training are sampled again, with the checkpointed sampling model.
+        """
+        if self.num_workers == 0 and self._train_iterator is not None and hasattr(self._train_iterator, "rng"):
+            # Without workers, sampling happens in this process, with the generators of the iterator
+            self._worker_rng_states = {0: self._train_iterator._get_rng_state(in_worker=False)}
+        optimizer_step = getattr(self, "optimizer_step", None)
+        return {
+            "models_state_dict": [self.model.state_dict()],
+            "sampling_model_state_dict": (
+                self.sampling_model.state_dict() if self.sampling_model is not self.model else None
+            ),
+            "optimizer_step": optimizer_step.state_dict() if optimizer_step is not None else None,
+            "replay_buffer": self.replay_buffer.state_dict() if self.replay_buffer is not None else None,
+            "rng": get_rng_state({}),
+            "worker_rng": {
+                "num_workers": self.num_workers,
+                "next_worker": self._next_worker,
+                "states": self._worker_rng_states,
+                "loader_seed": self._loader_seed,
+            },
+            "hps": self.hps,
+            "step": it,
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """Loads a checkpoint (see `state_dict`) to resume training from, before `run` builds its data loaders.
+        The models and optimizer are restored right away, the replay buffer and random number generators once
+        the data loaders are built. Checkpoints that only have the models' state are also accepted."""
+        self.model.load_state_dict(state["models_state_dict"][0])
+        if self.sampling_model is not self.model:
+            sampling_state = state.get("sampling_model_state_dict") or state["models_state_dict"][0]
+            self.sampling_model.load_state_dict(sampling_state)
+        if state.get("optimizer_step") is not None and hasattr(self, "optimizer_step"):
+            self.optimizer_step.load_state_dict(state["optimizer_step"])
+        missing = [k for k in ["optimizer_step", "rng", "worker_rng"] if state.get(k) is None]
+        if missing:
+            warnings.warn(f"The checkpoint has no {missing}, these are initialized anew")
+        self.hps["start_at_step"] = state["step"]
+        self._resume_state = state
+
+    def _maybe_resume(self, logger):
+        resume = self.hps.get("resume", False)
+        if resume is False or resume is None:
+            return
+        path = latest_checkpoint(self.hps["log_dir"]) if resume is True else resume
+        if path is None:
+            logger.info("No checkpoint to resume from, starting from scratch")
+            return
+        logger.info(f"Resuming from {path}")
+        self.load_state_dict(load_checkpoint(str(path)))
+
+    def _restore_sampling_state(self):
+        state, self._resume_state = self._resume_state, None
+        if state.get("replay_buffer") is not None and self.replay_buffer is not None:
+            self.replay_buffer.load_state_dict(state["replay_buffer"])
+        if state.get("worker_rng") is not None:
+            self._worker_rng_states = dict(state["worker_rng"]["states"])
+            self._next_worker = state["worker_rng"]["next_worker"] % max(self.num_workers, 1)
+        if state.get("rng") is not None:
+            set_rng_state(state["rng"])
 
     def _save_state(self, it):
-        file_path = pathlib.Path(self.hps["log_dir"]) / f"step_{it}" / "model_state.pt"
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        torch.save(
-            {
-                "models_state_dict": [self.model.state_dict()],
-                "hps": self.hps,
-                "step": it,
-            },
-            open(file_path, "wb"),
-        )
+        if self._checkpointer is None:
+            self._checkpointer = AsyncCheckpointer(
+                self.hps["log_dir"], self.checkpoint_keep_last, asynchronous=self.async_checkpointing
+            )
+        self._checkpointer.save(self.state_dict(it), it)
+        self._last_checkpoint_step = it
 
     def log(self, info, index, key):
-        if self.hps.get('wandb') is not None:
-            if not hasattr(self, '_wandb_run'):
-                self._wandb_run = wandb.init(project=self.hps['wandb'], dir=self.hps['log_dir'], config={k: v for k, v in self.hps.items() if k != 'wandb'})
-            wandb.log({f'{key}_{k}': v for k, v in info.items()}, step=index) 
+        # Called from the validation thread too with `async_validation`
+        with self._log_lock:
+            self._log(info, index, key)
+
+    def _log(self, info, index, key):
+        # wandb and tensorboard are slow to import, and only imported when logging to them. They are set up
+        # here, and written to by `_write_log`, in a background thread if `async_logging`.
+        if self.hps.get("wandb") is not None:
+            import wandb
+
+            if not hasattr(self, "_wandb_run"):
+                self._wandb_run = wandb.init(
+                    project=self.hps["wandb"],
+                    dir=self.hps["log_dir"],
+                    config={k: v for k, v in self.hps.items() if k != "wandb"},
+                )
+        elif not hasattr(self, "_summary_writer"):
+            from torch.utils.tensorboard import SummaryWriter
+
+            self._summary_writer = SummaryWriter(self.hps["log_dir"])
+        if not self.async_logging:
+            return self._write_log(info, index, key)
+        if self._log_writer is None:
+            self._log_writer = AsyncMetricWriter(self._write_log)
+        self._log_writer(info, index, key)
+
+    def _write_log(self, info, index, key):
+        if self.hps.get("wandb") is not None:
+            if self.async_validation and key in ["valid", "valid_end"]:
+                # wandb ignores steps older than its latest one, which late validation results are. They are
+                # instead logged against their own step metric.
+                self._wandb_run.define_metric(f"{key}_*", step_metric=f"{key}_step")
+                self._wandb_run.log({**{f"{key}_{k}": v for k, v in info.items()}, f"{key}_step": index})
+                return
+            self._wandb_run.log({f"{key}_{k}": v for k, v in info.items()}, step=index)
         else:
-            if not hasattr(self, '_summary_writer'):
-                self._summary_writer = torch.utils.tensorboard.SummaryWriter(self.hps['log_dir'])
             for k, v in info.items():
-                self._summary_writer.add_scalar(f'{key}_{k}', v, index)
+                self._summary_writer.add_scalar(f"{key}_{k}", v, index)
+
+    def close_log(self):
+        """Waits for the pending writes of `log`"""
+        if self._log_writer is not None:
+            self._log_writer.close()
+            self._log_writer = None
+        if hasattr(self, "_summary_writer"):
+            self._summary_writer.flush()
 
 
 def cycle(it):
@@ -0,0 +1,203 @@
+"""Resumable checkpoints of GFNTrainer, written to disk by a background thread.
+
+A checkpoint holds everything needed to resume training where it stopped (see `GFNTrainer.state_dict`): the
+models, the optimizer, LR schedulers and GradScaler (`FusedOptimizerStep.state_dict`), the replay buffer,
+and the state of the random number generators of the main process and of each sampling worker. The latter
+travel with the batches (as their `rng_state`, see SamplingIterator), so that the trainer knows the state of
+each worker right after the last batch it trained on.
+
+`AsyncCheckpointer.save` only copies the state to (CPU) memory, which takes milliseconds, then writes it to
+`log_dir/step_{step}/model_state.pt` from a background thread. The file is written under a temporary name
+and renamed once complete, so that a job killed mid-write never leaves a truncated checkpoint behind.
+"""
+
+import inspect
+import os
+import pathlib
+import random
+import re
+import threading
+import warnings
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from torch import Tensor
+
+CHECKPOINT_NAME = "model_state.pt"
+
+
+def checkpoint_path(log_dir: str, step: int) -> pathlib.Path:
+    return pathlib.Path(log_dir) / f"step_{step}" / CHECKPOINT_NAME
+
+
+def list_checkpoints(log_dir: str) -> List[pathlib.Path]:
+    """The (complete) checkpoints of `log_dir`, sorted by step"""
+    steps = []
+    for d in pathlib.Path(log_dir).glob("step_*"):
+        m = re.fullmatch(r"step_(\d+)", d.name)
+        if m is not None and (d / CHECKPOINT_NAME).is_file():
+            steps.append(int(m.group(1)))
+    return [checkpoint_path(log_dir, s) for s in sorted(steps)]
+
+
+def latest_checkpoint(log_dir: str) -> Optional[pathlib.Path]:
+    checkpoints = list_checkpoints(log_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path: str) -> Dict[str, Any]:
+    # Checkpoints hold numpy rng states, which torch >= 2.6 doesn't load by default
+    kwargs = {"weights_only": False} if "weights_only" in inspect.signature(torch.load).parameters else {}
+    return torch.load(path, map_location="cpu", **kwargs)
+
+
+def _generator_state(rng: np.random.Generator) -> Dict[str, Any]:
+    return rng.bit_generator.state
+
+
+def _generator_from_state(state: Dict[str, Any]) -> np.random.Generator:
+    bit_generator = getattr(np.random, state["bit_generator"])()
+    bit_generator.state = state
+    return np.random.Generator(bit_generator)
+
+
+def get_rng_state(generators: Dict[str, np.random.Generator], process: bool = True) -> Dict[str, Any]:
+    """Captures the state of random number generators
+
+    Parameters
+    ----------
+    generators: Dict[str, np.random.Generator]
+        Named numpy Generators. Some may be the same object (e.g. the task and the algorithm often share
+        their rng), which `set_rng_state` preserves.
+    process: bool
+        If True, the state of the process-wide generators (torch's, numpy's legacy global one and Python's,
+        and CUDA's if initialized) is included.
+
+    Returns
+    -------
+    state: Dict[str, Any]
+        The state, made of dicts, lists and numpy arrays only, so that it can be sent along with a batch
+        (whose `to(device)` would move tensors).
+    """
+    unique: Dict[int, int] = {}
+    states = []
+    for rng in generators.values():
+        if id(rng) not in unique:
+            unique[id(rng)] = len(states)
+            states.append(_generator_state(rng))
+    state: Dict[str, Any] = {"generators": states, "names": {k: unique[id(v)] for k, v in generators.items()}}
+    if process:
+        state["torch"] = torch.get_rng_state().numpy()
+        state["numpy"] = np.random.get_state(legacy=False)
+        state["python"] = random.getstate()
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            state["cuda"] = [s.numpy() for s in torch.cuda.get_rng_state_all()]
+    return state
+
+
+def set_rng_state(state: Dict[str, Any]) -> Dict[str, np.random.Generator]:
+    """Restores the process-wide generators captured by `get_rng_state` (if any), and returns new numpy
+    Generators in the state of the named ones, which the caller must put in place of the old ones"""
+    if "torch" in state:
+        torch.set_rng_state(torch.from_numpy(np.asarray(state["torch"], dtype=np.uint8)))
+        np.random.set_state(state["numpy"])
+        version, internal, gauss = state["python"]
+        random.setstate((version, tuple(internal), gauss))
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([torch.from_numpy(s) for s in state["cuda"]])
+    generators = [_generator_from_state(s) for s in state["generators"]]
+    return {k: generators[i] for k, i in state["names"].items()}
+
+
+def snapshot(obj: Any) -> Any:
+    """Copies the tensors of a nested structure of dicts, lists and tuples (e.g. state dicts) to CPU memory,
+    so that it can be written to disk while training keeps updating the originals. CUDA tensors are copied
+    asynchronously to pinned memory, with a single synchronization."""
+    copies_from_cuda = []
+
+    def copy(x):
+        if isinstance(x, Tensor):
+            if x.is_cuda:
+                out = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+                out.copy_(x.detach(), non_blocking=True)
+                copies_from_cuda.append(out)
+                return out
+            return x.detach().clone()
+        if isinstance(x, dict):
+            return type(x)((k, copy(v)) for k, v in x.items())
+        if isinstance(x, (list, tuple)):
+            return type(x)(copy(v) for v in x)
+        return x
+
+    out = copy(obj)
+    if copies_from_cuda:
+        torch.cuda.synchronize()
+    return out
+
+
+class AsyncCheckpointer:
+    def __init__(self, log_dir: str, keep_last: Optional[int] = None, asynchronous: bool = True):
+        """Writes checkpoints to `log_dir/step_{step}/model_state.pt`, see the module docstring.
+
+        Parameters
+        ----------
+        log_dir: str
+            The directory of the checkpoints.
+        keep_last: Optional[int]
+            If not None, only the last `keep_last` checkpoints of `log_dir` are kept, older ones are
+            deleted once a new one is written.
+        asynchronous: bool
+            If True, checkpoints are written by a background thread, at most one at a time: `save` waits
+            for the previous checkpoint to be written. Errors are raised by the next call to `save`, or by
+            `close`.
+        """
+        if keep_last is not None and keep_last < 1:
+            raise ValueError(f"keep_last must be at least 1, got {keep_last}")
+        self.log_dir = log_dir
+        self.keep_last = keep_last
+        self.asynchronous = asynchronous
+        self._thread: Optional[threading.Thread] = None
+        self._error: Optional[BaseException] = None
+
+    def save(self, state: Dict[str, Any], step: int):
+        self.wait()
+        state = snapshot(state)
+        if not self.asynchronous:
+            return self._write(state, step)
+        self._thread = threading.Thread(target=self._write_in_thread, args=(state, step), daemon=True)
+        self._thread.start()
+
+    def _write_in_thread(self, state: Dict[str, Any], step: int):
+        try:
+            self._write(state, step)
+        except Exception as e:
+            self._error = e
+
+    def _write(self, state: Dict[str, Any], step: int):
+        path = checkpoint_path(self.log_dir, step)
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            torch.save(state, f)
+        os.replace(tmp_path, path)
+        if self.keep_last is not None:
+            for old in list_checkpoints(self.log_dir)[: -self.keep_last]:
+                old.unlink()
+                try:
+                    old.parent.rmdir()
+                except OSError:  # Not empty
+                    warnings.warn(f"Deleted the checkpoint {old}, but not its directory, which isn't empty")
+
+    def wait(self):
+        """Waits for the checkpoint being written, if any"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        """Waits for the pending checkpoint"""
+        self.wait()
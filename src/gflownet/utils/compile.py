@@ -0,0 +1,144 @@
+"""Compiled inference paths for the models that are called many times on small batches, i.e. the sampling
+model (GraphTransformerGFN) and the sEH proxy (bengio2021flow.MPNNet), for which Python and dispatcher
+overheads dominate in eager mode.
+
+Models supporting it implement `inference_module(mode)`, which compiles the tensor-only part of their
+forward pass with `compile_module`, and returns a module with the same interface as the model, meant to be
+used without gradients. Whatever works on torch_geometric Batches or builds GraphActionCategoricals stays in
+eager mode.
+
+The "quantize" mode instead replaces (some of) the Linear and recurrent layers of the model by int8
+dynamically quantized copies, see `DynamicQuantized`, which only run on CPU. Its accuracy and speed relative
+to fp32 are measured by `python -m gflownet.benchmarks quantization`.
+"""
+
+import warnings
+from typing import Callable, Iterable, List, Optional, Type
+
+import torch
+import torch.nn as nn
+
+COMPILE_MODES = ["script", "freeze", "compile"]
+QUANTIZE_MODE = "quantize"
+# The layer types that torch's dynamic quantization supports
+QUANTIZABLE_TYPES = (nn.Linear, nn.GRU, nn.LSTM)
+
+
+class EagerFallback:
+    """Calls a compiled module, unless compiling it or calling it fails, in which case a warning is emitted
+    and the eager module is used from then on (e.g. torch.compile only compiles on the first call)."""
+
+    def __init__(self, compiled: Optional[Callable], eager: nn.Module):
+        self.compiled = compiled
+        self.eager = eager
+
+    def __call__(self, *args):
+        if self.compiled is not None:
+            try:
+                return self.compiled(*args)
+            except Exception as e:
+                warnings.warn(f"Compiled {type(self.eager).__name__} failed, falling back to eager mode: {e!r}")
+                self.compiled = None
+        return self.eager(*args)
+
+
+def compile_module(module: nn.Module, mode: str) -> EagerFallback:
+    """Compiles a module whose forward pass takes and returns tensors.
+
+    Parameters
+    ----------
+    module: nn.Module
+        The module, which must already be on its final device.
+    mode: str
+        - "script": torch.jit.script. The scripted module shares the parameters of `module`, so that it
+          follows their (in-place) updates, e.g. those of the optimizer or of the sampling model's EMA.
+        - "freeze": torch.jit.script, then torch.jit.freeze and optimize_for_inference, which inline the
+          parameters as constants. Only for modules whose parameters don't change, e.g. proxies.
+        - "compile": torch.compile (torch >= 2.0), with dynamic shapes.
+
+    Returns
+    -------
+    module: EagerFallback
+        The compiled module, or `module` itself if it can't be compiled.
+    """
+    if mode not in COMPILE_MODES:
+        raise ValueError(f"Unknown compile mode {mode}, expected one of {COMPILE_MODES}")
+    compiled = None
+    try:
+        if mode == "compile":
+            if hasattr(torch, "compile"):
+                compiled = torch.compile(module, dynamic=True)
+            else:
+                warnings.warn("torch.compile requires torch >= 2.0, falling back to eager mode")
+        else:
+            compiled = torch.jit.script(module)
+            if mode == "freeze":
+                compiled = torch.jit.freeze(compiled.eval())
+                if hasattr(torch.jit, "optimize_for_inference"):
+                    compiled = torch.jit.optimize_for_inference(compiled)
+    except Exception as e:
+        warnings.warn(f"Could not compile {type(module).__name__}, falling back to eager mode: {e!r}")
+    return EagerFallback(compiled, module)
+
+
+class DynamicQuantized(nn.Module):
+    """An int8 dynamically quantized copy of a module, whose weights are quantized ahead of time and whose
+    activations are quantized on the fly, for inference on CPU.
+
+    The copy is rebuilt when the parameters of the module are updated in place (e.g. by the optimizer or the
+    EMA of the sampling model), which is detected through their version counters. Quantizing a small module
+    takes about a millisecond, a cost paid at most once per training step.
+    """
+
+    # Quantized modules only run on CPU. This wrapper has no parameters of its own, so it reports its device
+    # through this attribute (e.g. to MPModelProxy)
+    device = torch.device("cpu")
+
+    def __init__(self, module: nn.Module, types: Iterable[Type[nn.Module]] = (nn.Linear,)):
+        super().__init__()
+        # Not registered as a submodule, so that the parameters aren't duplicated in e.g. state_dict()
+        self._module = [module]
+        self.types = set(types)
+        self.quantized: Optional[nn.Module] = None
+        self._versions: List[int] = []
+
+    def _quantize(self):
+        module = self._module[0]
+        versions = [p._version for p in module.parameters()]
+        if self.quantized is None or versions != self._versions:
+            with torch.no_grad():
+                self.quantized = torch.ao.quantization.quantize_dynamic(module, self.types, dtype=torch.qint8)
+            self._versions = versions
+
+    def forward(self, *args, **kwargs):
+        self._quantize()
+        with torch.no_grad():
+            return self.quantized(*args, **kwargs)
+
+
+def quantize_module(module: nn.Module, types: Iterable[Type[nn.Module]] = (nn.Linear,)) -> nn.Module:
+    """Returns `DynamicQuantized(module, types)`, or, with a warning, `module` itself if it isn't on CPU or
+    torch has no quantized CPU backend.
+    """
+    if not hasattr(torch, "ao"):  # torch < 1.10
+        warnings.warn("Dynamic quantization requires torch >= 1.10, falling back to fp32")
+        return module
+    if any(p.device.type != "cpu" for p in module.parameters()):
+        warnings.warn(f"Quantized {type(module).__name__} only runs on CPU, falling back to fp32")
+        return module
+    if torch.backends.quantized.engine == "none":
+        warnings.warn("torch has no quantized CPU backend on this machine, falling back to fp32")
+        return module
+    return DynamicQuantized(module, types)
+
+
+def compile_for_inference(model: nn.Module, mode: Optional[str]) -> nn.Module:
+    """Returns the compiled (or quantized, with mode "quantize") inference module of `model` (see
+    `compile_module` for the other modes), or `model` itself if `mode` is None or the model has no compiled
+    inference path."""
+    if mode is None:
+        return model
+    if not hasattr(model, "inference_module"):
+        warnings.warn(f"{type(model).__name__} has no compiled inference path, using it in eager mode")
+        return model
+    return model.inference_module(mode)
@@ -0,0 +1,117 @@
+"""Logging of training metrics without synchronizing with the device at every step.
+
+The info dicts of training steps hold scalar tensors (e.g. losses), which `MetricAccumulator` keeps on
+their device, and only reduces and copies to the host once per window of steps (see the `log_every` hp of
+GFNTrainer). The reduced metrics are
+then written (to wandb or tensorboard) by an `AsyncMetricWriter`, from a background thread.
+"""
+
+import math
+import queue
+import threading
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import torch
+from torch import Tensor
+
+REDUCTIONS = ["mean", "min", "max"]
+
+
+class MetricAccumulator:
+    def __init__(self, reductions: Sequence[str] = ("mean",)):
+        """Accumulates the scalar metrics (Python numbers or tensors, on any device) of a window of steps.
+
+        Parameters
+        ----------
+        reductions: Sequence[str]
+            The reductions of each metric, among REDUCTIONS. The mean of metric `k` is reported as `k`, and
+            the other reductions as e.g. `k_max`.
+        """
+        for r in reductions:
+            if r not in REDUCTIONS:
+                raise ValueError(f"Unknown reduction {r}, expected one of {REDUCTIONS}")
+        self.reductions = list(reductions)
+        self._values: Dict[str, List[Any]] = {}
+        self._num_steps = 0
+
+    def __len__(self):
+        """The number of steps accumulated since the last reduction"""
+        return self._num_steps
+
+    def add(self, info: Dict[str, Any]):
+        """Adds the metrics of a step, without synchronizing with the device"""
+        for k, v in info.items():
+            # Detached, so that the autograd graph of the step isn't kept alive
+            self._values.setdefault(k, []).append(v.detach() if isinstance(v, Tensor) else v)
+        self._num_steps += 1
+
+    def reduce(self) -> Dict[str, float]:
+        """Reduces the accumulated metrics (with a single device to host copy) and starts a new window"""
+        # The (sum, min, max, count) of each metric, those of tensors are first computed on their device
+        stats: Dict[str, List[float]] = {}
+        device_keys, device_stats = [], []
+        for k, values in self._values.items():
+            numbers = [float(v) for v in values if not isinstance(v, Tensor)]
+            tensors = [v.float().reshape(()) for v in values if isinstance(v, Tensor)]
+            stats[k] = [sum(numbers), min(numbers, default=math.inf), max(numbers, default=-math.inf), len(values)]
+            if tensors:
+                x = torch.stack([t.to(tensors[0].device) for t in tensors])
+                device_keys.append(k)
+                device_stats.append(torch.stack([x.sum(), x.min(), x.max()]))
+        if device_stats:
+            device = device_stats[0].device
+            host_stats = torch.stack([s.to(device) for s in device_stats]).tolist()
+            for k, (s, lo, hi) in zip(device_keys, host_stats):
+                stats[k] = [stats[k][0] + s, min(stats[k][1], lo), max(stats[k][2], hi), stats[k][3]]
+        self._values = {}
+        self._num_steps = 0
+        reduced = {}
+        for k, (s, lo, hi, n) in stats.items():
+            for r in self.reductions:
+                name = k if r == "mean" else f"{k}_{r}"
+                reduced[name] = s / max(n, 1) if r == "mean" else lo if r == "min" else hi
+        return reduced
+
+
+class AsyncMetricWriter:
+    def __init__(self, write: Callable[[Dict[str, float], int, str], None], max_queued: int = 64):
+        """Calls `write(info, index, key)` from a background thread, in the order of the calls to this
+        object. Errors of `write` are raised by the next call, or by `close`.
+
+        Parameters
+        ----------
+        write: Callable[[Dict[str, float], int, str], None]
+            The function writing metrics, e.g. to wandb.
+        max_queued: int
+            The maximum number of pending writes, after which calls block.
+        """
+        self.write = write
+        self._error: Optional[BaseException] = None
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queued)
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def __call__(self, info: Dict[str, float], index: int, key: str):
+        if self._error is not None:
+            raise self._error
+        self._queue.put((info, index, key))
+
+    def _writer_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self._error is None:
+                try:
+                    self.write(*item)
+                except Exception as e:
+                    # Keep consuming so that callers don't block forever on a full queue
+                    self._error = e
+
+    def close(self):
+        """Waits for the pending writes"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if self._error is not None:
+            raise self._error
@@ -4,11 +4,11 @@ from itertools import product
 
 import numpy as np
 import torch
-from botorch.utils.multi_objective import infer_reference_point, pareto
-from botorch.utils.multi_objective.hypervolume import Hypervolume
 from rdkit import Chem, DataStructs
 from scipy.spatial.distance import cdist
-from sklearn.cluster import KMeans
+
+# botorch, sklearn and cvxopt are slow to import, and only needed by some of these metrics, so they are
+# imported by the functions that use them
 
 
 def get_IGD(samples, ref_front: np.ndarray = None):
@@ -131,6 +131,8 @@ def partition_hypersphere(k: int, d: int, n_samples: int = 10000, normalisation:
             raise ValueError(f"Unknown normalisation {normalisation}")
         return points
 
+    from sklearn.cluster import KMeans
+
     points = sample_positiveQuadrant_ndim_sphere(n_samples, d, normalisation)
     v = KMeans(n_clusters=k, random_state=0, n_init="auto").fit(points).cluster_centers_
     if normalisation == "l2":
@@ -157,6 +159,8 @@ def pareto_frontier(obj_vals, maximize=True):
         obj_vals: NumPy array of objective values
     ----------
     """
+    from botorch.utils.multi_objective import pareto
+
     # pareto utility assumes maximization
     if maximize:
         pareto_mask = pareto.is_non_dominated(torch.tensor(obj_vals))
@@ -199,6 +203,9 @@ def get_hypervolume(flat_rewards: torch.Tensor, zero_ref=True) -> float:
     flat_rewards: torch.Tensor
       A tensor of shape (num_trajs, num_of_objectives) containing the rewards of each trajectory.
     """
+    from botorch.utils.multi_objective import infer_reference_point
+    from botorch.utils.multi_objective.hypervolume import Hypervolume
+
     # Compute the reference point
     if zero_ref:
         reference_point = torch.zeros_like(flat_rewards[0])
@@ -2,6 +2,13 @@ import logging
 import sys
 
 
+def wandb_run():
+    """Returns the current wandb run, or None. wandb, which is slow to import, is only imported by the
+    code that starts a run, so there can't be a run if it isn't imported yet."""
+    wandb = sys.modules.get("wandb")
+    return None if wandb is None else wandb.run
+
+
 def create_logger(name="logger", loglevel=logging.INFO, logfile=None, streamHandle=True):
     logger = logging.getLogger(name)
     logger.setLevel(loglevel)
@@ -115,7 +115,7 @@ class MultiObjectiveStatsHook:
     def __call__(self, trajs, rewards, flat_rewards, cond_info):
         # locally (in-process) accumulate flat rewards to build a better pareto estimate
         self.all_flat_rewards = self.all_flat_rewards + list(flat_rewards)
-        self.all_smi = self.all_smi + list([i.get("smi", None) for i in trajs])
+        self.all_smi = self.all_smi + list([i.get("smi", None) for i in trajs.infos])
         if len(self.all_flat_rewards) > self.num_to_keep:
             self.all_flat_rewards = self.all_flat_rewards[-self.num_to_keep :]
             self.all_smi = self.all_smi[-self.num_to_keep :]
@@ -188,7 +188,7 @@ class TopKHook:
         self.num_preferences = num_preferences
 
     def __call__(self, trajs, rewards, flat_rewards, cond_info):
-        self.queue.put([(i["data_idx"], r) for i, r in zip(trajs, rewards)])
+        self.queue.put([(i["data_idx"], r) for i, r in zip(trajs.infos, rewards)])
         return {}
 
     def finalize(self):
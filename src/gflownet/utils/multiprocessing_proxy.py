@@ -1,10 +1,15 @@
+import itertools
 import pickle
 import queue
 import threading
+from typing import Optional
 
 import torch
 import torch.multiprocessing as mp
 
+from gflownet.utils.compile import compile_for_inference
+from gflownet.utils.timing import timers
+
 
 class MPModelPlaceholder:
     """This class can be used as a Model in a worker process, and
@@ -60,7 +65,14 @@ class MPModelProxy:
 
     """
 
-    def __init__(self, model: torch.nn.Module, num_workers: int, cast_types: tuple, pickle_messages: bool = False):
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        num_workers: int,
+        cast_types: tuple,
+        pickle_messages: bool = False,
+        count_bytes: bool = False,
+    ):
         """Construct a multiprocessing model proxy for torch DataLoaders.
 
         Parameters
@@ -76,14 +88,20 @@ class MPModelProxy:
             If True, pickle messages sent between processes. This reduces load on shared
             memory, but increases load on CPU. It is recommended to activate this flag if
             encountering "Too many open files"-type errors.
+        count_bytes: bool
+            If True, the size of the messages received from and sent to workers is accumulated (see
+            `num_bytes`) in `self.num_bytes_received` and `self.num_bytes_sent`.
         """
         self.in_queues = [mp.Queue() for i in range(num_workers)]  # type: ignore
         self.out_queues = [mp.Queue() for i in range(num_workers)]  # type: ignore
         self.pickle_messages = pickle_messages
         self.placeholder = MPModelPlaceholder(self.in_queues, self.out_queues, pickle_messages)
         self.model = model
-        self.device = next(model.parameters()).device
+        self.device = module_device(model)
         self.cuda_types = (torch.Tensor,) + cast_types
+        self.count_bytes = count_bytes
+        self.num_bytes_received = 0
+        self.num_bytes_sent = 0
         self.stop = threading.Event()
         self.thread = threading.Thread(target=self.run, daemon=True)
         self.thread.start()
@@ -108,28 +126,72 @@ class MPModelProxy:
         while not self.stop.is_set():
             for qi, q in enumerate(self.in_queues):
                 try:
-                    r = self.decode(q.get(True, 1e-5))
+                    r = q.get(True, 1e-5)
                 except queue.Empty:
                     continue
                 except ConnectionError:
                     break
+                if self.count_bytes:
+                    self.num_bytes_received += num_bytes(r)
+                r = self.decode(r)
                 attr, args, kwargs = r
                 f = getattr(self.model, attr)
-                args = [i.to(self.device) if isinstance(i, self.cuda_types) else i for i in args]
-                kwargs = {k: i.to(self.device) if isinstance(i, self.cuda_types) else i for k, i in kwargs.items()}
-                result = f(*args, **kwargs)
-                if isinstance(result, (list, tuple)):
-                    msg = [self.to_cpu(i) for i in result]
-                    self.out_queues[qi].put(self.encode(msg))
-                elif isinstance(result, dict):
-                    msg = {k: self.to_cpu(i) for k, i in result.items()}
-                    self.out_queues[qi].put(self.encode(msg))
-                else:
-                    msg = self.to_cpu(result)
-                    self.out_queues[qi].put(self.encode(msg))
-
-
-def wrap_model_mp(model, num_workers, cast_types, pickle_messages: bool = False):
+                # Time spent here, in the main process, excludes the IPC overheads included in the
+                # timings of the workers' calls.
+                with timers("mp_proxy/to_device"):
+                    args = [i.to(self.device) if isinstance(i, self.cuda_types) else i for i in args]
+                    kwargs = {k: i.to(self.device) if isinstance(i, self.cuda_types) else i for k, i in kwargs.items()}
+                with timers(f"mp_proxy/{attr.strip('_')}"):
+                    result = f(*args, **kwargs)
+                with timers("mp_proxy/to_cpu"):
+                    if isinstance(result, (list, tuple)):
+                        msg = [self.to_cpu(i) for i in result]
+                    elif isinstance(result, dict):
+                        msg = {k: self.to_cpu(i) for k, i in result.items()}
+                    else:
+                        msg = self.to_cpu(result)
+                    msg = self.encode(msg)
+                if self.count_bytes:
+                    self.num_bytes_sent += num_bytes(msg)
+                self.out_queues[qi].put(msg)
+
+
+def module_device(model: torch.nn.Module) -> torch.device:
+    """The device of the parameters (or buffers) of `model`. Modules without any, such as wrappers that
+    don't register the module they wrap (e.g. gflownet.utils.compile.DynamicQuantized), can set a `device`
+    attribute, and are otherwise assumed to be on CPU."""
+    for t in itertools.chain(model.parameters(), model.buffers()):
+        return t.device
+    return torch.device(getattr(model, "device", "cpu"))
+
+
+def num_bytes(obj) -> int:
+    """Estimates the number of bytes sent between processes when sending `obj`: the length of byte
+    strings (e.g. pickled messages) plus the size of the data of the tensors (which
+    torch.multiprocessing sends through shared memory) found in containers and object attributes.
+    """
+    seen = set()
+
+    def f(o):
+        if id(o) in seen:
+            return 0
+        seen.add(id(o))
+        if isinstance(o, (bytes, bytearray)):
+            return len(o)
+        if isinstance(o, torch.Tensor):
+            return o.numel() * o.element_size()
+        if isinstance(o, (list, tuple)):
+            return sum(f(i) for i in o)
+        if isinstance(o, dict):
+            return sum(f(i) for i in o.values())
+        if hasattr(o, "__dict__"):
+            return f(vars(o))
+        return 0
+
+    return f(obj)
+
+
+def wrap_model_mp(model, num_workers, cast_types, pickle_messages: bool = False, compile_mode: Optional[str] = None):
     """Construct a multiprocessing model proxy for torch DataLoaders so
     that only one process ends up making cuda calls and holding cuda
     tensors in memory.
@@ -147,6 +209,9 @@ def wrap_model_mp(model, num_workers, cast_types, pickle_messages: bool = False)
             If True, pickle messages sent between processes. This reduces load on shared
             memory, but increases load on CPU. It is recommended to activate this flag if
             encountering "Too many open files"-type errors.
+    compile_mode: Optional[str]
+        If not None, the calls are made to the compiled inference module of the model, see
+        gflownet.utils.compile.compile_for_inference.
 
     Returns
     -------
@@ -154,4 +219,5 @@ def wrap_model_mp(model, num_workers, cast_types, pickle_messages: bool = False)
         A placeholder model whose method calls route arguments to the main process
 
     """
+    model = compile_for_inference(model, compile_mode)
     return MPModelProxy(model, num_workers, cast_types, pickle_messages).placeholder
@@ -0,0 +1,129 @@
+import cProfile
+import os
+from typing import Any, Dict, Optional, Tuple
+
+import torch
+import torch.profiler
+
+
+def default_profile_hps() -> Dict[str, Any]:
+    """The default values of the `profile` hps block.
+
+    - start_step: the first training step to profile.
+    - num_steps: the number of steps to profile.
+    - activities: which activities torch.profiler records, "cpu" and/or "cuda"; by default "cuda"
+      is included if available.
+    - record_shapes: whether torch.profiler records the input shapes of operators.
+    - with_stack: whether torch.profiler records the Python stack of operators.
+    - profile_workers: whether DataLoader workers also run cProfile while producing the batches of
+      the profiled steps.
+    """
+    return {
+        "start_step": 10,
+        "num_steps": 5,
+        "activities": ["cpu", "cuda"] if torch.cuda.is_available() else ["cpu"],
+        "record_shapes": False,
+        "with_stack": False,
+        "profile_workers": False,
+    }
+
+
+class TorchProfileWindow:
+    """Runs torch.profiler for a window of training steps, then writes a Chrome trace
+    (`trace.json`, viewable in chrome://tracing or Perfetto) and key-average tables to `out_dir`.
+    """
+
+    def __init__(self, profile_hps: Dict[str, Any], out_dir: str):
+        """
+        Parameters
+        ----------
+        profile_hps: Dict[str, Any]
+            The `profile` hps block, missing values are taken from `default_profile_hps`.
+        out_dir: str
+            The directory the profiles are written to.
+        """
+        self.hps = {**default_profile_hps(), **profile_hps}
+        self.start_step = self.hps["start_step"]
+        self.end_step = self.start_step + self.hps["num_steps"]
+        self.out_dir = out_dir
+        self._prof: Optional[torch.profiler.profile] = None
+
+    def step(self, it: int):
+        """Called at the start of each training step, starts or stops profiling as needed"""
+        if it == self.start_step:
+            activities = {"cpu": torch.profiler.ProfilerActivity.CPU, "cuda": torch.profiler.ProfilerActivity.CUDA}
+            self._prof = torch.profiler.profile(
+                activities=[activities[i] for i in self.hps["activities"]],
+                record_shapes=self.hps["record_shapes"],
+                with_stack=self.hps["with_stack"],
+            )
+            self._prof.start()
+        elif self._prof is not None:
+            self._prof.step()
+            if it == self.end_step:
+                self.close()
+
+    def close(self):
+        """Stops profiling (if it is running) and writes the profiles"""
+        if self._prof is None:
+            return
+        prof, self._prof = self._prof, None
+        prof.stop()
+        os.makedirs(self.out_dir, exist_ok=True)
+        prof.export_chrome_trace(os.path.join(self.out_dir, "trace.json"))
+        sort_by = "self_cuda_time_total" if "cuda" in self.hps["activities"] else "self_cpu_time_total"
+        with open(os.path.join(self.out_dir, "key_averages.txt"), "w") as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=100))
+        if self.hps["record_shapes"]:
+            with open(os.path.join(self.out_dir, "key_averages_by_shape.txt"), "w") as f:
+                f.write(prof.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=100))
+
+
+class WorkerCProfiler:
+    """Runs cProfile in a DataLoader worker while it produces the batches of a window, and dumps the
+    stats to `{out_dir}/worker_{wid}.pstats` (e.g. for `python -m pstats` or snakeviz).
+
+    Since the DataLoader fetches batches from its workers in a round-robin fashion, the i-th batch of
+    worker `wid` is the `i * num_workers + wid`-th batch received by the main process.
+    """
+
+    def __init__(self, window: Tuple[int, int], out_dir: str, wid: int, num_workers: int):
+        """
+        Parameters
+        ----------
+        window: Tuple[int, int]
+            The [start, end) indices of the batches (as received by the main process) to profile.
+        out_dir: str
+            The directory the stats are written to.
+        wid: int
+            The id of the worker.
+        num_workers: int
+            The number of workers.
+        """
+        self.start, self.end = window
+        self.path = os.path.join(out_dir, f"worker_{wid}.pstats")
+        self.wid = wid
+        self.num_workers = max(num_workers, 1)
+        self._prof: Optional[cProfile.Profile] = None
+        self._done = False
+
+    def step(self, local_idx: int):
+        """Called before the worker produces its `local_idx`-th batch"""
+        if self._done:
+            return
+        batch_idx = local_idx * self.num_workers + self.wid
+        if self._prof is None and self.start <= batch_idx < self.end:
+            self._prof = cProfile.Profile()
+            self._prof.enable()
+        elif batch_idx >= self.end:
+            self.close()
+
+    def close(self):
+        """Stops profiling (if it is running) and dumps the stats"""
+        self._done = True
+        if self._prof is None:
+            return
+        prof, self._prof = self._prof, None
+        prof.disable()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        prof.dump_stats(self.path)
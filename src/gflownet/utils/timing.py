@@ -0,0 +1,88 @@
+import threading
+import time
+from typing import Dict
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *a):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ("timers", "name", "t0")
+
+    def __init__(self, timers: "Timers", name: str):
+        self.timers = timers
+        self.name = name
+
+    def __enter__(self):
+        stack = self.timers._stack()
+        if stack:
+            self.name = f"{stack[-1]}/{self.name}"
+        stack.append(self.name)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *a):
+        dt = time.perf_counter() - self.t0
+        self.timers._stack().pop()
+        self.timers._add(self.name, dt)
+        return False
+
+
+class Timers:
+    """Lightweight hierarchical wall-clock timers.
+
+    Timers are used as context managers, `with timers("name"): ...`, and nest: a timer opened while
+    another one is running (in the same thread) is named `outer/name`. The time spent in each timer
+    is summed until `pop` is called, which returns the totals as `time_*` entries meant to be
+    logged. When disabled, timers are no-ops.
+
+    A single instance, `gflownet.utils.timing.timers`, is shared by each process; DataLoader workers
+    send theirs to the main process through `batch.extra_info`.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._totals: Dict[str, float] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _add(self, name: str, dt: float):
+        with self._lock:
+            self._totals[name] = self._totals.get(name, 0.0) + dt
+
+    def pop(self) -> Dict[str, float]:
+        """Returns the total time (in seconds) spent in each timer since the last call, and resets them
+
+        Returns
+        -------
+        totals: Dict[str, float]
+            A dict of `{"time_{name}": seconds}`.
+        """
+        with self._lock:
+            totals, self._totals = self._totals, {}
+        return {f"time_{k}": v for k, v in totals.items()}
+
+
+timers = Timers()
@@ -0,0 +1,77 @@
+"""Validation running concurrently with training, on a snapshot of the model's weights.
+
+With the `async_validation` hp of GFNTrainer, the training loop doesn't wait for validation: at each validation
+step, `AsyncValidator.submit` copies the model's weights (a device to device copy), and a background thread
+loads them into a separate validation model, iterates the validation DataLoader and runs the callbacks, whose
+results are logged at the step of the snapshot. Sampling and reward computations happen in the validation
+DataLoader's own worker processes, and the validation model's forward passes in threads of the main process,
+which release the GIL while torch computes.
+"""
+
+import queue
+import threading
+from typing import Callable, Dict, Optional
+
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+
+def snapshot_weights(model: nn.Module, device: Optional[torch.device] = None) -> Dict[str, Tensor]:
+    """A copy of the state dict of `model`, on `device` (that of each tensor if None)"""
+    return {k: v.detach().to(device or v.device, copy=True) for k, v in model.state_dict().items()}
+
+
+class AsyncValidator:
+    def __init__(self, validate: Callable[[Dict[str, Tensor], int], None], max_in_flight: int = 1):
+        """Calls `validate(weights, step)` from a background thread, for the snapshots submitted with `submit`,
+        in order. Errors of `validate` are raised by the next call to `submit`, or by `close`.
+
+        Parameters
+        ----------
+        validate: Callable[[Dict[str, Tensor], int], None]
+            The validation of a snapshot of the model's weights (a state dict) taken at a training step.
+        max_in_flight: int
+            The maximum number of submitted validations that haven't finished, after which `submit` blocks
+            (each holds a copy of the weights).
+        """
+        if max_in_flight < 1:
+            raise ValueError(f"max_in_flight must be at least 1, got {max_in_flight}")
+        self.validate = validate
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._error: Optional[BaseException] = None
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(target=self._validation_loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, model: nn.Module, step: int, device: Optional[torch.device] = None):
+        """Validates the current weights of `model` (copied to `device`), as those of training step `step`"""
+        self._raise_error()
+        self._slots.acquire()
+        self._queue.put((snapshot_weights(model, device), step))
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _validation_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                if self._error is None:
+                    self.validate(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                del item
+                self._slots.release()
+
+    def close(self):
+        """Waits for the submitted validations"""
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_error()
@@ -0,0 +1,76 @@
+import threading
+
+import pytest
+import torch
+import torch.nn as nn
+
+from gflownet.utils.validation import AsyncValidator
+
+
+def test_async_validator():
+    model = nn.Linear(2, 1)
+    release = threading.Event()
+    validated = []
+
+    def validate(weights, step):
+        release.wait()
+        validated.append((step, weights["bias"].item()))
+
+    validator = AsyncValidator(validate, max_in_flight=2)
+    for step in range(1, 3):
+        with torch.no_grad():
+            model.bias.fill_(step)
+        validator.submit(model, step)
+    # Both slots are taken, the next submission waits for the first validation
+    blocked = threading.Thread(target=validator.submit, args=(model, 3))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive() and not validated
+    release.set()
+    blocked.join()
+    validator.close()
+    # Each step is validated with its snapshot of the weights, in order
+    assert validated == [(1, 1.0), (2, 2.0), (3, 2.0)]
+
+    def fails(weights, step):
+        raise RuntimeError("validation failed")
+
+    validator = AsyncValidator(fails)
+    validator.submit(model, 1)
+    with pytest.raises(RuntimeError, match="validation failed"):
+        validator.close()
+    with pytest.raises(ValueError):
+        AsyncValidator(fails, max_in_flight=0)
+
+
+def test_trainer_async_validation(tmp_path):
+    from gflownet.benchmarks.throughput import StubSEHFragTrainer
+
+    class Trainer(StubSEHFragTrainer):
+        def _validate(self, valid_dl, callbacks, it, logger, model, epoch_idx=0, batch_idx=0):
+            self.validated.append((it, model is self.model, threading.current_thread() is threading.main_thread()))
+            super()._validate(valid_dl, callbacks, it, logger, model, epoch_idx, batch_idx)
+
+    hps = {
+        "log_dir": str(tmp_path),
+        "num_training_steps": 4,
+        "validate_every": 2,
+        "num_data_loader_workers": 1,
+        "global_batch_size": 4,
+        "num_emb": 16,
+        "num_layers": 1,
+        "async_validation": True,
+    }
+    trainer = Trainer(hps, torch.device("cpu"))
+    trainer.validated = []
+    trainer.run()
+    # The validations ran in the background, on copies of the weights
+    assert trainer.validated == [(2, False, False), (4, False, False)]
+
+    # Without workers, validation would share the context and generators of training
+    with pytest.raises(ValueError, match="async_validation"):
+        Trainer({**hps, "num_data_loader_workers": 0}, torch.device("cpu"))
+    # Devices given as strings are compared as torch.device
+    assert Trainer({**hps, "async_validation": False}, "cpu").valid_device == torch.device("cpu")
+    with pytest.raises(ValueError, match="valid_device"):
+        Trainer({**hps, "async_validation": False, "valid_device": "meta"}, "cpu")
@@ -0,0 +1,45 @@
+import copy
+
+import torch
+from rdkit import Chem
+
+from gflownet.benchmarks import core
+from gflownet.benchmarks.__main__ import main
+from gflownet.models import bengio2021flow
+from gflownet.utils.multiprocessing_proxy import num_bytes
+
+
+def test_run_and_compare(tmp_path):
+    path = str(tmp_path / "results.json")
+    assert main(["run", "-k", "ctx/collate/*", "--repeats", "2", "--min-time", "0.01", "-o", path]) == 0
+    results = core.load_results(path)
+    assert sorted(results["results"].keys()) == ["ctx/collate/frag", "ctx/collate/mol"]
+    r = results["results"]["ctx/collate/mol"]
+    assert r["median_s"] > 0 and r["items"] > 0 and r["unit"] == "graph"
+
+    slower = copy.deepcopy(results)
+    slower["results"]["ctx/collate/mol"]["median_s"] *= 2
+    slower["results"]["ctx/collate/frag"] = {"skipped": "ImportError"}
+    rows = {r["name"]: r["status"] for r in core.compare(results, slower, threshold=0.1)}
+    assert rows == {"ctx/collate/mol": "regression", "ctx/collate/frag": "skipped"}
+    rows = {r["name"]: r["status"] for r in core.compare(slower, results, threshold=0.1)}
+    assert rows["ctx/collate/mol"] == "improvement"
+    core.save_results(slower, str(tmp_path / "slower.json"))
+    assert main(["compare", path, str(tmp_path / "slower.json")]) == 1
+
+
+def test_num_bytes():
+    x = torch.zeros((4, 3))
+    assert num_bytes(x) == 48
+    # Shared objects are counted once
+    assert num_bytes((x, [x, {"a": torch.zeros(2, dtype=torch.int64)}], b"1234")) == 48 + 16 + 4
+
+
+def test_stub_seh_proxy():
+    from gflownet.benchmarks import throughput
+
+    mols = [Chem.MolFromSmiles(i) for i in ["CCO", "c1ccccc1", "CC(=O)N"]]
+    batch = bengio2021flow.mols2batch([bengio2021flow.mol2graph(m) for m in mols])
+    r = throughput.StubSEHProxy()(batch)
+    assert r.shape == (3, 1) and (r >= 0).all() and (r <= 8).all()
+    assert torch.equal(r, throughput.StubSEHProxy()(batch))
@@ -0,0 +1,97 @@
+import os
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from gflownet.utils.checkpoint import (
+    AsyncCheckpointer,
+    get_rng_state,
+    list_checkpoints,
+    load_checkpoint,
+    set_rng_state,
+)
+
+
+def test_rng_state_roundtrip():
+    shared, other = np.random.default_rng(0), np.random.default_rng(1)
+    torch.manual_seed(0)
+    state = get_rng_state({"a": shared, "b": shared, "c": other})
+    expected = [shared.random(), other.random(), torch.rand(()), np.random.rand(), random.random()]
+    generators = set_rng_state(state)
+    assert generators["a"] is generators["b"] and generators["a"] is not generators["c"]
+    # The shared generator advances once for both names, as before
+    assert generators["a"].random() == expected[0] and generators["c"].random() == expected[1]
+    assert torch.rand(()) == expected[2] and np.random.rand() == expected[3] and random.random() == expected[4]
+    assert "torch" not in get_rng_state({"a": shared}, process=False)
+
+
+def test_async_checkpointer(tmp_path):
+    log_dir = str(tmp_path)
+    checkpointer = AsyncCheckpointer(log_dir, keep_last=2)
+    x = torch.zeros(3)
+    for step in range(1, 5):
+        checkpointer.save({"x": x, "step": step}, step)
+        # The saved tensor is a copy, which later in-place updates don't affect
+        x.add_(1)
+    checkpointer.close()
+    assert [p.parent.name for p in list_checkpoints(log_dir)] == ["step_3", "step_4"]
+    assert sorted(os.listdir(log_dir)) == ["step_3", "step_4"]
+    state = load_checkpoint(str(list_checkpoints(log_dir)[-1]))
+    assert state["step"] == 4 and torch.equal(state["x"], torch.full((3,), 3.0))
+
+    # Errors of the background thread are raised by the next call, and no partial checkpoint is left
+    checkpointer.save({"f": lambda: 0}, 5)
+    with pytest.raises(Exception):
+        checkpointer.close()
+    assert [p.parent.name for p in list_checkpoints(log_dir)] == ["step_3", "step_4"]
+    with pytest.raises(ValueError):
+        AsyncCheckpointer(log_dir, keep_last=0)
+
+
+def test_exact_resume(tmp_path):
+    from gflownet.benchmarks.throughput import StubSEHFragTrainer
+
+    class Trainer(StubSEHFragTrainer):
+        def train_batch(self, batch, epoch_idx, batch_idx):
+            info = super().train_batch(batch, epoch_idx, batch_idx)
+            self.losses.append(info["loss"].item())
+            return info
+
+    def losses(log_dir, num_training_steps, **hps):
+        os.makedirs(log_dir, exist_ok=True)
+        torch.manual_seed(0)
+        np.random.seed(0)
+        hps = {
+            "log_dir": log_dir,
+            "num_training_steps": num_training_steps,
+            "validate_every": 2,
+            "num_data_loader_workers": 0,
+            "global_batch_size": 4,
+            "num_emb": 16,
+            "num_layers": 1,
+            "sampling_tau": 0.9,
+            "random_action_prob": 0.1,
+            "replay_capacity": 16,
+            "replay_warmup": 4,
+            **hps,
+        }
+        trainer = Trainer(hps, torch.device("cpu"))
+        trainer.losses = []
+        trainer.run()
+        return trainer.losses
+
+    uninterrupted = losses(str(tmp_path / "a"), 5)
+    log_dir = str(tmp_path / "b")
+    # Checkpoints at the validation steps 2 and 4
+    first = losses(log_dir, 4)
+    state = load_checkpoint(str(list_checkpoints(log_dir)[-1]))
+    assert state["step"] == 4 and state["optimizer_step"]["opt"]["state"] and state["replay_buffer"] is not None
+    resumed = losses(log_dir, 5, resume=True)
+    assert len(resumed) == 1 and first + resumed == uninterrupted
+    # The DataLoader's seed is drawn from the (seeded) global generator, and kept when resuming
+    loader_seed = state["worker_rng"]["loader_seed"]
+    assert loader_seed is not None
+    assert load_checkpoint(str(list_checkpoints(log_dir)[-1]))["worker_rng"]["loader_seed"] == loader_seed
+    assert load_checkpoint(str(list_checkpoints(str(tmp_path / "a"))[-1]))["worker_rng"]["loader_seed"] == loader_seed
@@ -0,0 +1,156 @@
+import pytest
+import torch
+import torch.nn as nn
+from rdkit import Chem
+from torch_geometric.data import Batch
+
+from gflownet.benchmarks.quantization import distribution_errors
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.models import bengio2021flow
+from gflownet.models.graph_transformer import GraphTransformerGFN
+from gflownet.utils.compile import DynamicQuantized, EagerFallback, compile_for_inference, compile_module
+from gflownet.utils.multiprocessing_proxy import MPModelPlaceholder
+from tests.test_memmap_graphs import frag_graphs
+
+
+def assert_same_outputs(out, ref):
+    (cat, graph_out), (ref_cat, ref_graph_out) = out, ref
+    assert all(torch.allclose(i, j, atol=1e-6) for i, j in zip(cat.logits, ref_cat.logits))
+    assert torch.allclose(graph_out, ref_graph_out, atol=1e-6)
+
+
+@pytest.mark.parametrize("ln_type, self_loop_attr", [("pre", "mean"), ("post", "learned")])
+def test_graph_transformer_parity(ln_type, self_loop_attr):
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=2, ln_type=ln_type, self_loop_attr=self_loop_attr)
+    graphs = frag_graphs(ctx, 16)
+    batches = [ctx.collate([ctx.graph_to_Data(g) for g in graphs[:n]]) for n in [16, 5, 1]]
+    conds = [torch.rand((b.num_graphs, 4)) for b in batches]
+    compiled = compile_for_inference(model, "script")
+    assert isinstance(compiled.transf, EagerFallback) and compiled.transf.compiled is not None
+    for b, c in zip(batches, conds):
+        with torch.no_grad():
+            ref = model(b, c)
+        assert_same_outputs(compiled(b, c), ref)
+    assert torch.equal(compiled.logZ(conds[0]), model.logZ(conds[0]))
+
+    # The compiled module follows the (in-place) updates of the model's parameters
+    with torch.no_grad():
+        for p in model.parameters():
+            p.add_(torch.randn_like(p) * 0.1)
+        ref = model(batches[0], conds[0])
+    assert_same_outputs(compiled(batches[0], conds[0]), ref)
+
+
+def mpnnet_setup():
+    torch.manual_seed(0)
+    model = bengio2021flow.MPNNet(num_feat=14 + 1 + bengio2021flow.NUM_ATOMIC_NUMBERS, num_vec=0, num_conv_steps=4)
+    smis = ["CCO", "c1ccccc1O", "CC(=O)Nc1ccc(O)cc1", "CCN(CC)CC", "O=C(O)c1ccccc1"]
+    batches = [
+        Batch.from_data_list([bengio2021flow.mol2graph(Chem.MolFromSmiles(s)) for s in smis[:n]]) for n in [5, 2]
+    ]
+    return model, batches
+
+
+def test_mpnnet_parity():
+    model, batches = mpnnet_setup()
+    for mode in ["script", "freeze"]:
+        compiled = compile_for_inference(model, mode)
+        assert compiled.convs.compiled is not None
+        for b in batches:
+            with torch.no_grad():
+                assert torch.allclose(compiled(b), model(b), atol=1e-6)
+
+
+def test_mpnnet_quantized():
+    model, batches = mpnnet_setup()
+    quantized = compile_for_inference(model, "quantize")
+    assert isinstance(quantized, DynamicQuantized)
+    for b in batches:
+        with torch.no_grad():
+            ref = model(b)
+        assert torch.allclose(quantized(b), ref, atol=1e-2 * ref.abs().max().item())
+    # The copy is only quantized once if the parameters don't change
+    q = quantized.quantized
+    quantized(batches[0])
+    assert quantized.quantized is q
+    assert all(".quantized." in type(m).__module__ for m in [q.lin0, q.gru, q.conv.nn[2], q.set2set.lstm, q.lin3])
+
+
+def test_graph_transformer_quantized():
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=2, num_mlp_layers=1)
+    graphs = frag_graphs(ctx, 16)
+    batch = ctx.collate([ctx.graph_to_Data(g) for g in graphs])
+    cond = torch.rand((batch.num_graphs, 4))
+    quantized = compile_for_inference(model, "quantize")
+    heads = []
+    for i in range(2):
+        with torch.no_grad():
+            ref_cat, ref_out = model(batch, cond)
+        cat, out = quantized(batch, cond)
+        errors = distribution_errors(ref_cat, cat)
+        assert errors["tv"].max() < 0.02 and errors["kl"].max() < 1e-3
+        assert torch.allclose(out, ref_out, atol=2e-2)
+        # The quantized heads follow the (in-place) updates of the model's parameters
+        heads.append(quantized.emb2graph_out.quantized)
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(torch.randn_like(p) * 0.1)
+    assert heads[0] is not heads[1]
+    # The parameters aren't duplicated
+    assert len(list(quantized.parameters())) == len(list(model.parameters()))
+    errors = distribution_errors(ref_cat, ref_cat)
+    assert errors["tv"].max() < 1e-6 and errors["kl"].max() < 1e-6 and errors["argmax_agreement"].all()
+
+
+def test_quantized_proxy_with_workers(tmp_path):
+    from gflownet.tasks.seh_frag import SEHFragTrainer
+
+    # A cached sEH proxy with random weights, see bengio2021flow.load_original_model
+    torch.manual_seed(0)
+    torch.save(bengio2021flow._original_architecture().state_dict(), tmp_path / bengio2021flow.CACHED_STATE_DICT)
+    hps = {
+        "log_dir": str(tmp_path / "log"),
+        "num_training_steps": 1,
+        "num_data_loader_workers": 1,
+        "global_batch_size": 4,
+        "num_emb": 16,
+        "num_layers": 1,
+        "compile_proxy": "quantize",
+        "proxy_cache_dir": str(tmp_path),
+    }
+    trainer = SEHFragTrainer(hps, torch.device("cpu"))
+    # The proxy has no parameters of its own, but is known to be on CPU
+    assert isinstance(trainer.task.models["seh"], MPModelPlaceholder) and trainer.task.device == torch.device("cpu")
+    # The worker scores its molecules with the quantized proxy, through the main process
+    batch = next(iter(trainer.build_training_data_loader()))
+    assert torch.isfinite(batch.flat_rewards).all()
+
+
+class Unscriptable(nn.Module):
+    def forward(self, x):
+        return torch.tensor([i * 2 for i in x.tolist()])
+
+
+def test_eager_fallback():
+    x = torch.arange(3)
+    with pytest.warns(UserWarning, match="Could not compile"):
+        f = compile_module(Unscriptable(), "script")
+    assert f.compiled is None and torch.equal(f(x), x * 2)
+
+    def fails(x):
+        raise RuntimeError()
+
+    f = EagerFallback(fails, Unscriptable())
+    with pytest.warns(UserWarning, match="falling back to eager"):
+        assert torch.equal(f(x), x * 2)
+    assert f.compiled is None
+    with pytest.raises(ValueError):
+        compile_module(Unscriptable(), "trace")
+    model = nn.Linear(2, 2)
+    assert compile_for_inference(model, None) is model
+    with pytest.warns(UserWarning, match="no compiled inference path"):
+        assert compile_for_inference(model, "script") is model
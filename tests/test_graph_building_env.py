@@ -2,7 +2,7 @@ import torch
 import torch.nn.functional
 from torch_geometric.data import Batch, Data
 
-from gflownet.envs.graph_building_env import GraphActionCategorical, GraphActionType
+from gflownet.envs.graph_building_env import GraphActionCategorical, GraphActionType, fast_collate
 
 
 def make_test_cat():
@@ -124,3 +124,20 @@ def test_log_prob():
 def test_entropy():
     cat = make_test_cat()
     cat.entropy()
+
+
+def test_fast_collate():
+    datas = [
+        Data(x=torch.randn((n, 3)), edge_index=torch.randint(0, max(n, 1), (2, e)), y=torch.ones((e, 2)))
+        for n, e in [(2, 1), (3, 4), (1, 0), (4, 2)]
+    ]
+    ref = Batch.from_data_list(datas, follow_batch=["edge_index"])
+    batch = fast_collate(datas, follow_batch=["edge_index"])
+    assert batch.num_graphs == ref.num_graphs
+    for k in ["x", "edge_index", "y", "batch", "ptr", "edge_index_batch"]:
+        assert torch.equal(batch[k], ref[k])
+    for k in ["x", "edge_index", "y"]:
+        assert torch.equal(batch._slice_dict[k], ref._slice_dict[k])
+        assert torch.equal(batch._inc_dict[k], ref._inc_dict[k])
+    for a, b in zip(batch.to_data_list(), datas):
+        assert torch.equal(a.edge_index, b.edge_index)
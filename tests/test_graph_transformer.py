@@ -0,0 +1,49 @@
+import torch
+from torch_geometric.utils import add_self_loops
+
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import fast_collate, virtual_node_structure
+from gflownet.models.graph_transformer import GraphTransformerGFN
+from tests.test_memmap_graphs import frag_graphs
+
+
+def test_augmented_graph():
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    data = [ctx.graph_to_Data(g) for g in frag_graphs(ctx, 16)]
+    batch = ctx.collate(data)
+    # The structure add_self_loops would have created from the edges to and from the virtual nodes
+    n = batch.num_nodes
+    u, v = torch.arange(n), batch.batch + n
+    edge_index = torch.cat([batch.edge_index, torch.stack([u, v]), torch.stack([v, u])], 1)
+    ref, _ = add_self_loops(edge_index)
+    aug_edge_index, aug_batch = virtual_node_structure(batch)
+    assert aug_edge_index is batch._aug_edge_index
+    assert torch.equal(aug_edge_index, ref)
+    assert torch.equal(aug_batch, torch.cat([batch.batch, torch.arange(16)]))
+    # The augmentation has no per-graph slices, torch_geometric must ignore it when splitting the batch
+    assert "_aug_edge_index" not in batch.keys
+    assert [i.num_nodes for i in batch.to_data_list()] == [i.num_nodes for i in data]
+    assert torch.equal(batch.get_example(3).edge_index, data[3].edge_index)
+    assert [i.num_nodes for i in batch.index_select([1, 2])] == [data[1].num_nodes, data[2].num_nodes]
+
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=2)
+    cond = torch.rand((16, 4))
+    # The augmentation is otherwise done (and cached) in the forward pass
+    uncached = fast_collate(data, follow_batch=["edge_index"])
+    cat, graph_out = model(batch, cond)
+    ref_cat, ref_graph_out = model(uncached, cond)
+    assert hasattr(uncached, "_aug_edge_index")
+    assert all(torch.equal(i, j) for i, j in zip(cat.logits, ref_cat.logits))
+    assert torch.equal(graph_out, ref_graph_out)
+    # The virtual edges' attribute isn't part of the state
+    assert not any("virtual_edge_attr" in k for k in model.state_dict())
+
+
+def test_learned_self_loop_attr():
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    batch = ctx.collate([ctx.graph_to_Data(g) for g in frag_graphs(ctx, 8)])
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=2, self_loop_attr="learned")
+    cat, graph_out = model(batch, torch.rand((8, 4)))
+    graph_out.sum().backward()
+    assert model.transf.self_loop_emb.grad.abs().sum() > 0
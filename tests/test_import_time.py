@@ -0,0 +1,46 @@
+import os
+import pathlib
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+import gflownet
+
+# Optional dependencies that are slow to import, and must only be imported when they are used
+HEAVY_MODULES = ["wandb", "matplotlib", "torch.utils.tensorboard", "botorch", "sklearn", "cvxopt", "gpytorch"]
+# Importing the tasks takes about 3 seconds, mostly torch, torch_geometric and rdkit (and used to take 7).
+# Wall-clock times depend too much on the machine to be checked by default, set this variable to a budget
+# in seconds (e.g. 5) to check it
+IMPORT_TIME_BUDGET_VAR = "GFLOWNET_IMPORT_TIME_BUDGET"
+
+
+def import_times(module: str) -> Dict[str, float]:
+    """The cumulative import time in seconds of `module` and of every module it imports, in a new process"""
+    src = str(pathlib.Path(gflownet.__file__).parents[1])
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join([src, os.environ.get("PYTHONPATH", "")])}
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], env=env, capture_output=True, text=True
+    )
+    assert out.returncode == 0, out.stderr
+    times = {}
+    for line in out.stderr.splitlines():
+        if line.startswith("import time:"):
+            self_us, cumulative_us, name = line[len("import time:") :].split("|")
+            if cumulative_us.strip().isdigit():
+                times[name.strip()] = int(cumulative_us) / 1e6
+    return times
+
+
+@pytest.mark.parametrize("module", ["gflownet.tasks.seh_frag", "gflownet.tasks.seh_frag_moo"])
+def test_import_time(module):
+    times = import_times(module)
+    assert [m for m in HEAVY_MODULES if m in times] == []
+    if IMPORT_TIME_BUDGET_VAR not in os.environ:
+        return
+    budget = float(os.environ[IMPORT_TIME_BUDGET_VAR])
+    # The first import may be slowed down by a cold disk cache
+    if times[module] > budget:
+        times = import_times(module)
+    assert times[module] < budget
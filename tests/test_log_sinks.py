@@ -0,0 +1,56 @@
+import sqlite3
+from types import SimpleNamespace
+
+import networkx as nx
+import numpy as np
+import torch
+
+from gflownet.data.log_sinks import ParquetLog, read_parquet_logs
+from gflownet.data.sampling_iterator import SamplingIterator, SQLiteLog
+
+
+def make_columns(i, n=10):
+    return {"smi": ["CCO"] * n, "r": np.full(n, float(i), dtype=np.float32), "fr_0": np.arange(n) * 0.5}
+
+
+def test_parquet_log(tmp_path):
+    for wid in range(2):
+        log = ParquetLog(row_group_size=16, max_file_size=1)
+        log.connect(str(tmp_path / f"generated_mols_{wid}.parquet"))
+        for i in range(5):
+            log.insert_columns(make_columns(i))
+        log.close()
+    # 16 rows are buffered in 2 inserts, and files are rolled after every row group since max_file_size is tiny
+    assert len(list(tmp_path.glob("generated_mols_0_*.parquet"))) == 3
+    table = read_parquet_logs(str(tmp_path)).to_table()
+    assert table.num_rows == 100
+    assert table.column_names == ["smi", "r", "fr_0"]
+    assert np.isclose(sum(table.column("r").to_pylist()), 2 * 10 * (0 + 1 + 2 + 3 + 4))
+
+
+def test_sqlite_insert_columns(tmp_path):
+    path = str(tmp_path / "log.db")
+    log = SQLiteLog()
+    log.connect(path)
+    log.insert_columns(make_columns(1))
+    log.close()
+    db = sqlite3.connect(path)
+    assert db.execute("select count(*), sum(r), sum(fr_0) from results").fetchall() == [(10, 10.0, 22.5)]
+
+
+def test_log_generated_columns(tmp_path):
+    path = str(tmp_path / "log.db")
+    it = SimpleNamespace(log_molecule_smis=False, log=SQLiteLog())
+    it.log.connect(path)
+    graphs = [nx.path_graph(i + 1) for i in range(4)]
+    for g in graphs:
+        nx.set_node_attributes(g, "C", "v")
+    trajs = SimpleNamespace(results=graphs, is_valid=torch.ones(4, dtype=torch.bool))
+    # Tasks return cond_info values either as tensors or as numpy arrays
+    cond_info = {"encoding": torch.zeros((4, 8)), "beta": np.arange(4.0), "preferences": torch.ones((4, 2)) / 2}
+    SamplingIterator.log_generated(it, trajs, torch.arange(4.0), torch.ones((4, 1)), cond_info)
+    it.log.close()
+    db = sqlite3.connect(path)
+    columns = [i[1] for i in db.execute("pragma table_info(results)").fetchall()]
+    assert columns == ["smi", "r", "fr_0", "pref_0", "pref_1", "ci_beta"]
+    assert db.execute("select sum(r), sum(pref_1), sum(ci_beta) from results").fetchall() == [(6.0, 2.0, 6.0)]
@@ -0,0 +1,73 @@
+import pickle
+
+import networkx as nx
+import numpy as np
+import torch
+from rdkit import Chem
+
+from gflownet.data.memmap_graphs import MemmapGraphs, MemmapTrainingDataset, convert_graphs
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphBuildingEnv, generate_forward_trajectory
+from gflownet.envs.mol_building_env import MolBuildingEnvContext
+
+
+def frag_graphs(ctx, n=12):
+    env = GraphBuildingEnv()
+    rng = np.random.default_rng(0)
+    graphs = []
+    while len(graphs) < n:
+        g = env.new()
+        for _ in range(rng.integers(1, 6)):
+            gd = ctx.graph_to_Data(g)
+            masks = [gd[i.mask_name] for i in ctx.action_type_order[1:]]
+            legal = [(t + 1, r, c) for t, m in enumerate(masks) for r, c in m.nonzero().tolist()]
+            if not legal:
+                break
+            g = env.step(g, ctx.aidx_to_GraphAction(gd, legal[rng.integers(len(legal))]))
+        graphs.append(g)
+    return graphs
+
+
+def assert_same_graph(ctx, g, ref):
+    assert list(g.nodes(data=True)) == list(ref.nodes(data=True))
+    assert list(g.edges(data=True)) == list(ref.edges(data=True))
+    d, ref_d = ctx.graph_to_Data(g), ctx.graph_to_Data(ref)
+    assert all(torch.equal(d[k], ref_d[k]) for k in ref_d.keys)
+
+
+def test_frag_graphs_roundtrip(tmp_path):
+    ctx = FragMolBuildingEnvContext(max_frags=6)
+    graphs = frag_graphs(ctx)
+    # Some graphs must have (endpoint-relative) attachment point attributes
+    assert any(len(ed) for g in graphs for _, _, ed in g.edges(data=True))
+    rewards = [torch.tensor([float(i), -float(i)]) for i in range(len(graphs))]
+    convert_graphs(graphs, rewards, str(tmp_path), parts=[np.arange(0, 12, 2), np.arange(1, 12, 2)])
+    data = MemmapGraphs(str(tmp_path))
+    assert len(data) == len(graphs)
+    for i in range(len(graphs)):
+        assert_same_graph(ctx, data[i], graphs[i])
+        # The graphs can still be used to generate trajectories
+        assert nx.is_isomorphic(generate_forward_trajectory(data[i])[-1][0], graphs[i])
+
+    dataset = MemmapTrainingDataset(str(tmp_path), part=1)
+    assert len(dataset) == 6
+    g, r = dataset[2]
+    assert_same_graph(ctx, g, graphs[5])
+    assert torch.equal(r, rewards[5])
+
+    # The memory-mapped arrays aren't pickled, they are mapped again
+    unpickled = pickle.loads(pickle.dumps(dataset))
+    assert len(pickle.dumps(dataset.data)) < 1000
+    assert isinstance(unpickled.data.edges, np.memmap)
+    assert_same_graph(ctx, unpickled[2][0], graphs[5])
+
+
+def test_mol_graphs_roundtrip(tmp_path):
+    ctx = MolBuildingEnvContext()
+    smis = ["CC1CCC(O)C1", "C#N", "C[N+](C)(C)C", "c1ccccc1[C@H](F)O", "O"]
+    graphs = [ctx.mol_to_graph(Chem.MolFromSmiles(s)) for s in smis]
+    convert_graphs(graphs, [torch.zeros(1)] * len(graphs), str(tmp_path))
+    data = MemmapTrainingDataset(str(tmp_path))
+    for (g, _), ref, s in zip(data, graphs, smis):
+        assert_same_graph(ctx, g, ref)
+        assert Chem.MolToSmiles(ctx.graph_to_mol(g)) == Chem.MolToSmiles(Chem.MolFromSmiles(s))
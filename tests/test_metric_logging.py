@@ -0,0 +1,52 @@
+import pytest
+import torch
+
+from gflownet.utils.metric_logging import AsyncMetricWriter, MetricAccumulator
+
+
+def test_metric_accumulator(monkeypatch):
+    metrics = MetricAccumulator(["mean", "min", "max"])
+    loss = torch.tensor(2.0, requires_grad=True) * 2
+    metrics.add({"loss": loss, "time": 1.0, "invalid": 0})
+    metrics.add({"loss": torch.tensor(2.0), "time": 3.0, "invalid": torch.tensor(0.5)})
+    assert len(metrics) == 2
+
+    # A single copy to the host, and no .item()
+    tolist, num_calls = torch.Tensor.tolist, [0]
+
+    def counted_tolist(self):
+        num_calls[0] += 1
+        return tolist(self)
+
+    def item(self):
+        raise AssertionError(".item() synchronizes")
+
+    monkeypatch.setattr(torch.Tensor, "tolist", counted_tolist)
+    monkeypatch.setattr(torch.Tensor, "item", item)
+    info = metrics.reduce()
+    assert num_calls[0] == 1
+    expected = {"loss": (3, 2, 4), "time": (2, 1, 3), "invalid": (0.25, 0, 0.5)}
+    assert info == {f"{k}{s}": v for k, vs in expected.items() for s, v in zip(["", "_min", "_max"], vs)}
+    assert len(metrics) == 0 and metrics.reduce() == {}
+    with pytest.raises(ValueError):
+        MetricAccumulator(["median"])
+
+
+def test_async_metric_writer():
+    written = []
+
+    def write(info, index, key):
+        if index < 0:
+            raise RuntimeError("Failed")
+        written.append((info, index, key))
+
+    writer = AsyncMetricWriter(write, max_queued=2)
+    for i in range(10):
+        writer({"loss": float(i)}, i, "train")
+    writer.close()
+    assert written == [({"loss": float(i)}, i, "train") for i in range(10)]
+
+    writer = AsyncMetricWriter(write)
+    writer({}, -1, "train")
+    with pytest.raises(RuntimeError, match="Failed"):
+        writer.close()
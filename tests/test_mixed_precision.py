@@ -0,0 +1,76 @@
+import copy
+
+import numpy as np
+import torch
+
+from gflownet.algo.trajectory_balance import TrajectoryBalance
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphBuildingEnv
+from gflownet.models.graph_transformer import GraphTransformerGFN
+from gflownet.train import FusedOptimizerStep
+
+HPS = {
+    "illegal_action_logreward": -75,
+    "bootstrap_own_reward": False,
+    "tb_epsilon": None,
+    "learning_rate": 1e-3,
+    "Z_learning_rate": 1e-2,
+    "momentum": 0.9,
+    "weight_decay": 1e-8,
+    "adam_eps": 1e-8,
+    "lr_decay": 20000,
+    "Z_lr_decay": 20000,
+    "clip_grad_type": "norm",
+    "clip_grad_param": 10,
+    "sampling_tau": 0.0,
+}
+
+
+def setup():
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    algo = TrajectoryBalance(GraphBuildingEnv(), ctx, np.random.default_rng(0), HPS, max_len=8, max_nodes=5)
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=32, num_layers=2)
+    batches = []
+    for i in range(3):
+        cond_info = torch.rand((16, 4))
+        with torch.no_grad():
+            trajs = algo.create_training_data_from_own_samples(model, 16, cond_info, 0.0)
+        log_rewards = torch.tensor([float(len(g)) if v else -75.0 for g, v in zip(trajs.results, trajs.is_valid)])
+        batch = algo.construct_batch(trajs, cond_info, log_rewards)
+        batch.num_offline, batch.num_online = 0, len(trajs)
+        batches.append(batch)
+    return algo, model, batches
+
+
+def test_bf16_tb_losses_match_fp32():
+    algo, model, batches = setup()
+    losses = {}
+    for dtype in [None, torch.bfloat16]:
+        m = copy.deepcopy(model)
+        m.autocast_dtype = dtype
+        step = FusedOptimizerStep(m, HPS)
+        losses[dtype] = []
+        for i in range(12):
+            loss, info = algo.compute_batch_losses(m, batches[i % len(batches)])
+            # The categoricals and the loss are computed in fp32
+            assert loss.dtype == torch.float32
+            losses[dtype].append(loss.item())
+            step(loss)
+    ref, bf16 = np.array(losses[None]), np.array(losses[torch.bfloat16])
+    # The loss decreases, and along the same trajectory in both precisions
+    assert ref[-3:].mean() < ref[:3].mean()
+    assert np.allclose(bf16, ref, rtol=1e-2)
+
+
+def test_bf16_sampling():
+    algo, model, batches = setup()
+    model.autocast_dtype = torch.bfloat16
+    with torch.no_grad():
+        trajs = algo.create_training_data_from_own_samples(model, 16, torch.rand((16, 4)), 0.0)
+        batch = batches[0]
+        fwd_cat, graph_out = model(batch, batch.cond_info.repeat_interleave(batch.traj_lens, 0))
+    assert len(trajs) == 16 and (trajs.traj_lens > 0).all()
+    assert all(i.dtype == torch.float32 for i in fwd_cat.logits) and graph_out.dtype == torch.float32
+    # logZ isn't autocast
+    assert trajs.logZ.dtype == torch.float32
@@ -0,0 +1,44 @@
+import networkx as nx
+import torch
+from rdkit import Chem
+
+from gflownet.envs.mol_building_env import MolBuildingEnvContext
+
+
+def test_non_edge_index_matches_complement():
+    ctx = MolBuildingEnvContext()
+    g = ctx.mol_to_graph(Chem.MolFromSmiles("CC1CCC(O)C1"))
+    gd = ctx.graph_to_Data(g)
+    # No atom is saturated here, so every edge of the complement should be a legal non-edge, in order
+    assert gd.non_edge_index.T.tolist() == [list(e) for e in nx.complement(g).edges]
+    assert gd.add_edge_mask.shape == (gd.non_edge_index.shape[1], 1)
+
+
+def test_valence_masks():
+    ctx = MolBuildingEnvContext()
+    gd = ctx.graph_to_Data(ctx.mol_to_graph(Chem.MolFromSmiles("C#N")))
+    # N is saturated, C can still take a bond
+    assert gd.add_node_mask[:, 0].tolist() == [1, 0]
+    s, e = ctx.atom_attr_logit_slice["charge"]
+    assert gd.set_node_attr_mask[:, s:e].sum(1).tolist() == [e - s, 0]
+    # The triple bond's type is already set
+    assert (gd.set_edge_attr_mask == 0).all()
+    assert gd.non_edge_index.shape == (2, 0)
+
+    gd = ctx.graph_to_Data(ctx.mol_to_graph(Chem.MolFromSmiles("C[N+](C)(C)C")))
+    # A charged N can have 4 bonds, so it is saturated, but all pairs of methyls can be bonded
+    assert gd.add_node_mask[:, 0].tolist() == [1, 0, 1, 1, 1]
+    assert gd.non_edge_index.T.tolist() == [[0, 2], [0, 3], [0, 4], [2, 3], [2, 4], [3, 4]]
+    # Single bonds to the N can't become double bonds
+    assert (gd.set_edge_attr_mask == 0).all()
+
+
+def test_empty_graph():
+    ctx = MolBuildingEnvContext()
+    gd = ctx.graph_to_Data(ctx.mol_to_graph(Chem.MolFromSmiles("")))
+    assert gd.x.shape == (1, ctx.num_node_dim)
+    assert gd.x[0, ctx.num_node_dim - ctx.num_rw_feat - 1] == 1
+    assert (gd.add_node_mask == 1).all()
+    assert (gd.set_node_attr_mask == 0).all()
+    assert gd.edge_index.dtype == gd.non_edge_index.dtype == torch.long
+    assert gd.edge_index.shape == gd.non_edge_index.shape == (2, 0)
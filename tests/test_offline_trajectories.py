@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import torch
+from rdkit import Chem
+
+from gflownet.algo.trajectory_balance import TrajectoryBalance
+from gflownet.data.offline_trajectories import (
+    OfflineTrajectoryDataset,
+    OfflineTrajectoryStore,
+    build_offline_trajectories,
+)
+from gflownet.data.sampling_iterator import SamplingIterator
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphBuildingEnv
+from gflownet.models.graph_transformer import GraphTransformerGFN
+
+
+@pytest.fixture(scope="module")
+def setup():
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    hps = {"illegal_action_logreward": -75, "bootstrap_own_reward": False, "tb_epsilon": None}
+    algo = TrajectoryBalance(GraphBuildingEnv(), ctx, np.random.default_rng(0), hps, max_len=8, max_nodes=5)
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=1)
+    with torch.no_grad():
+        trajs = algo.create_training_data_from_own_samples(model, 16, torch.rand((16, 4)), 0.0)
+    graphs = [g for g, v in zip(trajs.results, trajs.is_valid) if v and len(g)]
+    return ctx, algo, model, graphs
+
+
+def smiles(ctx, graphs):
+    return [Chem.MolToSmiles(ctx.graph_to_mol(g)) for g in graphs]
+
+
+@pytest.mark.parametrize("store_states", [False, True])
+def test_store(setup, tmp_path, store_states):
+    ctx, algo, model, graphs = setup
+    build_offline_trajectories(graphs, ctx, str(tmp_path), k=3, store_states=store_states, chunk_size=4)
+    store = OfflineTrajectoryStore(str(tmp_path))
+    assert len(store) == len(graphs) and store.has_states == store_states
+    idcs = np.arange(len(graphs)).repeat(2)
+    trajs = store.sample(idcs, np.random.default_rng(0))
+    assert len(trajs) == len(idcs) and (trajs.states is not None) == store_states
+    # Replaying the stored actions leads back to the dataset's graphs
+    agraphs, torch_graphs, _, _ = trajs.replay(algo.env, ctx)
+    assert smiles(ctx, trajs.results) == smiles(ctx, [graphs[i] for i in idcs])
+    # P_B is computed as in create_training_data_from_graphs
+    ptr = trajs.step_ptr.tolist()
+    next_graphs = sum([agraphs[ptr[i] + 1 : ptr[i + 1]] + [trajs.results[i]] for i in range(len(trajs))], [])
+    n_back = [algo.env.count_backward_transitions(g) for g in next_graphs]
+    for i in range(len(trajs)):
+        n_back[ptr[i + 1] - 1] = 1
+    assert torch.allclose(trajs.log_p_B, -torch.tensor(n_back).float().log())
+    for d, g in zip(torch_graphs, agraphs):
+        ref = ctx.graph_to_Data(g)
+        assert all(torch.equal(d[k], ref[k]) for k in ref.keys)
+    if store_states:
+        # Constructing a batch from the stored states, or by replaying the trajectories, is equivalent
+        batch = algo.construct_batch(trajs, None, None)
+        trajs.states = None
+        ref_batch = algo.construct_batch(trajs, None, None)
+        for k in ["x", "edge_index", "edge_attr", "batch", "stop_mask", "add_node_mask", "actions", "log_p_B"]:
+            assert torch.equal(getattr(batch, k), getattr(ref_batch, k)), k
+
+
+def test_sampling_iterator(setup, tmp_path):
+    ctx, algo, model, graphs = setup
+    build_offline_trajectories(graphs, ctx, str(tmp_path), k=2, store_states=True)
+    # A dataset covering only some of the store's graphs
+    store_idxs = np.arange(1, len(graphs), 2)
+    data = OfflineTrajectoryDataset(
+        [(graphs[i], torch.ones(1)) for i in store_idxs], OfflineTrajectoryStore(str(tmp_path)), store_idxs
+    )
+
+    class Task:
+        def sample_conditional_information(self, n):
+            return {"beta": torch.ones(n), "encoding": torch.rand((n, 4))}
+
+        def cond_info_to_logreward(self, cond_info, flat_rewards):
+            return torch.stack(list(flat_rewards))[:, 0].log()
+
+    it = SamplingIterator(data, model, 4, ctx, algo, Task(), "cpu", ratio=1)
+    batch = next(iter(it))
+    assert batch.num_offline == 4 and batch.num_online == 0
+    assert batch.traj_lens.shape[0] == 4 and batch.num_graphs == int(batch.traj_lens.sum())
+    assert torch.isfinite(algo.compute_batch_losses(model, batch)[0])
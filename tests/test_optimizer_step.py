@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from gflownet.train import FusedOptimizerStep, clip_grads_
+
+HPS = {
+    "learning_rate": 1e-2,
+    "Z_learning_rate": 1e-1,
+    "momentum": 0.9,
+    "weight_decay": 1e-4,
+    "adam_eps": 1e-8,
+    "lr_decay": 10,
+    "Z_lr_decay": 5,
+    "clip_grad_param": 0.5,
+    "sampling_tau": 0.9,
+}
+
+
+class Model(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.mlp = nn.Sequential(nn.Linear(4, 16), nn.ReLU(), nn.Linear(16, 3))
+        self.logZ = nn.Linear(2, 1)
+        self.unused = nn.Linear(2, 2)  # Has no gradient
+
+    def loss(self, x):
+        return self.mlp(x).pow(2).sum() + self.logZ(x[:, :2]).pow(2).sum() * 10
+
+
+def reference_step(model, sampling_model, opt, opt_Z, lr_sched, lr_sched_Z, loss, clip_grad_type):
+    """The step SEHFragTrainer used to do: per-parameter clipping, two optimizers and a loop EMA"""
+    clip = {
+        "value": lambda p: torch.nn.utils.clip_grad_value_(p, HPS["clip_grad_param"]),
+        "norm": lambda p: torch.nn.utils.clip_grad_norm_(p, HPS["clip_grad_param"]),
+        "none": lambda p: None,
+    }[clip_grad_type]
+    loss.backward()
+    for i in model.parameters():
+        if i.grad is not None:  # Recent versions of torch fail on parameters without gradients
+            clip(i)
+    opt.step()
+    opt.zero_grad()
+    opt_Z.step()
+    opt_Z.zero_grad()
+    lr_sched.step()
+    lr_sched_Z.step()
+    for a, b in zip(model.parameters(), sampling_model.parameters()):
+        b.data.mul_(HPS["sampling_tau"]).add_(a.data * (1 - HPS["sampling_tau"]))
+
+
+@pytest.mark.parametrize("clip_grad_type", ["value", "norm", "none"])
+def test_fused_step_matches_reference(clip_grad_type):
+    hps = {**HPS, "clip_grad_type": clip_grad_type}
+    torch.manual_seed(0)
+    model = Model()
+    sampling_model = copy.deepcopy(model)
+    ref_model, ref_sampling_model = copy.deepcopy(model), copy.deepcopy(model)
+
+    fused = FusedOptimizerStep(model, hps, sampling_model)
+    Z_params = list(ref_model.logZ.parameters())
+    non_Z_params = [i for i in ref_model.parameters() if all(id(i) != id(j) for j in Z_params)]
+    opt = torch.optim.Adam(non_Z_params, hps["learning_rate"], (0.9, 0.999), weight_decay=1e-4, eps=1e-8)
+    opt_Z = torch.optim.Adam(Z_params, hps["Z_learning_rate"], (0.9, 0.999))
+    lr_sched = torch.optim.lr_scheduler.LambdaLR(opt, lambda steps: 2 ** (-steps / hps["lr_decay"]))
+    lr_sched_Z = torch.optim.lr_scheduler.LambdaLR(opt_Z, lambda steps: 2 ** (-steps / hps["Z_lr_decay"]))
+
+    for i in range(5):
+        x = torch.randn((8, 4))
+        fused(model.loss(x))
+        reference_step(
+            ref_model, ref_sampling_model, opt, opt_Z, lr_sched, lr_sched_Z, ref_model.loss(x), clip_grad_type
+        )
+    for a, b in zip(
+        list(model.parameters()) + list(sampling_model.parameters()),
+        list(ref_model.parameters()) + list(ref_sampling_model.parameters()),
+    ):
+        assert torch.allclose(a, b, atol=1e-6)
+    assert [g["lr"] for g in fused.opt.param_groups] == [opt.param_groups[0]["lr"], opt_Z.param_groups[0]["lr"]]
+
+
+def test_clip_grads():
+    torch.manual_seed(0)
+    model = Model()
+    model.loss(torch.randn((8, 4)) * 10).backward()
+    grads = [p.grad.clone() for p in model.parameters() if p.grad is not None]
+    clip_grads_(list(model.parameters()), "global_norm", 0.5)
+    clipped = [p.grad for p in model.parameters() if p.grad is not None]
+    assert torch.isclose(torch.stack([g.norm() for g in clipped]).norm(), torch.tensor(0.5))
+    # The direction of the global gradient is unchanged
+    coef = clipped[0].norm() / grads[0].norm()
+    assert all(torch.allclose(a, b * coef) for a, b in zip(clipped, grads))
+    norms = [g.norm() for g in clipped]
+    clip_grads_(list(model.parameters()), "norm", 0.01)
+    assert all(torch.isclose(g.norm(), n.clamp(max=0.01), rtol=1e-3) for g, n in zip(clipped, norms))
+    with pytest.raises(ValueError):
+        clip_grads_(list(model.parameters()), "max", 0.5)
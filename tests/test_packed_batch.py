@@ -0,0 +1,40 @@
+import torch
+from torch_geometric.data import Batch, Data
+
+from gflownet.data.packed_batch import PackedBatch
+from gflownet.envs.graph_building_env import augment_virtual_nodes
+
+
+def make_batch():
+    batch = Batch.from_data_list(
+        [
+            Data(x=torch.randn((2, 3)), edge_index=torch.tensor([[0, 1], [1, 0]]), mask=torch.ones((2, 1)).bool()),
+            Data(x=torch.randn((1, 3)), edge_index=torch.zeros((2, 0)).long(), mask=torch.zeros((1, 1)).bool()),
+        ],
+        follow_batch=["edge_index"],
+    )
+    batch.traj_lens = torch.tensor([2])
+    batch.log_rewards = torch.randn((1,), dtype=torch.float64)
+    batch.num_online = 1
+    batch.extra_info = {"foo": 0.5}
+    batch.mols = [object()]
+    return augment_virtual_nodes(batch)
+
+
+def test_round_trip():
+    batch = make_batch()
+    batch.batch_prime = make_batch()
+    packed = PackedBatch.from_batch(batch)
+    assert set(packed.buffers) == {torch.float32, torch.float64, torch.int64, torch.bool}
+    assert all(v.dtype == k and v.ndim == 1 for k, v in packed.buffers.items())
+    for b, u in [(batch, packed.to_batch()), (batch.batch_prime, packed.to_batch().batch_prime)]:
+        assert u.num_graphs == b.num_graphs
+        for k in ["x", "edge_index", "mask", "batch", "ptr", "edge_index_batch", "traj_lens", "log_rewards"]:
+            assert u[k].dtype == b[k].dtype and torch.equal(u[k], b[k])
+        for k in b._slice_dict:
+            assert torch.equal(u._slice_dict[k], b._slice_dict[k])
+            assert torch.equal(u._inc_dict[k], b._inc_dict[k])
+        assert torch.equal(u._aug_edge_index, b._aug_edge_index) and torch.equal(u._aug_batch, b._aug_batch)
+        assert u.num_online == 1 and u.extra_info == {"foo": 0.5}
+        assert not hasattr(u, "mols")
+        assert u.to_data_list()[0].x.shape == (2, 3)
@@ -0,0 +1,25 @@
+import pytest
+import torch
+from torch_geometric.data import Batch, Data
+
+from gflownet.data.prefetcher import DevicePrefetcher
+
+
+def batches(n, fail=False):
+    for i in range(n):
+        b = Batch.from_data_list([Data(x=torch.ones((2, 1)) * i)])
+        b.i = i
+        yield b
+    if fail:
+        raise RuntimeError("sampling failed")
+
+
+def test_prefetch_order():
+    assert [int(b.x[0, 0]) for b in DevicePrefetcher(batches(5), torch.device("cpu"), depth=2)] == list(range(5))
+
+
+def test_prefetch_error():
+    prefetcher = DevicePrefetcher(batches(1, fail=True), torch.device("cpu"), depth=1)
+    assert next(prefetcher).i == 0
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
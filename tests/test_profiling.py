@@ -0,0 +1,29 @@
+import pstats
+
+import torch
+
+from gflownet.utils.profiling import TorchProfileWindow, WorkerCProfiler
+
+
+def test_torch_profile_window(tmp_path):
+    profiler = TorchProfileWindow({"start_step": 2, "num_steps": 2, "activities": ["cpu"]}, str(tmp_path))
+    for it in range(1, 6):
+        profiler.step(it)
+        torch.randn((16, 16)).matmul(torch.randn((16, 16)))
+    profiler.close()
+    assert (tmp_path / "trace.json").exists()
+    assert "aten::matmul" in (tmp_path / "key_averages.txt").read_text()
+
+
+def test_worker_cprofiler(tmp_path):
+    def f():
+        return sum(range(100))
+
+    # Worker 1 of 2 produces batches 1, 3, 5, 7, ..., so only its 2nd and 3rd batches are profiled
+    profiler = WorkerCProfiler((2, 6), str(tmp_path), 1, 2)
+    for i in range(5):
+        profiler.step(i)
+        f()
+    assert profiler._done
+    stats = pstats.Stats(str(tmp_path / "worker_1.pstats"))
+    assert [v[1] for k, v in stats.stats.items() if k[2] == "f"] == [2]
@@ -0,0 +1,42 @@
+import gzip
+import pickle
+
+import pytest
+import requests
+import torch
+
+from gflownet.models import bengio2021flow
+
+
+@pytest.fixture
+def params_file(tmp_path):
+    """A best_params.pkl.gz with random weights, in the format of the original one"""
+    torch.manual_seed(0)
+    state_dict = bengio2021flow._original_architecture().state_dict()
+    params = [None] * 22
+    for k, i in bengio2021flow.ORIGINAL_PARAM_INDICES.items():
+        params[i] = state_dict[k].numpy()
+    path = tmp_path / "best_params.pkl.gz"
+    with gzip.open(path, "wb") as f:
+        pickle.dump(params, f)
+    return path, state_dict
+
+
+def test_load_from_cache(tmp_path, params_file, monkeypatch):
+    path, state_dict = params_file
+
+    def no_network(*args, **kwargs):
+        raise requests.ConnectionError("No network")
+
+    monkeypatch.setattr(requests, "get", no_network)
+    cache_dir = tmp_path / "cache"
+    with pytest.raises(RuntimeError, match="Could not download"):
+        bengio2021flow.load_original_model(str(cache_dir))
+    bengio2021flow.main(["--cache-dir", str(cache_dir), "--params-file", str(path)])
+    assert (cache_dir / bengio2021flow.CACHED_STATE_DICT).exists()
+    model = bengio2021flow.load_original_model(str(cache_dir))
+    loaded = model.state_dict()
+    assert all(torch.equal(loaded[k], state_dict[k]) for k in bengio2021flow.ORIGINAL_PARAM_INDICES)
+    # The cache directory defaults to $GFLOWNET_CACHE_DIR
+    monkeypatch.setenv("GFLOWNET_CACHE_DIR", str(cache_dir))
+    assert torch.equal(bengio2021flow.load_original_model().lin3.weight, model.lin3.weight)
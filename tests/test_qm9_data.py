@@ -0,0 +1,63 @@
+import io
+import tarfile
+
+import numpy as np
+import torch
+from rdkit import Chem
+
+from gflownet.data.qm9 import QM9_ELEMENTS, PreprocessedQM9Dataset, QM9Dataset, preprocess_qm9
+from gflownet.envs.mol_building_env import MolBuildingEnvContext
+
+SMILES = ["C", "CO", "C#N", "CC(=O)F", "C1CC1", "OCC=O", "CC(=O)[O-]", "c1ccncc1"]
+
+
+def write_xyz_tar(path, smiles=SMILES):
+    """Writes molecules in the format of QM9's dsgdb9nsd .xyz files (without coordinates)"""
+    with tarfile.open(path, "w:bz2") as f:
+        for i, smi in enumerate(smiles):
+            labels = [float(i), 1e-6] + [float(i * 15 + j) for j in range(2, 15)]
+            text = "\n".join(
+                [
+                    "0",
+                    f"gdb {i + 1}\t" + "\t".join(str(x) for x in labels).replace("e-06", "*^-6"),
+                    "0.0 0.0",
+                    f"{smi}\t{smi}",
+                    "InChI=1S/ InChI=1S/",
+                ]
+            ).encode()
+            info = tarfile.TarInfo(f"dsgdb9nsd_{i + 1:06d}.xyz")
+            info.size = len(text)
+            f.addfile(info, io.BytesIO(text))
+
+
+def test_preprocessed_qm9(tmp_path):
+    xyz = str(tmp_path / "qm9.tar.bz2")
+    write_xyz_tar(xyz)
+    ctx = MolBuildingEnvContext(QM9_ELEMENTS)
+    preprocess_qm9(str(tmp_path / "qm9"), ctx, xyz_file=xyz)
+    for train in [True, False]:
+        ref = QM9Dataset(xyz_file=xyz, train=train, ratio=0.75)
+        data = PreprocessedQM9Dataset(str(tmp_path / "qm9"), train=train, ratio=0.75)
+        assert len(data) == len(ref) == (6 if train else 2)
+        assert np.allclose(data.get_stats(), ref.get_stats())
+        for (g, y), (mol, ref_y) in zip(data, ref):
+            assert Chem.MolToSmiles(ctx.graph_to_mol(g)) == Chem.MolToSmiles(mol)
+            ref_d, d = ctx.graph_to_Data(ctx.mol_to_graph(mol)), ctx.graph_to_Data(g)
+            assert all(torch.equal(d[k], ref_d[k]) for k in ref_d.keys)
+            assert np.isclose(y, ref_y)
+    assert ref.df["rB"][0] == 1e-6
+
+
+def test_preprocessed_qm9_split(tmp_path):
+    # Molecules RDKit can't parse are dropped, but the others are split as with QM9Dataset
+    smiles = SMILES[:2] + ["C1CC"] + SMILES[2:]
+    xyz = str(tmp_path / "qm9.tar.bz2")
+    write_xyz_tar(xyz, smiles)
+    ctx = MolBuildingEnvContext(QM9_ELEMENTS)
+    preprocess_qm9(str(tmp_path / "qm9"), ctx, xyz_file=xyz)
+    for train in [True, False]:
+        ref = [(mol, y) for mol, y in QM9Dataset(xyz_file=xyz, train=train, ratio=0.5) if mol is not None]
+        data = PreprocessedQM9Dataset(str(tmp_path / "qm9"), train=train, ratio=0.5)
+        assert len(data) == len(ref)
+        for (g, y), (mol, ref_y) in zip(data, ref):
+            assert Chem.MolToSmiles(ctx.graph_to_mol(g)) == Chem.MolToSmiles(mol) and np.isclose(y, ref_y)
@@ -0,0 +1,127 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+import torch
+from rdkit import Chem
+
+from gflownet.algo.trajectory_balance import TrajectoryBalance
+from gflownet.data.replay_buffer import ReplayBuffer
+from gflownet.data.sampling_iterator import SamplingIterator
+from gflownet.envs.frag_mol_env import FragMolBuildingEnvContext
+from gflownet.envs.graph_building_env import GraphBuildingEnv
+from gflownet.models.graph_transformer import GraphTransformerGFN
+
+
+def setup(p_b_is_parameterized=False, n=16):
+    ctx = FragMolBuildingEnvContext(max_frags=5, num_cond_dim=4)
+    hps = {
+        "illegal_action_logreward": -75,
+        "bootstrap_own_reward": False,
+        "tb_epsilon": None,
+        "tb_p_b_is_parameterized": p_b_is_parameterized,
+    }
+    algo = TrajectoryBalance(GraphBuildingEnv(), ctx, np.random.default_rng(0), hps, max_len=8, max_nodes=5)
+    torch.manual_seed(0)
+    model = GraphTransformerGFN(ctx, num_emb=16, num_layers=1, do_bck=p_b_is_parameterized)
+    cond_info = torch.rand((n, 4))
+    with torch.no_grad():
+        trajs = algo.create_training_data_from_own_samples(model, n, cond_info, 0.0)
+    return ctx, algo, model, trajs, cond_info
+
+
+def make_buffer(ctx, algo, capacity=64, warmup=0, **kw):
+    return ReplayBuffer(
+        capacity, 10, ctx.num_cond_dim, store_bck_actions=algo.p_b_is_parameterized, warmup=warmup, **kw
+    )
+
+
+@pytest.mark.parametrize("p_b_is_parameterized", [False, True])
+def test_replay(p_b_is_parameterized):
+    ctx, algo, model, trajs, cond_info = setup(p_b_is_parameterized)
+    # The log-rewards identify the trajectories
+    log_rewards = torch.arange(len(trajs)).float()
+    buf = make_buffer(ctx, algo)
+    n = buf.add(trajs, cond_info, log_rewards, log_rewards[:, None])
+    assert n == len(buf) == int(trajs.is_valid.sum())
+    replayed = buf.sample(32, np.random.default_rng(0))
+    idx = replayed.log_rewards.long()
+    assert trajs.is_valid[idx].all()
+    assert torch.equal(replayed.cond_info, cond_info[idx])
+    assert torch.equal(replayed.flat_rewards[:, 0], log_rewards[idx])
+
+    batch = algo.construct_batch(replayed.trajs, replayed.cond_info, replayed.log_rewards)
+    smis = [Chem.MolToSmiles(ctx.graph_to_mol(trajs.results[i])) for i in idx]
+    assert [Chem.MolToSmiles(ctx.graph_to_mol(g)) for g in replayed.trajs.results] == smis
+    # The same trajectories, not replayed
+    orig = sum([trajs[i : i + 1] for i in idx.tolist()[1:]], trajs[idx[0] : idx[0] + 1])
+    orig_batch = algo.construct_batch(orig, cond_info[idx], log_rewards[idx])
+    for k in ["x", "edge_index", "traj_lens", "actions", "log_p_B"]:
+        assert torch.equal(getattr(batch, k).float(), getattr(orig_batch, k).float()), k
+    if p_b_is_parameterized:
+        assert torch.equal(batch.bck_actions, orig_batch.bck_actions)
+        assert torch.equal(batch.is_sink, orig_batch.is_sink)
+    for b in [batch, orig_batch]:
+        b.num_offline, b.num_online = 0, len(idx)
+    assert torch.isclose(algo.compute_batch_losses(model, batch)[0], algo.compute_batch_losses(model, orig_batch)[0])
+
+
+def test_eviction_and_prioritization():
+    ctx, algo, model, trajs, cond_info = setup()
+    trajs.is_valid[:] = True
+    buf = make_buffer(ctx, algo, capacity=4, sampling="reward", alpha=10.0)
+    log_rewards = torch.arange(len(trajs)).float()
+    for i in range(0, len(trajs), 3):
+        buf.add(trajs[i : i + 3], cond_info[i : i + 3], log_rewards[i : i + 3], log_rewards[i : i + 3, None])
+    # The oldest trajectories are evicted first
+    assert len(buf) == 4 and buf.num_added[0] == len(trajs)
+    assert sorted(buf.log_rewards.tolist()) == log_rewards[-4:].tolist()
+    rng = np.random.default_rng(0)
+    assert (buf.sample(16, rng).log_rewards == len(trajs) - 1).all()
+    buf.sampling, buf.recency_half_life = "recency", 1e-2
+    assert (buf.sample(16, rng).log_rewards == len(trajs) - 1).all()
+    buf.sampling = "uniform"
+    assert len(set(buf.sample(64, rng).log_rewards.tolist())) == 4
+
+
+def _add(buf, trajs, cond_info):
+    buf.add(trajs, cond_info, torch.zeros(len(trajs)), torch.zeros((len(trajs), 1)))
+
+
+def test_shared_between_processes():
+    ctx, algo, model, trajs, cond_info = setup()
+    buf = make_buffer(ctx, algo)
+    proc = multiprocessing.get_context("fork").Process(target=_add, args=(buf, trajs, cond_info))
+    proc.start()
+    proc.join()
+    assert len(buf) == int(trajs.is_valid.sum())
+    assert torch.equal(buf.cond_info[: len(buf)], cond_info[trajs.is_valid])
+
+
+class CountingTask:
+    def __init__(self):
+        self.num_rewards = 0
+
+    def sample_conditional_information(self, n):
+        return {"beta": torch.ones(n), "encoding": torch.rand((n, 4))}
+
+    def cond_info_to_logreward(self, cond_info, flat_rewards):
+        return flat_rewards[:, 0].log()
+
+    def compute_flat_rewards(self, mols):
+        self.num_rewards += len(mols)
+        return torch.ones((len(mols), 1)), torch.ones(len(mols)).bool()
+
+
+def test_sampling_iterator_replay():
+    ctx, algo, model, trajs, cond_info = setup()
+    buf = make_buffer(ctx, algo, warmup=4)
+    task = CountingTask()
+    it = SamplingIterator([], model, 8, ctx, algo, task, "cpu", ratio=0, replay_buffer=buf, replay_ratio=0.25)
+    batches = [b for _, b in zip(range(4), it)]
+    assert [b.num_replayed for b in batches] == [0, 2, 2, 2]
+    assert all(b.num_online + b.num_replayed == 8 == b.traj_lens.shape[0] for b in batches)
+    assert len(buf) == int(sum(b.is_valid[: b.num_online].sum() for b in batches))
+    assert task.num_rewards <= 8 + 3 * 6
+    loss, info = algo.compute_batch_losses(model, batches[-1])
+    assert torch.isfinite(loss) and info["replay_loss"] > 0
@@ -0,0 +1,18 @@
+import sqlite3
+
+import pytest
+
+from gflownet.data.sampling_iterator import SQLiteLog
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_insert_many(tmp_path, write_behind):
+    path = str(tmp_path / "log.db")
+    log = SQLiteLog(write_behind=write_behind, commit_every=10)
+    log.connect(path)
+    for i in range(5):
+        log.insert_many([["CCO", float(i), 0.5]] * 3, ["smi", "r", "fr_0"])
+    log.close()
+    db = sqlite3.connect(path)
+    assert db.execute("select count(*), sum(r) from results").fetchall() == [(15, 30.0)]
+    assert db.execute("pragma journal_mode").fetchall()[0][0] == ("wal" if write_behind else "delete")
@@ -0,0 +1,20 @@
+import time
+
+from gflownet.utils.timing import Timers
+
+
+def test_timers():
+    timers = Timers()
+    with timers("a"):
+        pass
+    assert timers.pop() == {}
+
+    timers.enabled = True
+    for i in range(2):
+        with timers("a"):
+            with timers("b"):
+                time.sleep(0.01)
+    totals = timers.pop()
+    assert sorted(totals.keys()) == ["time_a", "time_a/b"]
+    assert totals["time_a"] >= totals["time_a/b"] >= 0.02
+    assert timers.pop() == {}
@@ -0,0 +1,41 @@
+import networkx as nx
+import numpy as np
+import torch
+from rdkit import Chem
+
+from gflownet.data.trajectory_batch import TrajectoryBatch
+from gflownet.envs.graph_building_env import GraphBuildingEnv, generate_forward_trajectory
+from gflownet.envs.mol_building_env import MolBuildingEnvContext
+
+
+def make_trajs():
+    np.random.seed(0)
+    ctx = MolBuildingEnvContext()
+    smis = ["CC1CCC(O)C1", "C#N", "C[N+](C)(C)C"]
+    trajs = [generate_forward_trajectory(ctx.mol_to_graph(Chem.MolFromSmiles(s))) for s in smis]
+    return ctx, trajs, TrajectoryBatch.from_graph_trajectories(trajs, ctx)
+
+
+def test_replay():
+    ctx, trajs, batch = make_trajs()
+    graphs, torch_graphs, actions, bck_actions = batch.replay(GraphBuildingEnv(), ctx)
+    assert batch.traj_lens.tolist() == [len(i) for i in trajs]
+    assert len(graphs) == len(torch_graphs) == len(actions) == len(bck_actions) == batch.num_steps
+    for g, (gt, at), a in zip(graphs, [i for tj in trajs for i in tj], actions):
+        assert nx.is_isomorphic(g, gt, lambda a, b: a == b, lambda a, b: a == b)
+        assert a.action == at.action
+
+
+def test_slice_and_cat():
+    ctx, trajs, batch = make_trajs()
+    batch.infos[2]["smi"] = "C[N+](C)(C)C"
+    a, b = batch[:1], batch[1:]
+    assert len(a) == 1 and len(b) == 2
+    assert b.actions.shape[0] == batch.num_steps - len(trajs[0])
+    assert b.infos[1]["smi"] == "C[N+](C)(C)C"
+    b.is_valid[0] = False
+    assert batch.is_valid.tolist() == [True, False, True]
+    c = a + b
+    assert torch.equal(c.actions, batch.actions)
+    assert torch.equal(c.traj_lens, batch.traj_lens)
+    assert len(batch[3:]) == 0 and batch[3:].num_steps == 0